@@ -0,0 +1,310 @@
+import argparse
+import errno
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+from subprocess import PIPE
+
+from aws_gate import __version__
+from aws_gate.constants import AGENT_SUBCOMMANDS, DEFAULT_GATE_AGENT_SOCKET_PATH
+from aws_gate.exceptions import AgentError
+from aws_gate.utils import execute, execute_plugin, redirected_execution
+
+logger = logging.getLogger(__name__)
+
+# aws-gate agent is a long running process, which runs subcommands on behalf of
+# aws-gate invocations (clients). The agent keeps AWS sessions, clients and all
+# in-process caches warm between invocations, while the client only spawns the
+# processes which need the user's terminal (session-manager-plugin, ssh).
+#
+# The protocol consists of JSON messages separated by newlines. The client sends
+# a single "run" message and then serves "log", "output" and "execute" messages
+# until the agent replies with either "done", "error" or "fallback". "fallback"
+# means that the agent cannot run the subcommand and the client has to run it
+# in-process instead.
+
+# Clients serving a subcommand in the agent, keyed by thread
+_CLIENT = threading.local()
+
+# The agent listens on a Unix domain socket, which not every platform supports
+HAS_UNIX_SOCKETS = hasattr(socket, "AF_UNIX")
+
+
+def _send(f, message):
+    f.write(json.dumps(message).encode() + b"\n")
+    f.flush()
+
+
+def _receive(f):
+    line = f.readline()
+    if not line:
+        raise ConnectionError("Connection closed by peer")
+    return json.loads(line.decode())
+
+
+def _aws_environment():
+    # AWS sessions in the agent are created from the agent's environment, so we
+    # can serve only clients sharing it
+    return {k: v for k, v in os.environ.items() if k.startswith("AWS_")}
+
+
+def _connect(socket_path):
+    if not os.path.exists(socket_path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError as e:
+        logger.debug("Unable to connect to aws-gate agent at %s: %s", socket_path, e)
+        sock.close()
+        return None
+
+    return sock
+
+
+def _execute_locally(message):
+    kwargs = {"stdout": PIPE, "stderr": PIPE} if message["capture"] else {}
+    try:
+        if message["plugin"]:
+            output = execute_plugin(message["args"], **kwargs)
+        else:
+            output = execute(message["cmd"], message["args"], **kwargs)
+    except ValueError as e:
+        return {"type": "result", "error": str(e)}
+
+    return {"type": "result", "output": output}
+
+
+def run_in_agent(args, log_level=logging.ERROR, socket_path=None):
+    if not HAS_UNIX_SOCKETS:
+        return False
+
+    socket_path = socket_path or DEFAULT_GATE_AGENT_SOCKET_PATH
+
+    sock = _connect(socket_path)
+    if sock is None:
+        return False
+
+    logger.debug("Running %s in aws-gate agent at %s", args.subcommand, socket_path)
+    with sock, sock.makefile("rwb") as f:
+        _send(
+            f,
+            {
+                "type": "run",
+                "version": __version__,
+                "args": vars(args),
+                "env": _aws_environment(),
+                "log_level": log_level,
+            },
+        )
+
+        while True:
+            message = _receive(f)
+            if message["type"] == "fallback":
+                logger.debug(
+                    "aws-gate agent declined the request: %s", message["reason"]
+                )
+                return False
+            if message["type"] == "done":
+                return True
+            if message["type"] == "error":
+                raise AgentError(message["message"])
+
+            if message["type"] == "log":
+                logging.getLogger(message["name"]).log(
+                    message["level"], "%s", message["message"]
+                )
+            elif message["type"] == "output":
+                stream = getattr(sys, message.get("stream", "stdout"))
+                stream.write(message["data"])
+                stream.flush()
+            elif message["type"] == "execute":
+                _send(f, _execute_locally(message))
+
+
+class _ClientChannel:
+    def __init__(self, rfile, wfile, log_level):
+        self._rfile = rfile
+        self._wfile = wfile
+        self.log_level = log_level
+
+    def send(self, message):
+        _send(self._wfile, message)
+
+    def execute(self, cmd, args, plugin=False, **kwargs):
+        self.send(
+            {
+                "type": "execute",
+                "cmd": cmd,
+                "args": args,
+                "plugin": plugin,
+                "capture": kwargs.get("stdout") == PIPE,
+            }
+        )
+        result = _receive(self._rfile)
+        if result.get("error"):
+            raise ValueError(result["error"])
+
+        return result.get("output")
+
+
+class _ClientStream:
+    # Output of subcommands running in the agent belongs to the client, so we
+    # replace sys.stdout and sys.stderr with streams forwarding writes from
+    # threads serving clients and passing everything else through
+
+    def __init__(self, stream, name="stdout"):
+        self._stream = stream
+        self._name = name
+
+    def write(self, data):
+        channel = getattr(_CLIENT, "channel", None)
+        if channel is None:
+            return self._stream.write(data)
+
+        channel.send({"type": "output", "stream": self._name, "data": data})
+        return len(data)
+
+    def flush(self):
+        if getattr(_CLIENT, "channel", None) is None:
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class _ClientLogHandler(logging.Handler):
+    def emit(self, record):
+        channel = getattr(_CLIENT, "channel", None)
+        if channel is None or record.levelno < channel.log_level:
+            return
+
+        try:
+            channel.send(
+                {
+                    "type": "log",
+                    "name": record.name,
+                    "level": record.levelno,
+                    "message": record.getMessage(),
+                }
+            )
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+
+
+class AgentRequestHandler(socketserver.StreamRequestHandler):
+    def _decline(self, reason):
+        logger.debug("Declining request: %s", reason)
+        _send(self.wfile, {"type": "fallback", "reason": reason})
+
+    def handle(self):
+        try:
+            request = _receive(self.rfile)
+        except (ConnectionError, ValueError) as e:
+            logger.debug("Invalid request: %s", e)
+            return
+
+        if request.get("version") != __version__:
+            self._decline(f"aws-gate agent runs version {__version__}")
+            return
+        if request.get("env") != _aws_environment():
+            self._decline("AWS environment differs from aws-gate agent")
+            return
+        if request.get("args", {}).get("subcommand") not in AGENT_SUBCOMMANDS:
+            self._decline("Subcommand cannot be run in aws-gate agent")
+            return
+
+        # pylint: disable=import-outside-toplevel,cyclic-import
+        from aws_gate.cli import run_subcommand
+
+        args = argparse.Namespace(**request["args"])
+        channel = _ClientChannel(self.rfile, self.wfile, request["log_level"])
+
+        logger.debug("Running subcommand: %s", args.subcommand)
+        _CLIENT.channel = channel
+        try:
+            with redirected_execution(channel.execute):
+                run_subcommand(args)
+        except ConnectionError:
+            logger.debug("Client disconnected while running %s", args.subcommand)
+            return
+        except Exception as e:  # pylint: disable=broad-except
+            logger.debug("Subcommand %s failed: %s", args.subcommand, e)
+            channel.send({"type": "error", "message": str(e)})
+            return
+        finally:
+            _CLIENT.channel = None
+
+        channel.send({"type": "done"})
+
+
+if HAS_UNIX_SOCKETS:
+
+    class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self, socket_path):
+            if os.path.exists(socket_path):
+                sock = _connect(socket_path)
+                if sock is not None:
+                    sock.close()
+                    raise ValueError(
+                        f"aws-gate agent is already running at {socket_path}"
+                    )
+
+                logger.debug("Removing stale socket: %s", socket_path)
+                os.unlink(socket_path)
+
+            os.makedirs(os.path.dirname(socket_path), mode=0o700, exist_ok=True)
+
+            # Only the user running the agent is allowed to talk to it
+            umask = os.umask(0o177)
+            try:
+                super().__init__(socket_path, AgentRequestHandler)
+            finally:
+                os.umask(umask)
+
+            self.socket_path = socket_path
+
+        def server_close(self):
+            super().server_close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+def _attach_client_logging():
+    # Log records have to be produced regardless of the agent's own verbosity,
+    # as clients might ask for more verbose output
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers:
+        handler.setLevel(max(handler.level, root_logger.level))
+    root_logger.setLevel(logging.DEBUG)
+    root_logger.addHandler(_ClientLogHandler())
+
+
+def agent(socket_path=None):
+    if not HAS_UNIX_SOCKETS:
+        raise ValueError("aws-gate agent requires Unix domain sockets")
+
+    socket_path = socket_path or DEFAULT_GATE_AGENT_SOCKET_PATH
+
+    server = AgentServer(socket_path)
+    _attach_client_logging()
+    sys.stdout = _ClientStream(sys.stdout)
+    sys.stderr = _ClientStream(sys.stderr, name="stderr")
+
+    logger.info("aws-gate agent listening on %s", socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down aws-gate agent")
+    finally:
+        server.server_close()
@@ -3,13 +3,10 @@ import logging
 import os
 import sys
 
-from marshmallow import ValidationError
-from yaml.scanner import ScannerError
-
 from aws_gate import __version__, __description__
-from aws_gate.bootstrap import bootstrap
-from aws_gate.config import load_config_from_files
 from aws_gate.constants import (
+    AGENT_SUBCOMMANDS,
+    AWS_REGIONS,
     SUPPORTED_KEY_TYPES,
     DEBUG,
     AWS_DEFAULT_REGION,
@@ -21,14 +18,17 @@ from aws_gate.constants import (
     DEFAULT_LIST_HUMAN_FIELDS,
     DEFAULT_LIST_OUTPUT_FORMATS,
     DEFAULT_LIST_OUTPUT,
+    DEFAULT_INSTANCE_SELECTION,
+    DEFAULT_PROFILE_PREFERENCE,
+    INSTANCE_SELECTION_POLICIES,
+    PROFILE_PREFERENCES,
 )
-from aws_gate.exec import exec
-from aws_gate.list import list_instances
-from aws_gate.session import session
-from aws_gate.ssh import ssh
-from aws_gate.ssh_config import ssh_config
-from aws_gate.ssh_proxy import ssh_proxy
-from aws_gate.utils import get_default_region
+
+# Subcommand modules (and their dependencies like boto3, cryptography, requests,
+# PyYAML or marshmallow) are imported lazily in run_subcommand(), so that every
+# invocation only pays for the modules needed by the chosen subcommand. This
+# matters for ssh-proxy, which is spawned by ssh for every connection.
+# pylint: disable=import-outside-toplevel
 
 logger = logging.getLogger(__name__)
 
@@ -47,7 +47,94 @@ def _get_region(args, config, default):
     return region or config.default_region or default
 
 
-def get_argument_parser(*args, **kwargs):
+def _add_instance_query_arguments(parser):
+    parser.add_argument(
+        "--select",
+        help="Instance to choose when several instances match",
+        default=DEFAULT_INSTANCE_SELECTION,
+        choices=INSTANCE_SELECTION_POLICIES,
+        dest="selection",
+    )
+    parser.add_argument(
+        "--availability-zone",
+        help="Availability zone preferred by same-az selection",
+        default=None,
+        dest="availability_zone",
+    )
+    parser.add_argument(
+        "--fallback-regions",
+        help="Regions to search when instance is not found (comma separated "
+        "or 'all')",
+        default=None,
+        dest="fallback_regions",
+    )
+
+
+def _parse_regions(regions):
+    if regions is None:
+        return None
+    if regions == "all":
+        return AWS_REGIONS
+    return [region for region in regions.split(",") if region]
+
+
+def _get_fallback_regions(args):
+    return _parse_regions(args.fallback_regions)
+
+
+def _get_region_names(args):
+    return _parse_regions(args.region_names)
+
+
+def _add_profile_set_arguments(parser):
+    parser.add_argument(
+        "--profiles",
+        help="AWS profiles to look for the instance in (comma separated or 'all')",
+        default=None,
+        dest="profile_names",
+    )
+    parser.add_argument(
+        "--profile-preference",
+        help="Profile to use when the instance is found in several profiles",
+        default=DEFAULT_PROFILE_PREFERENCE,
+        choices=PROFILE_PREFERENCES,
+        dest="profile_preference",
+    )
+
+
+def _add_target_set_arguments(parser):
+    parser.add_argument(
+        "--profiles",
+        help="AWS profiles to list instances from (comma separated or 'all')",
+        default=None,
+        dest="profile_names",
+    )
+    parser.add_argument(
+        "--regions",
+        help="AWS regions to list instances from (comma separated or 'all')",
+        default=None,
+        dest="region_names",
+    )
+    parser.add_argument(
+        "--all-regions",
+        help="List instances from all AWS regions",
+        action="store_const",
+        const="all",
+        dest="region_names",
+    )
+
+
+def _get_profile_names(args):
+    from aws_gate.utils import get_aws_profiles
+
+    if args.profile_names is None:
+        return None
+    if args.profile_names == "all":
+        return get_aws_profiles()
+    return [profile for profile in args.profile_names.split(",") if profile]
+
+
+def get_argument_parser(*args, **kwargs):  # pylint: disable=too-many-statements
     parser = argparse.ArgumentParser(*args, **kwargs)
     parser.add_argument(
         "-v", "--verbose", help="increase output verbosity", action="store_true"
@@ -65,12 +152,25 @@ def get_argument_parser(*args, **kwargs):
         "-f", "--force", action="store_true", help="Forces bootstrap operation"
     )
 
+    # 'agent' subcommand
+    subparsers.add_parser(
+        "agent", help="Run aws-gate agent keeping AWS clients and caches warm"
+    )
+
     # 'exec' subcommand
     exec_parser = subparsers.add_parser(
         "exec", help="Execute interactive command on instance"
     )
     exec_parser.add_argument("-p", "--profile", help="AWS profile to use")
     exec_parser.add_argument("-r", "--region", help="AWS region to use")
+    _add_instance_query_arguments(exec_parser)
+    _add_profile_set_arguments(exec_parser)
+    exec_parser.add_argument(
+        "--all",
+        help="Execute command on all matching instances",
+        action="store_true",
+        dest="all_instances",
+    )
     exec_parser.add_argument(
         "instance_name", help="Instance we wish to execute command on"
     )
@@ -84,6 +184,8 @@ def get_argument_parser(*args, **kwargs):
     )
     session_parser.add_argument("-p", "--profile", help="AWS profile to use")
     session_parser.add_argument("-r", "--region", help="AWS region to use")
+    _add_instance_query_arguments(session_parser)
+    _add_profile_set_arguments(session_parser)
     session_parser.add_argument(
         "instance_name", help="Instance we wish to open session to"
     )
@@ -94,6 +196,8 @@ def get_argument_parser(*args, **kwargs):
     )
     ssh_parser.add_argument("-p", "--profile", help="AWS profile to use")
     ssh_parser.add_argument("-r", "--region", help="AWS region to use")
+    _add_instance_query_arguments(ssh_parser)
+    _add_profile_set_arguments(ssh_parser)
     ssh_parser.add_argument(
         "-l", "--os-user", help="SSH user to use", type=str, default=DEFAULT_OS_USER
     )
@@ -132,6 +236,11 @@ def get_argument_parser(*args, **kwargs):
     ssh_parser.add_argument(
         "--key-size", type=int, default=DEFAULT_KEY_SIZE, help=argparse.SUPPRESS
     )
+    ssh_parser.add_argument(
+        "--ssh-agent",
+        help="Serve SSH key to ssh by an agent instead of writing it to disk",
+        action="store_true",
+    )
     ssh_parser.add_argument("instance_name", help="Instance we wish to open session to")
     ssh_parser.add_argument(
         "command", help="command to execute on the instance", nargs=argparse.REMAINDER
@@ -156,6 +265,7 @@ def get_argument_parser(*args, **kwargs):
     )
     ssh_proxy_parser.add_argument("-p", "--profile", help="AWS profile to use")
     ssh_proxy_parser.add_argument("-r", "--region", help="AWS region to use")
+    _add_instance_query_arguments(ssh_proxy_parser)
     ssh_proxy_parser.add_argument(
         "-l", "--os-user", help="SSH user to use", type=str, default=DEFAULT_OS_USER
     )
@@ -172,6 +282,11 @@ def get_argument_parser(*args, **kwargs):
     ssh_proxy_parser.add_argument(
         "--key-size", type=int, default=DEFAULT_KEY_SIZE, help=argparse.SUPPRESS
     )
+    ssh_proxy_parser.add_argument(
+        "--key-path",
+        help="File to write SSH key to, which might be shared by concurrent "
+        "sessions (default: ~/.aws-gate/key)",
+    )
     ssh_proxy_parser.add_argument(
         "instance_name", help="Instance we wish to open session to"
     )
@@ -182,6 +297,20 @@ def get_argument_parser(*args, **kwargs):
     )
     ls_parser.add_argument("-p", "--profile", help="AWS profile to use")
     ls_parser.add_argument("-r", "--region", help="AWS region to use")
+    _add_target_set_arguments(ls_parser)
+    ls_parser.add_argument(
+        "--filter",
+        help="Filter instances by tag:KEY, vpc, az, platform, name prefix or "
+        "output field (KEY=VALUE[,VALUE...])",
+        action="append",
+        default=None,
+        dest="filters",
+    )
+    ls_parser.add_argument(
+        "--inventory",
+        help="List instances from the local inventory when it is fresh",
+        action="store_true",
+    )
     ls_parser.add_argument(
         "-f",
         "--format",
@@ -192,8 +321,27 @@ def get_argument_parser(*args, **kwargs):
     ls_parser.add_argument(
         "-o",
         "--output",
-        help=argparse.SUPPRESS,
-        default=",".join(DEFAULT_LIST_HUMAN_FIELDS),
+        help="Fields to output (comma separated)",
+        default=None,
+    )
+
+    # 'inventory' subcommand
+    inventory_parser = subparsers.add_parser(
+        "inventory", help="Manage local inventory of instances"
+    )
+    inventory_subparsers = inventory_parser.add_subparsers(
+        title="inventory commands", dest="inventory_command", required=True
+    )
+    inventory_sync_parser = inventory_subparsers.add_parser(
+        "sync", help="Synchronize local inventory with AWS"
+    )
+    inventory_sync_parser.add_argument("-p", "--profile", help="AWS profile to use")
+    inventory_sync_parser.add_argument("-r", "--region", help="AWS region to use")
+    _add_target_set_arguments(inventory_sync_parser)
+    inventory_sync_parser.add_argument(
+        "--full",
+        help="Fetch details of all instances, not only of the changed ones",
+        action="store_true",
     )
 
     return parser, subparsers
@@ -213,6 +361,13 @@ def parse_arguments(parser=None):
 
 
 def main(args=None, argument_parser=None):
+    # Shell completion runs on every <Tab>, so it skips building the argument
+    # parser and everything else a subcommand needs
+    if not args and sys.argv[1:2] == ["__complete"]:
+        from aws_gate.completion import complete
+
+        sys.exit(complete(sys.argv[2:]))
+
     if not args:
         args = parse_arguments(argument_parser)
 
@@ -236,6 +391,37 @@ def main(args=None, argument_parser=None):
 
     logging.basicConfig(level=log_level, stream=sys.stderr, format=log_format)
 
+    # When aws-gate agent is running, we let it do all the work with its warm
+    # caches and AWS clients and only spawn processes needing our terminal
+    if args.subcommand in AGENT_SUBCOMMANDS:
+        from aws_gate.agent import run_in_agent
+
+        if run_in_agent(args, log_level=log_level):
+            return
+
+    run_subcommand(args)
+
+
+def run_subcommand(args):  # pylint: disable=too-many-statements
+    # bootstrap and agent do not need any configuration or AWS credentials
+    if args.subcommand == "bootstrap":
+        from aws_gate.bootstrap import bootstrap
+
+        bootstrap(force=args.force)
+        return
+
+    if args.subcommand == "agent":
+        from aws_gate.agent import agent
+
+        agent()
+        return
+
+    from marshmallow import ValidationError
+    from yaml.scanner import ScannerError
+
+    from aws_gate.config import load_config_from_files
+    from aws_gate.utils import get_default_region
+
     try:
         config = load_config_from_files()
     except (ValidationError, ScannerError) as e:
@@ -267,24 +453,39 @@ def main(args=None, argument_parser=None):
 
     logger.debug('Using AWS profile "%s" in region "%s"', profile, region)
 
-    if args.subcommand == "bootstrap":
-        bootstrap(force=args.force)
-    elif args.subcommand == "exec":
+    if args.subcommand == "exec":
+        from aws_gate.exec import exec
+
         exec(
             config=config,
             instance_name=args.instance_name,
             command=args.command,
             region_name=region,
             profile_name=profile,
+            selection=args.selection,
+            availability_zone=args.availability_zone,
+            fallback_regions=_get_fallback_regions(args),
+            all_instances=args.all_instances,
+            profile_names=_get_profile_names(args),
+            profile_preference=args.profile_preference,
         )
     elif args.subcommand == "session":
+        from aws_gate.session import session
+
         session(
             config=config,
             instance_name=args.instance_name,
             region_name=region,
             profile_name=profile,
+            selection=args.selection,
+            availability_zone=args.availability_zone,
+            fallback_regions=_get_fallback_regions(args),
+            profile_names=_get_profile_names(args),
+            profile_preference=args.profile_preference,
         )
     elif args.subcommand == "ssh":
+        from aws_gate.ssh import ssh
+
         ssh(
             config=config,
             instance_name=args.instance_name,
@@ -298,12 +499,22 @@ def main(args=None, argument_parser=None):
             local_forward=args.local_forward,
             remote_forward=args.remote_forward,
             dynamic_forward=args.dynamic_forward,
+            selection=args.selection,
+            availability_zone=args.availability_zone,
+            fallback_regions=_get_fallback_regions(args),
+            profile_names=_get_profile_names(args),
+            profile_preference=args.profile_preference,
+            ssh_agent=args.ssh_agent,
         )
     elif args.subcommand == "ssh-config":
+        from aws_gate.ssh_config import ssh_config
+
         ssh_config(
             region_name=region, profile_name=profile, user=args.os_user, port=args.port
         )
     elif args.subcommand == "ssh-proxy":
+        from aws_gate.ssh_proxy import ssh_proxy
+
         ssh_proxy(
             config=config,
             instance_name=args.instance_name,
@@ -313,14 +524,41 @@ def main(args=None, argument_parser=None):
             port=args.port,
             key_type=args.key_type,
             key_size=args.key_size,
+            selection=args.selection,
+            availability_zone=args.availability_zone,
+            fallback_regions=_get_fallback_regions(args),
+            key_path=args.key_path,
         )
     elif args.subcommand in ["ls", "list"]:
-        fields = args.output.split(",")
+        from aws_gate.list import list_instances
+
+        profile_names = _get_profile_names(args)
+        region_names = _get_region_names(args)
+        if args.output is not None:
+            fields = args.output.split(",")
+        elif profile_names or region_names:
+            fields = DEFAULT_LIST_HUMAN_FIELDS + ("profile", "region")
+        else:
+            fields = DEFAULT_LIST_HUMAN_FIELDS
         list_instances(
             region_name=region,
             profile_name=profile,
             output_format=args.format,
             fields=fields,
+            profile_names=profile_names,
+            region_names=region_names,
+            filters=args.filters,
+            inventory=args.inventory,
+        )
+    elif args.subcommand == "inventory":
+        from aws_gate.inventory_sync import sync
+
+        sync(
+            region_name=region,
+            profile_name=profile,
+            profile_names=_get_profile_names(args),
+            region_names=_get_region_names(args),
+            full=args.full,
         )
 
 
@@ -0,0 +1,182 @@
+import bisect
+import configparser
+import heapq
+import logging
+import os
+import re
+import stat
+import sys
+
+from aws_gate.constants import (
+    ALIAS_PATTERN_CHARS,
+    AWS_REGIONS,
+    DEFAULT_GATE_COMPLETION_DIR,
+    DEFAULT_GATE_CONFIG_PATH,
+    DEFAULT_GATE_CONFIGD_PATH,
+)
+
+# Shell completion runs on every <Tab>, so this module must stay cheap to
+# import: no boto3, PyYAML or marshmallow, and no aws_gate modules pulling
+# them in. Host names are read from lists written by the commands which
+# already paid for loading the configuration or the inventory. Prefix lookups
+# bisect these sorted lists rather than building a NameIndex (aws_gate.names)
+# on every <Tab>, the index only pays off for suggestions of similar names.
+
+logger = logging.getLogger(__name__)
+
+HOST_SOURCES = ["aliases", "instances"]
+
+# Host aliases in YAML configuration, good enough for completion only
+ALIAS_LINE_REGEX = re.compile(r"^\s*(?:-\s+)?alias:\s*[\"']?([^\s\"'#]+)")
+
+
+def _read_names(source):
+    try:
+        with open(
+            os.path.join(DEFAULT_GATE_COMPLETION_DIR, source), "r", encoding="utf-8"
+        ) as f:
+            return f.read().splitlines()
+    except OSError:
+        return []
+
+
+def store_names(source, names):
+    from aws_gate.utils import (  # pylint: disable=import-outside-toplevel
+        write_file_atomically,
+    )
+
+    # Names are stored sorted, so completion can bisect them
+    data = "".join(f"{name}\n" for name in sorted(set(names)))
+    try:
+        write_file_atomically(
+            os.path.join(DEFAULT_GATE_COMPLETION_DIR, source), data.encode("utf-8")
+        )
+    except OSError as e:
+        logger.debug("Unable to store %s for completion: %s", source, e)
+
+
+def _iter_prefixed(names, prefix):
+    # names are sorted, so the ones starting with prefix form a single run
+    for name in names[bisect.bisect_left(names, prefix) :]:
+        if not name.startswith(prefix):
+            break
+        yield name
+
+
+def _get_config_mtimes():
+    paths = [DEFAULT_GATE_CONFIG_PATH]
+    try:
+        paths += [
+            os.path.join(DEFAULT_GATE_CONFIGD_PATH, f)
+            for f in os.listdir(DEFAULT_GATE_CONFIGD_PATH)
+        ]
+    except OSError:
+        pass
+
+    mtimes = {}
+    for path in paths:
+        try:
+            path_stat = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISREG(path_stat.st_mode):
+            mtimes[path] = path_stat.st_mtime_ns
+    return mtimes
+
+
+def _scan_aliases(paths):
+    aliases = set()
+    for path in paths:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    match = ALIAS_LINE_REGEX.match(line)
+                    if match and ALIAS_PATTERN_CHARS.isdisjoint(match.group(1)):
+                        aliases.add(match.group(1))
+        except (OSError, ValueError) as e:
+            logger.debug("Unable to read aliases from %s: %s", path, e)
+    return sorted(aliases)
+
+
+def _read_aliases():
+    # Aliases are stored when the configuration is loaded after a change. When
+    # the configuration was edited since, they are scanned from the files
+    # directly until the next aws-gate run stores them again.
+    mtimes = _get_config_mtimes()
+    try:
+        stored = os.stat(os.path.join(DEFAULT_GATE_COMPLETION_DIR, "aliases"))
+    except OSError:
+        stored = None
+
+    if stored is not None and all(
+        mtime <= stored.st_mtime_ns for mtime in mtimes.values()
+    ):
+        return _read_names("aliases") if mtimes else []
+
+    logger.debug("Stored aliases are stale, reading configuration files")
+    return _scan_aliases(mtimes)
+
+
+def _complete_hosts(prefix):
+    names = {"aliases": _read_aliases(), "instances": _read_names("instances")}
+    previous = None
+    for name in heapq.merge(
+        *[_iter_prefixed(names[source], prefix) for source in HOST_SOURCES]
+    ):
+        if name != previous:
+            yield name
+        previous = name
+
+
+def _complete_profiles(prefix):
+    profiles = set()
+    for path, section_prefix in [
+        (
+            os.environ.get("AWS_CONFIG_FILE", os.path.expanduser("~/.aws/config")),
+            "profile ",
+        ),
+        (
+            os.environ.get(
+                "AWS_SHARED_CREDENTIALS_FILE", os.path.expanduser("~/.aws/credentials")
+            ),
+            "",
+        ),
+    ]:
+        parser = configparser.RawConfigParser()
+        try:
+            parser.read(path)
+        except configparser.Error as e:
+            logger.debug("Unable to read profiles from %s: %s", path, e)
+            continue
+
+        for section in parser.sections():
+            # Besides profiles, AWS config has e.g. sso-session sections
+            if section == "default":
+                profiles.add(section)
+            elif section.startswith(section_prefix):
+                profiles.add(section[len(section_prefix) :].strip())
+
+    return _iter_prefixed(sorted(profiles), prefix)
+
+
+def _complete_regions(prefix):
+    return _iter_prefixed(sorted(AWS_REGIONS), prefix)
+
+
+def complete(args, stream=None):
+    stream = stream or sys.stdout
+    completers = {
+        "hosts": _complete_hosts,
+        "profiles": _complete_profiles,
+        "regions": _complete_regions,
+    }
+
+    if not args or args[0] not in completers:
+        sys.stderr.write(
+            f"usage: aws-gate __complete {{{','.join(completers)}}} [PREFIX]\n"
+        )
+        return 2
+
+    prefix = args[1] if len(args) > 1 else ""
+    stream.writelines(f"{name}\n" for name in completers[args[0]](prefix))
+    return 0
@@ -1,13 +1,28 @@
+import collections
+import fnmatch
+import json
 import logging
 import os
+import re
 
 import yaml
 from marshmallow import Schema, fields, post_load, ValidationError
 from yaml.constructor import ConstructorError
 from yaml.parser import ParserError
 
-from aws_gate.constants import DEFAULT_GATE_CONFIG_PATH, DEFAULT_GATE_CONFIGD_PATH
-from aws_gate.utils import is_existing_profile, is_existing_region
+from aws_gate import __version__
+from aws_gate.completion import store_names
+from aws_gate.constants import (
+    ALIAS_PATTERN_CHARS,
+    DEFAULT_GATE_CONFIG_PATH,
+    DEFAULT_GATE_CONFIGD_PATH,
+    DEFAULT_GATE_CONFIG_CACHE_PATH,
+)
+from aws_gate.utils import (
+    is_existing_profile,
+    is_existing_region,
+    write_file_atomically,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -55,11 +70,63 @@ class GateConfigSchema(Schema):
         return GateConfig(**data)
 
 
+def _is_alias_pattern(alias):
+    return not ALIAS_PATTERN_CHARS.isdisjoint(alias)
+
+
+def _get_literal_prefix(pattern):
+    return re.split(r"[*?[]", pattern, maxsplit=1)[0]
+
+
+def _index_alias_patterns(patterns):
+    # Patterns are bucketed by their literal prefix (everything before the
+    # first wildcard), so a lookup only tries the buckets whose prefix the name
+    # starts with. Buckets are keyed by the prefix length first, lookups go
+    # through them from the shortest prefix.
+    index = collections.defaultdict(lambda: collections.defaultdict(list))
+    for position, pattern in enumerate(patterns):
+        prefix = _get_literal_prefix(pattern)
+        index[len(prefix)][prefix].append((position, pattern))
+
+    return sorted((length, dict(buckets)) for length, buckets in index.items())
+
+
+def _compile_alias_patterns(patterns):
+    # Patterns of a bucket are compiled into a single regular expression, with
+    # every pattern in a group named after its position in the configuration
+    return re.compile(
+        "|".join(
+            f"(?P<alias{position}>{fnmatch.translate(pattern)})"
+            for position, pattern in patterns
+        )
+    )
+
+
 class GateConfig:
     def __init__(self, defaults, hosts):
         self._defaults = defaults
         self._hosts = hosts
 
+        # Host aliases are indexed once. When the same alias is defined
+        # multiple times, the first definition wins (configuration files are
+        # loaded from ~/.aws-gate/config.d in alphabetical order first and
+        # ~/.aws-gate/config last).
+        self._hosts_by_alias = {}
+        self._host_patterns = []
+        for host in hosts:
+            alias = host["alias"]
+            if _is_alias_pattern(alias):
+                self._host_patterns.append(host)
+            elif alias not in self._hosts_by_alias:
+                self._hosts_by_alias[alias] = host
+            else:
+                logger.debug("Ignoring duplicate definition of host alias: %s", alias)
+
+        # Compiling the patterns is comparatively expensive, so it is deferred
+        # until a lookup misses the exact aliases
+        self._host_pattern_index = None
+        self._host_pattern_matchers = {}
+
     @property
     def hosts(self):
         return self._hosts
@@ -80,11 +147,57 @@ class GateConfig:
             return self._defaults["profile"]
         return None
 
+    def _match_host_pattern(self, name):
+        if not self._host_patterns:
+            return {}
+
+        if self._host_pattern_index is None:
+            self._host_pattern_index = _index_alias_patterns(
+                [host["alias"] for host in self._host_patterns]
+            )
+
+        # Alternatives are tried in order, so the first pattern of a bucket
+        # matching the name wins. Across buckets, the first pattern from the
+        # configuration wins.
+        position = None
+        for length, buckets in self._host_pattern_index:
+            if length > len(name):
+                break
+
+            prefix = name[:length]
+            if prefix not in buckets:
+                continue
+
+            matcher = self._host_pattern_matchers.get(prefix)
+            if matcher is None:
+                matcher = _compile_alias_patterns(buckets[prefix])
+                self._host_pattern_matchers[prefix] = matcher
+
+            match = matcher.match(name)
+            if match is not None:
+                matched = int(match.lastgroup[len("alias") :])
+                position = matched if position is None else min(position, matched)
+
+        if position is None:
+            return {}
+
+        pattern_host = self._host_patterns[position]
+        logger.debug(
+            "Host %s matched host alias pattern: %s", name, pattern_host["alias"]
+        )
+        host = dict(pattern_host, alias=name)
+        # A pattern used as the name stands for the host name being looked up
+        if pattern_host["name"] == pattern_host["alias"]:
+            host["name"] = name
+
+        return host
+
     def get_host(self, name):
-        host = [host for host in self._hosts if host["alias"] == name]
-        if host:
-            return host[0]
-        return {}
+        host = self._hosts_by_alias.get(name)
+        if host is not None:
+            return host
+
+        return self._match_host_pattern(name)
 
 
 def _locate_config_files():
@@ -130,15 +243,80 @@ def _merge_data(src, dst):
 
 
 def _merge_defaults(config_data):
+    defaults = config_data.get("defaults", {})
+    if not defaults:
+        return
+
     for host in config_data.get("hosts", []):
-        for key, value in config_data.get("defaults", {}).items():
-            if key not in host:
-                host[key] = value
+        for key, value in defaults.items():
+            host.setdefault(key, value)
+
+
+def _aws_config_files():
+    # Profile validation depends on the AWS configuration, so the configuration
+    # cache has to be invalidated when it changes as well
+    return [
+        os.environ.get("AWS_CONFIG_FILE", os.path.expanduser("~/.aws/config")),
+        os.environ.get(
+            "AWS_SHARED_CREDENTIALS_FILE", os.path.expanduser("~/.aws/credentials")
+        ),
+    ]
+
+
+def _config_cache_key(config_files):
+    key = [__version__]
+    for path in list(config_files) + _aws_config_files():
+        try:
+            stat = os.stat(path)
+        except OSError:
+            key.append([str(path), None, None])
+            continue
+        key.append([str(path), stat.st_mtime_ns, stat.st_size])
+
+    return key
+
+
+def _load_cached_config(cache_key):
+    # Only the validated data are cached, GateConfig is rebuilt from them
+    try:
+        with open(DEFAULT_GATE_CONFIG_CACHE_PATH, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.debug("Ignoring unreadable configuration cache: %s", e)
+        return None
+
+    if not isinstance(cached, dict) or cached.get("key") != cache_key:
+        logger.debug("Configuration cache is stale")
+        return None
+
+    return GateConfig(defaults=cached["defaults"], hosts=cached["hosts"])
+
+
+def _store_cached_config(cache_key, config):
+    data = json.dumps(
+        {"key": cache_key, "defaults": config.defaults, "hosts": config.hosts}
+    )
+    try:
+        write_file_atomically(DEFAULT_GATE_CONFIG_CACHE_PATH, data.encode("utf-8"))
+    except OSError as e:
+        logger.debug("Unable to store configuration cache: %s", e)
 
 
 def load_config_from_files(config_files=None):
+    # Parsing and validating the configuration is expensive (validation needs
+    # to consult AWS configuration for every host), so configuration discovered
+    # on its own is cached, keyed on the state of every file it depends on.
+    cache_key = None
     if config_files is None:
         config_files = _locate_config_files()
+        if config_files:
+            cache_key = _config_cache_key(config_files)
+            config = _load_cached_config(cache_key)
+            if config is not None:
+                logger.debug("Using cached configuration")
+                return config
 
     config_data, data = {}, {}
     if config_files:
@@ -155,4 +333,17 @@ def load_config_from_files(config_files=None):
 
     _merge_defaults(config_data)
     config = GateConfigSchema().load(config_data)
+
+    if cache_key is not None:
+        _store_cached_config(cache_key, config)
+        # Shell completion cannot afford parsing the configuration itself
+        store_names(
+            "aliases",
+            [
+                host["alias"]
+                for host in config.hosts
+                if not _is_alias_pattern(host["alias"])
+            ],
+        )
+
     return config
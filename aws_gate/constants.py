@@ -13,17 +13,26 @@ SUPPORTED_KEY_TYPES = ["rsa", "ed25519"]
 KEY_MIN_SIZE = DEFAULT_KEY_SIZE
 
 DEFAULT_LIST_OUTPUT = "human"
-DEFAULT_LIST_OUTPUT_FORMATS = ["json", "human", "tsv", "csv"]
-DEFAULT_LIST_OUTPUT_FIELDS = (
-    "instance_id",
-    "instance_name",
-    "availability_zone",
-    "vpc_id",
-    "private_ip_address",
-    "public_ip_address",
-    "private_dns_name",
-    "public_dns_name",
-)
+DEFAULT_LIST_OUTPUT_FORMATS = ["json", "ndjson", "human", "tsv", "csv"]
+# API every list output field comes from, so that only APIs needed for the
+# requested fields are called. Fields without API describe the listed target.
+LIST_FIELD_SOURCES = {
+    "instance_id": "ssm",
+    "instance_name": "ec2",
+    "availability_zone": "ec2",
+    "vpc_id": "ec2",
+    "private_ip_address": "ec2",
+    "public_ip_address": "ec2",
+    "private_dns_name": "ec2",
+    "public_dns_name": "ec2",
+    "profile": None,
+    "region": None,
+    "ping_status": "ssm",
+    "agent_version": "ssm",
+    "platform": "ssm",
+    "asg_name": "ec2",
+}
+DEFAULT_LIST_OUTPUT_FIELDS = tuple(LIST_FIELD_SOURCES)
 DEFAULT_LIST_HUMAN_FIELDS = (
     "instance_id",
     "instance_name",
@@ -31,16 +40,121 @@ DEFAULT_LIST_HUMAN_FIELDS = (
     "vpc_id",
     "private_ip_address",
 )
+# Instance details of managed instances are fetched in batches of at most
+# LIST_BATCH_SIZE instances, LIST_MAX_WORKERS batches at once
+LIST_BATCH_SIZE = int(os.environ.get("GATE_LIST_BATCH_SIZE", "100"))
+LIST_MAX_WORKERS = int(os.environ.get("GATE_LIST_WORKERS", "8"))
+# Maximum number of (profile, region) pairs listed at once
+LIST_TARGET_MAX_WORKERS = int(os.environ.get("GATE_LIST_TARGET_WORKERS", "8"))
 
 DEFAULT_GATE_DIR = os.path.expanduser("~/.aws-gate")
 DEFAULT_GATE_CONFIG_PATH = os.path.join(DEFAULT_GATE_DIR, "config")
 DEFAULT_GATE_CONFIGD_PATH = os.path.join(DEFAULT_GATE_DIR, "config.d")
 
+DEFAULT_GATE_CACHE_DIR = os.path.join(DEFAULT_GATE_DIR, "cache")
+DEFAULT_GATE_CONFIG_CACHE_PATH = os.path.join(DEFAULT_GATE_CACHE_DIR, "config.json")
+DEFAULT_GATE_PLUGIN_VERSION_CACHE_PATH = os.path.join(
+    DEFAULT_GATE_CACHE_DIR, "plugin-version.json"
+)
+DEFAULT_GATE_INSTANCE_CACHE_PATH = os.path.join(
+    DEFAULT_GATE_CACHE_DIR, "instances.json"
+)
+# Lifetime (in seconds) of resolved instance identifiers and of identifiers
+# which could not be resolved. Setting them to 0 disables caching.
+INSTANCE_CACHE_TTL = int(os.environ.get("GATE_INSTANCE_CACHE_TTL", "300"))
+INSTANCE_CACHE_NEGATIVE_TTL = int(
+    os.environ.get("GATE_INSTANCE_CACHE_NEGATIVE_TTL", "30")
+)
+
+# This list is maintained by hand as new regions are not added that often. This should be
+# removed once, we find a better way how to obtain region list without the need to
+# contact AWS EC2 API
+AWS_REGIONS = [
+    "af-south-1",
+    "ap-east-1",
+    "ap-northeast-1",
+    "ap-northeast-2",
+    "ap-south-1",
+    "ap-southeast-1",
+    "ap-southeast-2",
+    "ca-central-1",
+    "cn-north-1",
+    "cn-northwest-1",
+    "eu-central-1",
+    "eu-north-1",
+    "eu-south-1",
+    "eu-west-1",
+    "eu-west-2",
+    "eu-west-3",
+    "me-south-1",
+    "sa-east-1",
+    "us-east-1",
+    "us-east-2",
+    "us-gov-east-1",
+    "us-gov-west-1",
+    "us-west-1",
+    "us-west-2",
+]
+
+# Lists of names offered by shell completion, refreshed whenever the
+# configuration or the inventory changes
+DEFAULT_GATE_COMPLETION_DIR = os.path.join(DEFAULT_GATE_DIR, "completion")
+
+# Host aliases containing any of these characters are shell-style patterns
+ALIAS_PATTERN_CHARS = frozenset("*?[")
+
+DEFAULT_GATE_INVENTORY_PATH = os.path.join(DEFAULT_GATE_DIR, "inventory.db")
+# Inventory of a profile and region synchronized longer ago (in seconds) is not
+# used to answer instance queries. Setting it to 0 disables the inventory.
+INVENTORY_MAX_AGE = int(os.environ.get("GATE_INVENTORY_MAX_AGE", "900"))
+# Inventory synchronization only fetches EC2 details of instances whose SSM
+# registration changed, all of them are fetched once in this many seconds
+INVENTORY_FULL_SYNC_AGE = int(os.environ.get("GATE_INVENTORY_FULL_SYNC_AGE", "86400"))
+
+# Policies choosing an instance when an identifier (e.g. a tag) matches several
+INSTANCE_SELECTION_POLICIES = ["first", "newest", "random", "same-az"]
+DEFAULT_INSTANCE_SELECTION = "first"
+# Maximum number of regions queried at once when an instance is looked up in
+# other regions
+REGION_FALLBACK_MAX_WORKERS = int(os.environ.get("GATE_REGION_FALLBACK_WORKERS", "8"))
+# How an instance is chosen when it is looked up in several profiles at once:
+# from the profile listed first, or from the profile which answered first
+PROFILE_PREFERENCES = ["order", "fastest"]
+DEFAULT_PROFILE_PREFERENCE = "order"
+PROFILE_FANOUT_MAX_WORKERS = int(os.environ.get("GATE_PROFILE_FANOUT_WORKERS", "8"))
+
 PLUGIN_NAME = "session-manager-plugin"
 DEFAULT_GATE_BIN_PATH = os.path.join(DEFAULT_GATE_DIR, "bin")
 PLUGIN_INSTALL_PATH = os.path.join(DEFAULT_GATE_BIN_PATH, PLUGIN_NAME)
 
+DEFAULT_GATE_KEY_DIR = os.path.join(DEFAULT_GATE_DIR, "keys")
+# Every ssh session writes its key to a file of its own, so that concurrent
+# sessions never overwrite or remove keys of each other
+DEFAULT_GATE_SESSION_KEY_DIR = os.path.join(DEFAULT_GATE_KEY_DIR, "sessions")
+# Key file of ssh-proxy sessions opened without --key-path, which is what
+# ssh configuration generated by earlier versions of ssh-config points to
 DEFAULT_GATE_KEY_PATH = os.path.join(DEFAULT_GATE_DIR, "key")
+# Keys generated ahead of time, so that connections do not wait for the key
+# generation. Every key is used for a single connection only. Setting the pool
+# size to 0 disables the pool.
+DEFAULT_GATE_KEY_POOL_DIR = os.path.join(DEFAULT_GATE_KEY_DIR, "pool")
+KEY_POOL_SIZE = int(os.environ.get("GATE_KEY_POOL_SIZE", "2"))
+# Generating ed25519 keys is cheaper than reading them from the pool
+KEY_POOL_TYPES = ["rsa"]
+# EC2 Instance Connect keeps pushed keys for 60 seconds. Connections to the same
+# instance and user reuse the pushed key for this many seconds after the push,
+# leaving ssh the rest of the validity to authenticate. Setting it to 0
+# disables the reuse.
+EC2_IC_KEY_VALIDITY = 60
+SSH_KEY_REUSE_TTL = min(
+    int(os.environ.get("GATE_SSH_KEY_REUSE_TTL", "40")), EC2_IC_KEY_VALIDITY
+)
+DEFAULT_GATE_SSH_KEY_CACHE_DIR = os.path.join(DEFAULT_GATE_CACHE_DIR, "ssh-keys")
+
+DEFAULT_GATE_AGENT_SOCKET_PATH = os.environ.get(
+    "GATE_AGENT_SOCKET", os.path.join(DEFAULT_GATE_DIR, "agent.sock")
+)
+AGENT_SUBCOMMANDS = ["exec", "list", "ls", "session", "ssh", "ssh-proxy"]
 
 SSM_PLUGIN_BASE_URL = "https://s3.amazonaws.com/session-manager-downloads/plugin/latest"
 SSM_PLUGIN_PATH = {
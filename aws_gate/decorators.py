@@ -1,3 +1,4 @@
+import json
 import platform
 import logging
 import os
@@ -6,32 +7,116 @@ from subprocess import PIPE
 from packaging.version import parse as parse_version
 from wrapt import decorator
 
-from aws_gate.constants import PLUGIN_INSTALL_PATH, PLUGIN_NAME
-from aws_gate.utils import execute_plugin, is_existing_profile, is_existing_region
+from aws_gate.constants import (
+    DEFAULT_GATE_BIN_PATH,
+    DEFAULT_GATE_PLUGIN_VERSION_CACHE_PATH,
+    PLUGIN_NAME,
+)
+from aws_gate.utils import (
+    execute_plugin,
+    is_existing_profile,
+    is_existing_region,
+    write_file_atomically,
+)
 
 logger = logging.getLogger(__name__)
 
+# Resolved plugin locations keyed by the search path they were resolved from
+_PLUGIN_PATH_CACHE = {}
+
 
 def _plugin_exists(plugin_path):
     return os.path.exists(plugin_path)
 
 
+def _resolve_plugin_path():
+    # We search the same locations as execute() does, our own bin directory first
+    search_path = DEFAULT_GATE_BIN_PATH + os.pathsep + os.environ["PATH"]
+
+    plugin_path = _PLUGIN_PATH_CACHE.get(search_path)
+    if plugin_path is None or not _plugin_exists(plugin_path):
+        plugin_path = next(
+            (
+                path
+                for path in (
+                    os.path.join(directory, PLUGIN_NAME)
+                    for directory in search_path.split(os.pathsep)
+                )
+                if _plugin_exists(path)
+            ),
+            None,
+        )
+        _PLUGIN_PATH_CACHE[search_path] = plugin_path
+
+    return plugin_path
+
+
 def _plugin_exists_in_path():
-    return any(
-        _plugin_exists(os.path.join(path, PLUGIN_NAME))
-        for path in os.environ["PATH"].split(os.path.pathsep)
-    )
+    return _resolve_plugin_path() is not None
+
+
+def _plugin_version_cache_key(plugin_path):
+    plugin_path = os.path.realpath(plugin_path)
+    stat = os.stat(plugin_path)
+    return {
+        "path": plugin_path,
+        "inode": stat.st_ino,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+    }
+
+
+def _get_cached_plugin_version(cache_key):
+    try:
+        with open(DEFAULT_GATE_PLUGIN_VERSION_CACHE_PATH, "r") as f:
+            cached = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.debug("Unable to read plugin version cache: %s", e)
+        return None
+
+    if not isinstance(cached, dict) or cached.get("key") != cache_key:
+        return None
+
+    return cached.get("version")
+
+
+def _store_cached_plugin_version(cache_key, version):
+    data = json.dumps({"key": cache_key, "version": version})
+    try:
+        write_file_atomically(DEFAULT_GATE_PLUGIN_VERSION_CACHE_PATH, data.encode())
+    except OSError as e:
+        logger.debug("Unable to store plugin version cache: %s", e)
+
+
+def _get_plugin_version():
+    # Spawning the plugin only to learn its version is expensive, so we cache
+    # the version until the binary itself changes.
+    cache_key = None
+    plugin_path = _resolve_plugin_path()
+    if plugin_path is not None:
+        try:
+            cache_key = _plugin_version_cache_key(plugin_path)
+        except OSError as e:
+            logger.debug("Unable to stat %s: %s", plugin_path, e)
+
+    if cache_key is not None:
+        version = _get_cached_plugin_version(cache_key)
+        if version:
+            logger.debug("Using cached session-manager-plugin version")
+            return version
+
+    version = execute_plugin(["--version"], stdout=PIPE, stderr=PIPE)
+    if version and cache_key is not None:
+        _store_cached_plugin_version(cache_key, version)
+
+    return version
 
 
 @decorator
 def plugin_required(
     wrapped_function, instance, args, kwargs
 ):  # pylint: disable=unused-argument
-    if (
-        not _plugin_exists(PLUGIN_INSTALL_PATH)
-        and not _plugin_exists_in_path()
-        and not platform.system() == "Windows"
-    ):
+    if not _plugin_exists_in_path() and not platform.system() == "Windows":
         raise OSError(f"{PLUGIN_NAME} not found")
 
     return wrapped_function(*args, **kwargs)
@@ -42,7 +127,7 @@ def plugin_version(required_version):
     def wrapper(
         wrapped_function, instance, args, kwargs
     ):  # pylint: disable=unused-argument
-        version = execute_plugin(["--version"], stdout=PIPE, stderr=PIPE)
+        version = _get_plugin_version()
         logger.debug(
             "session-manager-plugin version: %s (required version: %s)",
             version,
@@ -61,8 +146,11 @@ def plugin_version(required_version):
 def valid_aws_profile(
     wrapped_function, instance, args, kwargs
 ):  # pylint: disable=unused-argument
-    if not is_existing_profile(kwargs["profile_name"]):
-        raise ValueError(f"Invalid profile provided: {kwargs['profile_name']}")
+    # With several profiles given, instances are looked up or listed in those,
+    # the single one is never used then
+    for profile_name in kwargs.get("profile_names") or [kwargs["profile_name"]]:
+        if not is_existing_profile(profile_name):
+            raise ValueError(f"Invalid profile provided: {profile_name}")
 
     return wrapped_function(*args, **kwargs)
 
@@ -71,7 +159,8 @@ def valid_aws_profile(
 def valid_aws_region(
     wrapped_function, instance, args, kwargs
 ):  # pylint: disable=unused-argument
-    if not is_existing_region(kwargs["region_name"]):
-        raise ValueError(f"Invalid region provided: {kwargs['region_name']}")
+    for region_name in kwargs.get("region_names") or [kwargs["region_name"]]:
+        if not is_existing_region(region_name):
+            raise ValueError(f"Invalid region provided: {region_name}")
 
     return wrapped_function(*args, **kwargs)
@@ -12,3 +12,7 @@ class AWSConnectionError(Error):
 
 class UnsupportedPlatormError(Error):
     pass
+
+
+class AgentError(Error):
+    pass
@@ -1,13 +1,19 @@
 import logging
 
-from aws_gate.constants import AWS_DEFAULT_PROFILE, AWS_DEFAULT_REGION
+from aws_gate.constants import (
+    AWS_DEFAULT_PROFILE,
+    AWS_DEFAULT_REGION,
+    DEFAULT_INSTANCE_SELECTION,
+    DEFAULT_PROFILE_PREFERENCE,
+)
 from aws_gate.decorators import (
     plugin_required,
     plugin_version,
     valid_aws_profile,
     valid_aws_region,
 )
-from aws_gate.query import query_instance
+from aws_gate.names import instance_not_found
+from aws_gate.query import query_instances, resolve_instance
 from aws_gate.session_common import BaseSession
 from aws_gate.utils import (
     get_aws_client,
@@ -46,30 +52,68 @@ class ExecSession(BaseSession):
 @plugin_version("1.1.23.0")
 @valid_aws_profile
 @valid_aws_region
-def exec(
+def exec(  # pylint: disable=too-many-arguments
     config,
     instance_name,
     command,
     profile_name=AWS_DEFAULT_PROFILE,
     region_name=AWS_DEFAULT_REGION,
+    selection=DEFAULT_INSTANCE_SELECTION,
+    availability_zone=None,
+    fallback_regions=None,
+    all_instances=False,
+    profile_names=None,
+    profile_preference=DEFAULT_PROFILE_PREFERENCE,
 ):
     instance, profile, region = fetch_instance_details_from_config(
         config, instance_name, profile_name, region_name
     )
 
-    ssm = get_aws_client("ssm", region_name=region, profile_name=profile)
-    ec2 = get_aws_resource("ec2", region_name=region, profile_name=profile)
+    if all_instances:
+        # Commands are run on instances as DescribeInstances pages arrive, we
+        # do not wait for the whole fleet to be listed
+        ec2 = get_aws_resource("ec2", region_name=region, profile_name=profile)
+        instances = query_instances(name=instance, ec2=ec2)
+    else:
+        # Commands are run by the instance ID alone
+        instance_details = resolve_instance(
+            instance,
+            profile,
+            region,
+            selection=selection,
+            availability_zone=availability_zone,
+            fallback_regions=fallback_regions,
+            profile_names=profile_names,
+            profile_preference=profile_preference,
+            instance_id_only=True,
+        )
+        instances = [instance_details] if instance_details is not None else []
 
-    instance_id = query_instance(name=instance, ec2=ec2)
-    if instance_id is None:
-        raise ValueError(f"No instance could be found for name: {instance}")
+    found = False
+    for instance_details in instances:
+        found = True
+        instance_id = instance_details["instance_id"]
+        instance_profile = instance_details.get("profile_name", profile)
+        instance_region = instance_details.get("region_name", region)
+        ssm = get_aws_client(
+            "ssm", region_name=instance_region, profile_name=instance_profile
+        )
 
-    logger.info(
-        'Executing command "%s"  on instance %s (%s) via profile %s',
-        " ".join(command),
-        instance_id,
-        region,
-        profile,
-    )
-    with ExecSession(instance_id, command, region_name=region, ssm=ssm) as sess:
-        sess.open()
+        logger.info(
+            'Executing command "%s"  on instance %s (%s) via profile %s',
+            " ".join(command),
+            instance_id,
+            instance_region,
+            instance_profile,
+        )
+        with ExecSession(
+            instance_id,
+            command,
+            region_name=instance_region,
+            profile_name=instance_profile,
+            ssm=ssm,
+        ) as sess:
+            sess.open()
+
+    if not found:
+        raise instance_not_found(instance, config)
@@ -0,0 +1,306 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+from aws_gate.constants import (
+    DEFAULT_GATE_INVENTORY_PATH,
+    DEFAULT_LIST_OUTPUT_FIELDS,
+    INVENTORY_MAX_AGE,
+)
+
+logger = logging.getLogger(__name__)
+
+INVENTORY_FORMAT = 3
+
+# Every instance is stored under the profile and region it was listed from
+INSTANCE_FIELDS = tuple(
+    field for field in DEFAULT_LIST_OUTPUT_FIELDS if field not in ["profile", "region"]
+)
+# Fields returned for instance queries, the same ones EC2 API queries return
+INSTANCE_DETAILS_FIELDS = (
+    "instance_id",
+    "instance_name",
+    "availability_zone",
+    "vpc_id",
+    "private_ip_address",
+    "public_ip_address",
+    "private_dns_name",
+    "public_dns_name",
+)
+INDEXED_FIELDS = (
+    "instance_id",
+    "instance_name",
+    "private_ip_address",
+    "public_ip_address",
+    "private_dns_name",
+    "public_dns_name",
+    "asg_name",
+)
+
+# EC2 and SSM API filters which can be answered from the inventory columns,
+# tag filters are answered from the tags table
+FILTER_FIELDS = {
+    "instance-id": "instance_id",
+    "dns-name": "public_dns_name",
+    "private-dns-name": "private_dns_name",
+    "ip-address": "public_ip_address",
+    "private-ip-address": "private_ip_address",
+    "vpc-id": "vpc_id",
+    "availability-zone": "availability_zone",
+    "tag:Name": "instance_name",
+    "tag:aws:autoscaling:groupName": "asg_name",
+    "PlatformTypes": "platform",
+}
+# EC2 details of instances unchanged in SSM are kept from the synchronization
+# which fetched them. Filters on fields which never change during the life of
+# an instance are answered from them however old they are, the rest only from
+# details fetched within the staleness bound.
+STABLE_FILTERS = (
+    "instance-id",
+    "private-dns-name",
+    "private-ip-address",
+    "vpc-id",
+    "availability-zone",
+    "PlatformTypes",
+)
+
+
+def _create_schema(conn):
+    columns = ", ".join(f"{field} TEXT" for field in INSTANCE_FIELDS)
+    statements = [
+        "DROP TABLE IF EXISTS targets",
+        "DROP TABLE IF EXISTS instances",
+        "DROP TABLE IF EXISTS tags",
+        "CREATE TABLE targets (profile TEXT NOT NULL, region TEXT NOT NULL, "
+        "synced REAL NOT NULL, full_synced REAL, PRIMARY KEY (profile, region))",
+        f"CREATE TABLE instances (profile TEXT NOT NULL, region TEXT NOT NULL, "
+        f"{columns}, tags TEXT, fingerprint TEXT, synced REAL NOT NULL, "
+        f"details_synced REAL NOT NULL, "
+        f"PRIMARY KEY (profile, region, instance_id))",
+        "CREATE TABLE tags (profile TEXT NOT NULL, region TEXT NOT NULL, "
+        "instance_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT, "
+        "PRIMARY KEY (profile, region, instance_id, key))",
+        "CREATE INDEX tags_key_value ON tags (key, value)",
+    ]
+    statements.extend(
+        f"CREATE INDEX instances_{field} ON instances ({field})"
+        for field in INDEXED_FIELDS
+    )
+
+    with conn:
+        for statement in statements:
+            conn.execute(statement)
+        conn.execute(f"PRAGMA user_version = {INVENTORY_FORMAT}")
+
+
+def open_inventory(path=None, create=False):
+    path = path or DEFAULT_GATE_INVENTORY_PATH
+    if not create and not os.path.exists(path):
+        return None
+
+    if create:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        # The inventory describes the user's whole estate, nobody else should
+        # be able to read it
+        os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+
+    conn = sqlite3.connect(path, timeout=5)
+    conn.row_factory = sqlite3.Row
+
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version != INVENTORY_FORMAT:
+        if not create:
+            logger.debug("Ignoring inventory in format %s", version)
+            conn.close()
+            return None
+
+        logger.debug("Creating inventory in %s", path)
+        _create_schema(conn)
+
+    # Readers keep using the last synchronized inventory while it is replaced
+    conn.execute("PRAGMA journal_mode = WAL")
+    return conn
+
+
+def _is_fresh(conn, profile_name, region_name, max_age):
+    row = conn.execute(
+        "SELECT synced FROM targets WHERE profile = ? AND region = ?",
+        (profile_name, region_name),
+    ).fetchone()
+    if row is None or row["synced"] < time.time() - max_age:
+        logger.debug(
+            "Inventory of %s/%s is missing or stale", profile_name, region_name
+        )
+        return False
+    return True
+
+
+def _glob_escape(value):
+    # Values are matched with GLOB, so EC2 API wildcards (* and ?) keep working,
+    # character classes are not supported by EC2 API
+    return value.replace("[", "[[]")
+
+
+def _get_filter_name(api_filter):
+    return api_filter.get("Name", api_filter.get("Key"))
+
+
+def _build_conditions(filters):
+    conditions, params = [], []
+    for api_filter in filters:
+        name = _get_filter_name(api_filter)
+        values = [_glob_escape(value) for value in api_filter["Values"]]
+
+        if name in FILTER_FIELDS:
+            field = FILTER_FIELDS[name]
+            matches = " OR ".join(f"{field} GLOB ?" for _ in values)
+            params.extend(values)
+        elif name.startswith("tag:"):
+            matches = (
+                "EXISTS (SELECT 1 FROM tags WHERE tags.profile = instances.profile "
+                "AND tags.region = instances.region "
+                "AND tags.instance_id = instances.instance_id AND tags.key = ? AND ("
+                + " OR ".join("tags.value GLOB ?" for _ in values)
+                + "))"
+            )
+            params.extend([name[len("tag:") :]] + values)
+        else:
+            raise ValueError(f"Filter cannot be answered from inventory: {name}")
+
+        conditions.append(f"({matches})")
+
+    return conditions, params
+
+
+def lookup_instance(
+    filters,
+    profile_name,
+    region_name,
+    availability_zone=None,
+    max_age=INVENTORY_MAX_AGE,
+    path=None,
+):
+    if max_age <= 0:
+        return None
+
+    try:
+        conn = open_inventory(path)
+        if conn is None:
+            return None
+
+        with closing(conn):
+            if not _is_fresh(conn, profile_name, region_name, max_age):
+                return None
+
+            conditions, params = _build_conditions(filters)
+            if any(_get_filter_name(f) not in STABLE_FILTERS for f in filters):
+                conditions.append("details_synced >= ?")
+                params.append(time.time() - max_age)
+            # Instances are stored in the order they were listed, i.e. the
+            # order EC2 API returns them in
+            order = "rowid"
+            if availability_zone is not None:
+                order = "availability_zone = ? DESC, rowid"
+                params.append(availability_zone)
+
+            row = conn.execute(
+                "SELECT * FROM instances WHERE profile = ? AND region = ? AND "
+                + " AND ".join(conditions + ["1"])
+                + f" ORDER BY {order} LIMIT 1",
+                [profile_name, region_name] + params,
+            ).fetchone()
+    except (sqlite3.Error, ValueError) as e:
+        logger.debug("Unable to look instance up in inventory: %s", e)
+        return None
+
+    if row is None:
+        return None
+
+    return {field: row[field] for field in INSTANCE_DETAILS_FIELDS}
+
+
+def build_instance(row):
+    instance = {field: row[field] for field in INSTANCE_FIELDS}
+    instance["tags"] = json.loads(row["tags"] or "{}")
+    return instance
+
+
+def _iter_rows(conn, query, params):
+    with closing(conn):
+        for row in conn.execute(query, params):
+            yield build_instance(row)
+
+
+def iter_inventory_instances(
+    profile_name, region_name, filters, max_age=INVENTORY_MAX_AGE, path=None
+):
+    # None means that the inventory cannot answer and APIs have to be asked
+    if max_age <= 0:
+        return None
+
+    try:
+        conn = open_inventory(path)
+        if conn is None:
+            return None
+
+        if not _is_fresh(conn, profile_name, region_name, max_age):
+            conn.close()
+            return None
+
+        conditions, params = _build_conditions(filters["ssm"] + filters["ec2"])
+    except (sqlite3.Error, ValueError) as e:
+        logger.debug("Unable to list instances from inventory: %s", e)
+        return None
+
+    logger.debug("Listing %s/%s from inventory", profile_name, region_name)
+    return _iter_rows(
+        conn,
+        "SELECT * FROM instances WHERE profile = ? AND region = ? AND "
+        + " AND ".join(conditions + ["1"])
+        + " ORDER BY rowid",
+        [profile_name, region_name] + params,
+    )
+
+
+def get_instance_names(path=None):
+    # Names are only used for suggestions, so stale inventory is good enough
+    try:
+        conn = open_inventory(path)
+        if conn is None:
+            return []
+
+        with closing(conn):
+            return [
+                row["instance_name"]
+                for row in conn.execute(
+                    "SELECT DISTINCT instance_name FROM instances "
+                    "WHERE instance_name IS NOT NULL ORDER BY instance_name"
+                )
+            ]
+    except sqlite3.Error as e:
+        logger.debug("Unable to read instance names from inventory: %s", e)
+        return []
+
+
+def remove_instance(instance_id, path=None):
+    # Instances AWS tells us are gone must not be found in the inventory until
+    # the next synchronization
+    try:
+        conn = open_inventory(path)
+        if conn is None:
+            return
+
+        with closing(conn), conn:
+            removed = conn.execute(
+                "DELETE FROM instances WHERE instance_id = ?", (instance_id,)
+            ).rowcount
+            conn.execute("DELETE FROM tags WHERE instance_id = ?", (instance_id,))
+    except sqlite3.Error as e:
+        logger.debug("Unable to remove instance from inventory: %s", e)
+        return
+
+    if removed:
+        logger.debug("Removed instance from inventory: %s", instance_id)
@@ -0,0 +1,173 @@
+import collections
+import json
+import logging
+import math
+import time
+from contextlib import closing
+
+from aws_gate.completion import store_names
+from aws_gate.constants import (
+    AWS_DEFAULT_PROFILE,
+    AWS_DEFAULT_REGION,
+    INVENTORY_FULL_SYNC_AGE,
+    LIST_BATCH_SIZE,
+)
+from aws_gate.decorators import valid_aws_profile, valid_aws_region
+from aws_gate.exceptions import AWSConnectionError
+from aws_gate.inventory import (
+    INSTANCE_FIELDS,
+    build_instance,
+    get_instance_names,
+    open_inventory,
+)
+from aws_gate.list import get_targets, iter_instances
+
+logger = logging.getLogger(__name__)
+
+# Synchronization of the inventory lives apart from the inventory itself, as
+# it lists instances the way "aws-gate list" does, while "aws-gate list" reads
+# the inventory
+
+
+def _store_instance(conn, instance, synced, details_synced):
+    fields = ("profile", "region") + INSTANCE_FIELDS
+    fields += ("tags", "fingerprint", "synced", "details_synced")
+    tags = instance.get("tags") or {}
+    values = dict(
+        instance,
+        tags=json.dumps(tags, sort_keys=True),
+        synced=synced,
+        details_synced=details_synced,
+    )
+
+    conn.execute(
+        f"INSERT OR REPLACE INTO instances ({', '.join(fields)}) "
+        f"VALUES ({', '.join('?' for _ in fields)})",
+        [values.get(field) for field in fields],
+    )
+    key = (instance["profile"], instance["region"], instance["instance_id"])
+    conn.execute(
+        "DELETE FROM tags WHERE profile = ? AND region = ? AND instance_id = ?", key
+    )
+    conn.executemany(
+        "INSERT INTO tags (profile, region, instance_id, key, value) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [key + tag for tag in tags.items()],
+    )
+
+
+def _load_known(conn, targets, synced):
+    # Targets are synchronized incrementally until their last full
+    # synchronization gets too old
+    known = {}
+    for profile_name, region_name in targets:
+        row = conn.execute(
+            "SELECT full_synced FROM targets WHERE profile = ? AND region = ?",
+            (profile_name, region_name),
+        ).fetchone()
+        if row is None or (row["full_synced"] or 0) < synced - INVENTORY_FULL_SYNC_AGE:
+            continue
+
+        known[(profile_name, region_name)] = {
+            row["instance_id"]: dict(
+                build_instance(row),
+                fingerprint=row["fingerprint"],
+                details_synced=row["details_synced"],
+            )
+            for row in conn.execute(
+                "SELECT * FROM instances WHERE profile = ? AND region = ?",
+                (profile_name, region_name),
+            )
+        }
+
+    return known
+
+
+def _expire_target(conn, profile_name, region_name, synced, full):
+    # Instances which were not listed by this synchronization are gone
+    removed = conn.execute(
+        "DELETE FROM instances WHERE profile = ? AND region = ? AND synced < ?",
+        (profile_name, region_name, synced),
+    ).rowcount
+    conn.execute(
+        "DELETE FROM tags WHERE profile = ? AND region = ? AND NOT EXISTS ("
+        "SELECT 1 FROM instances WHERE instances.profile = tags.profile "
+        "AND instances.region = tags.region "
+        "AND instances.instance_id = tags.instance_id)",
+        (profile_name, region_name),
+    )
+    conn.execute(
+        "INSERT INTO targets (profile, region, synced, full_synced) "
+        "VALUES (?, ?, ?, ?) ON CONFLICT (profile, region) DO UPDATE SET "
+        "synced = excluded.synced, "
+        "full_synced = COALESCE(excluded.full_synced, targets.full_synced)",
+        (profile_name, region_name, synced, synced if full else None),
+    )
+    return removed
+
+
+def _count_saved_calls(fetched, reused):
+    # DescribeInstances calls a full synchronization would have made on top of
+    # the ones made for instances which changed
+    return sum(
+        math.ceil((fetched[target] + reused[target]) / LIST_BATCH_SIZE)
+        - math.ceil(fetched[target] / LIST_BATCH_SIZE)
+        for target in reused
+    )
+
+
+@valid_aws_profile
+@valid_aws_region
+def sync(  # pylint: disable=too-many-locals
+    profile_name=AWS_DEFAULT_PROFILE,
+    region_name=AWS_DEFAULT_REGION,
+    profile_names=None,
+    region_names=None,
+    full=False,
+    path=None,
+):
+    targets = get_targets(profile_name, region_name, profile_names, region_names)
+    failures = []
+    synced = time.time()
+    fetched, reused = collections.Counter(), collections.Counter()
+    removed = 0
+
+    conn = open_inventory(path, create=True)
+    # The whole synchronization is a single transaction, readers see either
+    # the previous inventory or the new one
+    with closing(conn), conn:
+        known = {} if full else _load_known(conn, targets, synced)
+
+        for instance in iter_instances(targets, failures=failures, known=known):
+            target = (instance["profile"], instance["region"])
+            stored = known.get(target, {}).get(instance["instance_id"])
+            # EC2 details of unchanged instances are as old as the
+            # synchronization which fetched them
+            details_synced = synced
+            if stored is not None and stored["fingerprint"] == instance["fingerprint"]:
+                reused[target] += 1
+                details_synced = stored["details_synced"]
+            else:
+                fetched[target] += 1
+            _store_instance(conn, instance, synced, details_synced)
+
+        failed = {(f.profile_name, f.region_name) for f in failures}
+        for target in targets:
+            if target not in failed:
+                removed += _expire_target(
+                    conn, *target, synced, full=target not in known
+                )
+
+    store_names("instances", get_instance_names(path))
+
+    count = sum(fetched.values()) + sum(reused.values())
+    print(
+        f"Synchronized {count} instances from {len(targets) - len(failed)} targets: "
+        f"{sum(fetched.values())} changed, {removed} removed, "
+        f"{_count_saved_calls(fetched, reused)} EC2 API calls saved"
+    )
+
+    if failures:
+        raise AWSConnectionError(
+            f"Synchronization failed in {len(failures)} of {len(targets)} targets"
+        )
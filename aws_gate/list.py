@@ -1,7 +1,16 @@
+import collections
 import csv
+import fnmatch
 import io
+import itertools
 import json
 import logging
+import queue
+import sys
+import textwrap
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from aws_gate.constants import (
     AWS_DEFAULT_PROFILE,
@@ -9,28 +18,49 @@ from aws_gate.constants import (
     DEFAULT_LIST_OUTPUT_FIELDS,
     DEFAULT_LIST_HUMAN_FIELDS,
     DEFAULT_LIST_OUTPUT,
+    LIST_BATCH_SIZE,
+    LIST_FIELD_SOURCES,
+    LIST_MAX_WORKERS,
+    LIST_TARGET_MAX_WORKERS,
 )
 from aws_gate.decorators import valid_aws_region, valid_aws_profile
+from aws_gate.exceptions import AWSConnectionError
+from aws_gate.inventory import iter_inventory_instances
 from aws_gate.utils import (
+    build_instance_details,
     get_aws_client,
     get_aws_resource,
-    get_multiple_instance_details,
 )
 
 logger = logging.getLogger(__name__)
 
 
+# Serializers are generators producing the output piece by piece, so instances
+# can be printed as soon as their details are fetched
 # pylint: disable=unused-argument
 def _serialize_json(data, fields=None):
-    return json.dumps(data, indent=4, sort_keys=True)
+    separator = "[\n"
+    for item in data:
+        item_json = json.dumps(item, indent=4, sort_keys=True)
+        yield separator + textwrap.indent(item_json, " " * 4)
+        separator = ",\n"
+
+    yield "[]" if separator == "[\n" else "\n]"
+
+
+def _serialize_ndjson(data, fields=None):
+    for item in data:
+        yield json.dumps(item, sort_keys=True) + "\n"
 
 
 def _serialize_csv(data, delimiter=",", fields=DEFAULT_LIST_OUTPUT_FIELDS):
     output = io.StringIO()
     writer = csv.DictWriter(output, delimiter=delimiter, fieldnames=fields)
-    writer.writerows(data)
-
-    return output.getvalue()
+    for item in data:
+        writer.writerow(item)
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
 
 
 def _serialize_tsv(data, fields=DEFAULT_LIST_OUTPUT_FIELDS):
@@ -41,7 +71,7 @@ def _serialize_human(data, fields=DEFAULT_LIST_HUMAN_FIELDS):
     return _serialize_csv(data, delimiter=" ", fields=fields)
 
 
-def serialize(
+def serialize_stream(
     data, output_format=DEFAULT_LIST_OUTPUT, fields=DEFAULT_LIST_OUTPUT_FIELDS
 ):
     format_dispatcher = {
@@ -49,19 +79,411 @@ def serialize(
         "tsv": _serialize_tsv,
         "human": _serialize_human,
         "json": _serialize_json,
+        "ndjson": _serialize_ndjson,
     }
 
-    filtered_data = []
-    for item in data:
-        filtered_data_item = {}
-        for field in fields:
-            if field in item.keys():
-                filtered_data_item[field] = item[field]
-        filtered_data.append(filtered_data_item)
+    filtered_data = (
+        {field: item[field] for field in fields if field in item.keys()}
+        for item in data
+    )
 
     return format_dispatcher[output_format](filtered_data, fields=fields)
 
 
+def serialize(
+    data, output_format=DEFAULT_LIST_OUTPUT, fields=DEFAULT_LIST_OUTPUT_FIELDS
+):
+    return "".join(serialize_stream(data, output_format=output_format, fields=fields))
+
+
+def _print_stream(chunks, stream=None):
+    stream = stream if stream is not None else sys.stdout
+
+    # Trailing line break of the output is replaced by a plain newline, like
+    # print(serialize(...).rstrip()) would do, without waiting for the next chunk
+    line_break = ""
+    for chunk in chunks:
+        content = chunk.rstrip("\r\n")
+        stream.write(line_break + content)
+        stream.flush()
+        line_break = chunk[len(content) :]
+    stream.write("\n")
+
+
+# Filters are sent to SSM or EC2 API whenever the API can evaluate them, the
+# rest (list output fields) are matched locally. Values are comma separated
+# alternatives, the local ones might contain shell-style wildcards.
+def _ssm_filter_by_platform(values):
+    return {"Key": "PlatformTypes", "Values": values}
+
+
+def _ec2_filter_by_tag(key, values):
+    return {"Name": key, "Values": values}
+
+
+def _ec2_filter_by_vpc(values):
+    return {"Name": "vpc-id", "Values": values}
+
+
+def _ec2_filter_by_availability_zone(values):
+    return {"Name": "availability-zone", "Values": values}
+
+
+def _ec2_filter_by_name_prefix(values):
+    return {"Name": "tag:Name", "Values": [f"{value}*" for value in values]}
+
+
+def _report_filters(placement):
+    # Where filters are evaluated decides how much is downloaded, so it is
+    # always reported, on stderr to keep the output parseable
+    applied = [
+        f"{where}: {', '.join(expressions)}"
+        for where, expressions in placement.items()
+        if expressions
+    ]
+    if applied:
+        sys.stderr.write(f"Filters applied {'; '.join(applied)}\n")
+
+
+def _parse_filters(filters):
+    ssm_dispatcher = {"platform": _ssm_filter_by_platform}
+    ec2_dispatcher = {
+        "vpc": _ec2_filter_by_vpc,
+        "az": _ec2_filter_by_availability_zone,
+        "name": _ec2_filter_by_name_prefix,
+    }
+
+    parsed = {"ssm": [], "ec2": [], "local": []}
+    placement = {"by SSM API": [], "by EC2 API": [], "locally": []}
+    for expression in filters or []:
+        key, separator, value = expression.partition("=")
+        values = [v for v in value.split(",") if v]
+        if not separator or not key or not values:
+            raise ValueError(f'Invalid filter provided: "{expression}"')
+
+        if key in ssm_dispatcher:
+            parsed["ssm"].append(ssm_dispatcher[key](values))
+            placement["by SSM API"].append(expression)
+        elif key in ec2_dispatcher or key.startswith("tag:"):
+            if key in ec2_dispatcher:
+                parsed["ec2"].append(ec2_dispatcher[key](values))
+            else:
+                parsed["ec2"].append(_ec2_filter_by_tag(key, values))
+            placement["by EC2 API"].append(expression)
+        elif key in DEFAULT_LIST_OUTPUT_FIELDS:
+            parsed["local"].append((key, values))
+            placement["locally"].append(expression)
+        else:
+            raise ValueError(f'Invalid filter provided: "{expression}"')
+
+    _report_filters(placement)
+    return parsed
+
+
+def _matches_local_filters(instance, local_filters):
+    for key, values in local_filters:
+        value = instance.get(key) or ""
+        if not any(fnmatch.fnmatchcase(value, pattern) for pattern in values):
+            return False
+    return True
+
+
+def _get_required_sources(fields, filters):
+    sources = {LIST_FIELD_SOURCES[field] for field in fields}
+    sources.update(LIST_FIELD_SOURCES[key] for key, _ in filters["local"])
+    if filters["ec2"]:
+        sources.add("ec2")
+
+    logger.debug("APIs needed for listing: %s", " ".join(sorted(sources - {None})))
+    return sources
+
+
+def _build_ec2_details(instance):
+    # Tags are not a list output field, they are kept for the inventory
+    tags = {tag["Key"]: tag["Value"] for tag in instance.get("Tags", [])}
+
+    return dict(
+        build_instance_details(instance),
+        asg_name=tags.get("aws:autoscaling:groupName"),
+        tags=tags,
+    )
+
+
+def _fetch_instance_details_batch(instances, ec2, filters=None):
+    import botocore.exceptions  # pylint: disable=import-outside-toplevel
+
+    # Unlike InstanceIds, instance-id filter does not fail the whole request
+    # when some of the instances do not exist (anymore). SSM-managed instances
+    # (mi-) are not known to EC2 API, so we do not ask about them at all.
+    instance_ids = [
+        instance["instance_id"]
+        for instance in instances
+        if instance["instance_id"].startswith("i-")
+    ]
+    ec2_details = {}
+    if instance_ids:
+        paginator = ec2.meta.client.get_paginator("describe_instances")
+        try:
+            ec2_details = {
+                instance["InstanceId"]: _build_ec2_details(instance)
+                for instance in paginator.paginate(
+                    Filters=[{"Name": "instance-id", "Values": instance_ids}]
+                    + (filters or [])
+                ).search("Reservations[].Instances[]")
+            }
+        except botocore.exceptions.ClientError as e:
+            raise AWSConnectionError(e)
+
+    # Instances EC2 API did not describe are still listed by what SSM knows
+    # about them, unless EC2 API filters left them out
+    details = []
+    for instance in instances:
+        if instance["instance_id"] in ec2_details:
+            details.append(dict(instance, **ec2_details[instance["instance_id"]]))
+        elif not filters:
+            logger.debug("No instance details found for %s", instance["instance_id"])
+            details.append(dict(instance, tags={}))
+
+    return details
+
+
+def _iter_batches(iterable, size):
+    iterator = iter(iterable)
+    batch = list(itertools.islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, size))
+
+
+def _fetch_instance_details(instances, ec2, filters=None):
+    # Batches are fetched while instances are still being read from SSM. At
+    # most LIST_MAX_WORKERS batches are in flight, and they are yielded in the
+    # order they were submitted, so instances are listed in the order SSM
+    # returned them.
+    in_flight = collections.deque()
+    with ThreadPoolExecutor(max_workers=LIST_MAX_WORKERS) as executor:
+        for batch in _iter_batches(instances, LIST_BATCH_SIZE):
+            logger.debug("Fetching details of %s instances", len(batch))
+            in_flight.append(
+                executor.submit(_fetch_instance_details_batch, batch, ec2, filters)
+            )
+            while in_flight and (
+                len(in_flight) >= LIST_MAX_WORKERS or in_flight[0].done()
+            ):
+                yield from in_flight.popleft().result()
+
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+
+def _get_fingerprint(instance):
+    # Registration details change when an instance is replaced, re-registered,
+    # upgraded or gets a new address. Fingerprint is not a list output field,
+    # the inventory uses it to refresh only the instances which changed.
+    registration_keys = [
+        "PingStatus",
+        "AgentVersion",
+        "PlatformType",
+        "PlatformName",
+        "PlatformVersion",
+        "IPAddress",
+        "ComputerName",
+        "RegistrationDate",
+    ]
+    return json.dumps([instance.get(key) for key in registration_keys], default=str)
+
+
+def _iter_online_instances(ssm, filters=None):
+    ssm_fields = {
+        "instance_id": "InstanceId",
+        "ping_status": "PingStatus",
+        "agent_version": "AgentVersion",
+        "platform": "PlatformType",
+    }
+
+    paginator = ssm.get_paginator("describe_instance_information")
+    filters = [{"Key": "PingStatus", "Values": ["Online"]}] + (filters or [])
+    for response in paginator.paginate(Filters=filters):
+        for instance in response["InstanceInformationList"]:
+            if instance["PingStatus"] != "Online":
+                continue
+            details = {field: instance.get(key) for field, key in ssm_fields.items()}
+            details["fingerprint"] = _get_fingerprint(instance)
+            yield details
+
+
+def _fetch_changed_instance_details(instances, ec2, known, filters=None):
+    # Instances whose fingerprint did not change keep the EC2 details they
+    # are known with, only details of the rest are fetched
+    changed = []
+    for instance in instances:
+        stored = known.get(instance["instance_id"])
+        if stored is not None and stored["fingerprint"] == instance["fingerprint"]:
+            yield dict(stored, **instance)
+        else:
+            changed.append(instance)
+
+    logger.debug("Details of %s instances changed", len(changed))
+    yield from _fetch_instance_details(instances=changed, ec2=ec2, filters=filters)
+
+
+def _iter_live_instances(profile_name, region_name, plan):
+    filters = plan["filters"]
+    ssm = get_aws_client("ssm", region_name=region_name, profile_name=profile_name)
+    instances = _iter_online_instances(ssm, filters=filters["ssm"])
+
+    if "ec2" in plan["sources"]:
+        ec2 = get_aws_resource(
+            "ec2", region_name=region_name, profile_name=profile_name
+        )
+        known = plan["known"].get((profile_name, region_name))
+        if known:
+            instances = _fetch_changed_instance_details(
+                instances=instances, ec2=ec2, known=known, filters=filters["ec2"]
+            )
+        else:
+            instances = _fetch_instance_details(
+                instances=instances, ec2=ec2, filters=filters["ec2"]
+            )
+
+    return instances
+
+
+def _list_target(profile_name, region_name, plan):
+    instances = None
+    if plan["inventory"]:
+        instances = iter_inventory_instances(profile_name, region_name, plan["filters"])
+    if instances is None:
+        instances = _iter_live_instances(profile_name, region_name, plan)
+
+    for instance in instances:
+        instance = dict(instance, profile=profile_name, region=region_name)
+        if _matches_local_filters(instance, plan["filters"]["local"]):
+            yield instance
+
+
+_TargetSummary = collections.namedtuple(
+    "_TargetSummary", ["profile_name", "region_name", "count", "latency", "error"]
+)
+
+
+def _put(items, item, stop):
+    # Nobody is going to consume the item once the listing is stopped
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _produce_target(profile_name, region_name, plan, items, stop):
+    start = time.monotonic()
+    count, error = 0, None
+    try:
+        for instance in _list_target(profile_name, region_name, plan):
+            if not _put(items, instance, stop):
+                return
+            count += 1
+    except Exception as e:  # pylint: disable=broad-except
+        error = e
+
+    summary = _TargetSummary(
+        profile_name, region_name, count, time.monotonic() - start, error
+    )
+    _put(items, summary, stop)
+
+
+def _report_target(summary):
+    latency_ms = int(summary.latency * 1000)
+    if summary.error is not None:
+        logger.error(
+            "%s/%s: failed after %s ms: %s",
+            summary.profile_name,
+            summary.region_name,
+            latency_ms,
+            summary.error,
+        )
+    else:
+        logger.info(
+            "%s/%s: %s instances in %s ms",
+            summary.profile_name,
+            summary.region_name,
+            summary.count,
+            latency_ms,
+        )
+
+
+def _list_targets(targets, plan, failures):
+    # Targets are listed on a thread pool and their instances are merged into
+    # a single stream through a bounded queue, so the output does not wait for
+    # the slowest target and memory use does not grow with the fleet. All the
+    # output and logging happens in the calling thread.
+    items = queue.Queue(maxsize=LIST_BATCH_SIZE * LIST_TARGET_MAX_WORKERS)
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(
+        max_workers=min(len(targets), LIST_TARGET_MAX_WORKERS)
+    )
+    futures = [
+        executor.submit(_produce_target, profile_name, region_name, plan, items, stop)
+        for profile_name, region_name in targets
+    ]
+
+    remaining = len(targets)
+    try:
+        while remaining:
+            item = items.get()
+            if not isinstance(item, _TargetSummary):
+                yield item
+                continue
+
+            remaining -= 1
+            _report_target(item)
+            if item.error is not None:
+                failures.append(item)
+    finally:
+        stop.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def get_targets(profile_name, region_name, profile_names=None, region_names=None):
+    # Profiles and regions are validated by the caller, valid_aws_profile and
+    # valid_aws_region check the ones instances are listed from
+    return list(
+        itertools.product(
+            profile_names or [profile_name], region_names or [region_name]
+        )
+    )
+
+
+def iter_instances(
+    targets,
+    fields=DEFAULT_LIST_OUTPUT_FIELDS,
+    filters=None,
+    failures=None,
+    inventory=False,
+    known=None,
+):
+    # known maps targets to the instances already known about them, keyed by
+    # instance ID, as kept by the inventory
+    filters = _parse_filters(filters)
+    plan = {
+        "filters": filters,
+        "sources": _get_required_sources(fields, filters),
+        "inventory": inventory,
+        "known": known or {},
+    }
+
+    # Errors of a single target are raised, errors of several targets are
+    # reported and collected in failures
+    if len(targets) == 1:
+        return _list_target(*targets[0], plan)
+    return _list_targets(targets, plan, failures if failures is not None else [])
+
+
 @valid_aws_profile
 @valid_aws_region
 def list_instances(
@@ -69,6 +491,10 @@ def list_instances(
     region_name=AWS_DEFAULT_REGION,
     output_format=DEFAULT_LIST_OUTPUT,
     fields=DEFAULT_LIST_HUMAN_FIELDS,
+    profile_names=None,
+    region_names=None,
+    filters=None,
+    inventory=False,
 ):
     invalid_fields = list(set(fields) - set(DEFAULT_LIST_OUTPUT_FIELDS))
     if invalid_fields:
@@ -79,20 +505,16 @@ def list_instances(
             f'Invalid fields provided: "{invalid_fields_str}". Valid fields: "{default_fields_str}"'  # noqa: B950
         )
 
-    ssm = get_aws_client("ssm", region_name=region_name, profile_name=profile_name)
-    ec2 = get_aws_resource("ec2", region_name=region_name, profile_name=profile_name)
-
-    instances_ssm_paginator = ssm.get_paginator("describe_instance_information")
-    instances_ssm_response_iterator = instances_ssm_paginator.paginate()
-
-    instance_ids = []
-    for response in instances_ssm_response_iterator:
-        for instance in response["InstanceInformationList"]:
-            if instance["PingStatus"] != "Online":
-                continue
-            instance_ids.append(instance["InstanceId"])
-
-    instance_details = get_multiple_instance_details(instance_ids=instance_ids, ec2=ec2)
-    print(
-        serialize(instance_details, output_format=output_format, fields=fields).rstrip()
+    targets = get_targets(profile_name, region_name, profile_names, region_names)
+    failures = []
+    instance_details = iter_instances(
+        targets, fields=fields, filters=filters, failures=failures, inventory=inventory
     )
+    _print_stream(
+        serialize_stream(instance_details, output_format=output_format, fields=fields)
+    )
+
+    if failures:
+        raise AWSConnectionError(
+            f"Listing instances failed in {len(failures)} of {len(targets)} targets"
+        )
@@ -0,0 +1,117 @@
+import collections
+import heapq
+import itertools
+import logging
+
+from aws_gate.constants import ALIAS_PATTERN_CHARS
+from aws_gate.inventory import get_instance_names
+
+logger = logging.getLogger(__name__)
+
+SUGGESTIONS_LIMIT = 5
+# Share of trigrams two names need to have in common to be considered similar
+FUZZY_THRESHOLD = 0.3
+
+
+def _trigrams(name):
+    # Padding makes names sharing their beginning more similar than names
+    # sharing the same letters somewhere in the middle
+    padded = f"  {name.lower()} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    def __init__(self, names=()):
+        # Trie of names, every node maps characters to child nodes and None
+        # to the name ending in the node
+        self._trie = {}
+        self._trigrams = collections.defaultdict(set)
+        self._trigram_counts = {}
+
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self._trigram_counts)
+
+    def __contains__(self, name):
+        return name in self._trigram_counts
+
+    def add(self, name):
+        if not name or name in self:
+            return
+
+        node = self._trie
+        for char in name:
+            node = node.setdefault(char, {})
+        node[None] = name
+
+        trigrams = _trigrams(name)
+        self._trigram_counts[name] = len(trigrams)
+        for trigram in trigrams:
+            self._trigrams[trigram].add(name)
+
+    @classmethod
+    def _walk(cls, node):
+        # Names in lexicographic order, i.e. every name comes before the longer
+        # names it is a prefix of
+        if None in node:
+            yield node[None]
+        for char in sorted(char for char in node if char is not None):
+            yield from cls._walk(node[char])
+
+    def complete(self, prefix, limit=None):
+        node = self._trie
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+
+        return list(itertools.islice(self._walk(node), limit))
+
+    def fuzzy(self, name, limit=SUGGESTIONS_LIMIT):
+        trigrams = _trigrams(name)
+        shared = collections.Counter()
+        for trigram in trigrams:
+            shared.update(self._trigrams.get(trigram, ()))
+
+        # Names are ranked by Jaccard similarity of their trigrams
+        scored = []
+        for candidate, count in shared.items():
+            score = count / (len(trigrams) + self._trigram_counts[candidate] - count)
+            if score >= FUZZY_THRESHOLD:
+                scored.append((-score, candidate))
+
+        return [candidate for _, candidate in heapq.nsmallest(limit, scored)]
+
+    def suggest(self, name, limit=SUGGESTIONS_LIMIT):
+        suggestions = [n for n in self.complete(name, limit=limit + 1) if n != name]
+        for candidate in self.fuzzy(name, limit=limit + 1):
+            if candidate != name and candidate not in suggestions:
+                suggestions.append(candidate)
+
+        return suggestions[:limit]
+
+
+def build_name_index(config):
+    # Aliases with wildcards are not names anybody could type
+    names = [
+        host["alias"]
+        for host in config.hosts
+        if ALIAS_PATTERN_CHARS.isdisjoint(host["alias"])
+    ]
+    names.extend(get_instance_names())
+
+    index = NameIndex(names)
+    logger.debug("Indexed %s host names", len(index))
+    return index
+
+
+def instance_not_found(name, config):
+    message = f"No instance could be found for name: {name}"
+
+    suggestions = build_name_index(config).suggest(name)
+    if suggestions:
+        message += f" (did you mean: {', '.join(suggestions)}?)"
+
+    return ValueError(message)
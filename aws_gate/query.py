@@ -1,12 +1,48 @@
 import ipaddress
+import json
 import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 
 import botocore.exceptions
 
+from aws_gate.constants import (
+    DEFAULT_GATE_INSTANCE_CACHE_PATH,
+    DEFAULT_INSTANCE_SELECTION,
+    INSTANCE_CACHE_NEGATIVE_TTL,
+    INSTANCE_CACHE_TTL,
+    INSTANCE_SELECTION_POLICIES,
+    DEFAULT_PROFILE_PREFERENCE,
+    PROFILE_FANOUT_MAX_WORKERS,
+    PROFILE_PREFERENCES,
+    REGION_FALLBACK_MAX_WORKERS,
+)
 from aws_gate.exceptions import AWSConnectionError
+from aws_gate.inventory import lookup_instance, remove_instance
+from aws_gate.utils import (
+    build_instance_details,
+    get_aws_resource,
+    get_instance_details,
+    write_file_atomically,
+)
 
 logger = logging.getLogger(__name__)
 
+INSTANCE_CACHE_FORMAT = 2
+
+# Error codes reported by SSM StartSession and EC2 Instance Connect
+# SendSSHPublicKey when the instance we connect to is gone
+SSM_INSTANCE_GONE_ERRORS = ("TargetNotConnected", "InvalidTarget")
+EC2_IC_INSTANCE_GONE_ERRORS = (
+    "EC2InstanceNotFoundException",
+    "EC2InstanceStateInvalidException",
+)
+# Error codes reported by EC2 DescribeInstances for instance IDs it does not
+# know in the region
+EC2_NOT_FOUND_ERRORS = ("InvalidInstanceID.NotFound",)
+
 
 def _is_valid_ip(ip):
     try:
@@ -16,47 +52,176 @@ def _is_valid_ip(ip):
     return True
 
 
-def _query_aws_api(filters, ec2=None):
-    ret = None
-
+def _iter_aws_api(filters, ec2=None):
     # We are always interested only in running EC2 instances as we cannot
     # open a session to terminated EC2 instance.
     filters = filters + [{"Name": "instance-state-name", "Values": ["running"]}]
 
+    # Plain DescribeInstances responses are used instead of ec2.Instance
+    # resources, which are expensive to build for large fleets. Pages are
+    # requested lazily, so consumers can stop early once they have a match.
+    paginator = ec2.meta.client.get_paginator("describe_instances")
     try:
-        ec2_instances = list(ec2.instances.filter(Filters=filters))
-        logger.debug("Found %s maching instances", len(ec2_instances))
-        for i in ec2_instances:
-            if i.instance_id:
-                logger.debug("Matching instance: %s", i.instance_id)
-                ret = i.instance_id
+        for instance in paginator.paginate(Filters=filters).search(
+            "Reservations[].Instances[]"
+        ):
+            logger.debug("Matching instance: %s", instance["InstanceId"])
+            yield instance
     except botocore.exceptions.ClientError as e:
         raise AWSConnectionError(e)
 
-    return ret
 
+# pylint: disable=unused-argument
+def _select_first(instances, availability_zone=None):
+    return next(instances, None)
+
+
+def _select_newest(instances, availability_zone=None):
+    return max(
+        instances,
+        key=lambda i: (i["LaunchTime"], i["InstanceId"]),
+        default=None,
+    )
+
+
+def _select_random(instances, availability_zone=None):
+    # Reservoir sampling, so we never hold more than one instance in memory
+    selected = None
+    for count, instance in enumerate(instances, start=1):
+        if random.randrange(count) == 0:  # noqa: S311
+            selected = instance
+    return selected
+
+
+def _select_same_az(instances, availability_zone=None):
+    fallback = None
+    for instance in instances:
+        if instance["Placement"]["AvailabilityZone"] == availability_zone:
+            return instance
+        if fallback is None:
+            fallback = instance
+    return fallback
+
+
+def _query_aws_api(
+    filters, ec2=None, selection=DEFAULT_INSTANCE_SELECTION, availability_zone=None
+):
+    selection_dispatcher = {
+        "first": _select_first,
+        "newest": _select_newest,
+        "random": _select_random,
+        "same-az": _select_same_az,
+    }
+
+    instance = selection_dispatcher[selection](
+        _iter_aws_api(filters=filters, ec2=ec2), availability_zone=availability_zone
+    )
+    if instance is None:
+        return None
+
+    logger.debug("Selected instance (%s): %s", selection, instance["InstanceId"])
+    return build_instance_details(instance)
+
+
+def _instance_cache_key(name, region_name, profile_name, selection, availability_zone):
+    return json.dumps([profile_name, region_name, name, selection, availability_zone])
+
+
+def _load_instance_cache():
+    try:
+        with open(DEFAULT_GATE_INSTANCE_CACHE_PATH, "r") as f:
+            cached = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.debug("Ignoring unreadable instance cache: %s", e)
+        return {}
+
+    if not isinstance(cached, dict) or cached.get("format") != INSTANCE_CACHE_FORMAT:
+        return {}
+
+    return cached.get("instances", {})
+
+
+def _store_instance_cache(entries):
+    now = time.time()
+    data = json.dumps(
+        {
+            "format": INSTANCE_CACHE_FORMAT,
+            "instances": {k: v for k, v in entries.items() if v["expires"] > now},
+        }
+    )
+    try:
+        write_file_atomically(DEFAULT_GATE_INSTANCE_CACHE_PATH, data.encode())
+    except OSError as e:
+        logger.debug("Unable to store instance cache: %s", e)
+
+
+def _get_cached_instance(cache_key):
+    entry = _load_instance_cache().get(cache_key)
+    if entry is None or entry["expires"] <= time.time():
+        return False, None
+
+    return True, entry["instance"]
 
-def getinstanceidbyprivatednsname(name, ec2=None):
-    filters = [{"Name": "private-dns-name", "Values": [name]}]
-    return _query_aws_api(filters=filters, ec2=ec2)
 
+def _cache_instance(cache_key, instance):
+    ttl = INSTANCE_CACHE_TTL if instance else INSTANCE_CACHE_NEGATIVE_TTL
+    if ttl <= 0:
+        return
 
-def getinstanceidbydnsname(name, ec2=None):
-    filters = [{"Name": "dns-name", "Values": [name]}]
-    return _query_aws_api(filters=filters, ec2=ec2)
+    entries = _load_instance_cache()
+    entries[cache_key] = {"instance": instance, "expires": time.time() + ttl}
+    _store_instance_cache(entries)
 
 
-def getinstanceidbyprivateipaddress(name, ec2=None):
-    filters = [{"Name": "private-ip-address", "Values": [name]}]
-    return _query_aws_api(filters=filters, ec2=ec2)
+def invalidate_cached_instance(instance_id):
+    remove_instance(instance_id)
 
+    entries = _load_instance_cache()
+    stale = [
+        k
+        for k, v in entries.items()
+        if v["instance"] and v["instance"]["instance_id"] == instance_id
+    ]
+    if not stale:
+        return
 
-def getinstanceidbyipaddress(name, ec2=None):
-    filters = [{"Name": "ip-address", "Values": [name]}]
-    return _query_aws_api(filters=filters, ec2=ec2)
+    logger.debug("Invalidating cached instance: %s", instance_id)
+    for cache_key in stale:
+        del entries[cache_key]
+    _store_instance_cache(entries)
 
 
-def getinstanceidbytag(name, ec2=None):
+@contextmanager
+def invalidate_cached_instance_on_error(instance_id, error_codes):
+    # Instances are replaced all the time (e.g. by autoscaling groups), so a
+    # cached identifier has to be dropped as soon as AWS tells us it is gone
+    try:
+        yield
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") in error_codes:
+            invalidate_cached_instance(instance_id)
+        raise
+
+
+def _filters_by_private_dns_name(name):
+    return [{"Name": "private-dns-name", "Values": [name]}]
+
+
+def _filters_by_dns_name(name):
+    return [{"Name": "dns-name", "Values": [name]}]
+
+
+def _filters_by_private_ip_address(name):
+    return [{"Name": "private-ip-address", "Values": [name]}]
+
+
+def _filters_by_ip_address(name):
+    return [{"Name": "ip-address", "Values": [name]}]
+
+
+def _filters_by_tag(name):
     # One of the allowed characters in tags is ":", which might break tag
     # parsing. For this reason,we have to differentiate 2 cases for
     # provided name:
@@ -67,45 +232,38 @@ def getinstanceidbytag(name, ec2=None):
     else:
         key, value = name.split(":", 1)
 
-    filters = [{"Name": f"tag:{key}", "Values": [value]}]
-    return _query_aws_api(filters=filters, ec2=ec2)
+    return [{"Name": f"tag:{key}", "Values": [value]}]
 
 
-def getinstanceidbyinstancename(name, ec2=None):
-    return getinstanceidbytag(f"Name:{name}", ec2=ec2)
+def _filters_by_instance_name(name):
+    return _filters_by_tag(f"Name:{name}")
 
 
-def getinstanceidbyautoscalinggroup(name, ec2=None):
+def _filters_by_autoscaling_group(name):
     _, asg_name = name.split(":")
-    return getinstanceidbytag(f"aws:autoscaling:groupName:{asg_name}", ec2=ec2)
+    return _filters_by_tag(f"aws:autoscaling:groupName:{asg_name}")
 
 
-def query_instance(name, ec2=None):
-    if ec2 is None:
-        raise ValueError("EC2 client is not initialized")
+def is_instance_id(name):
+    # Identifier prefixes:
+    # id - human friendly, present in some systems
+    # i - regular EC2 instance ID as present in AWS console/logs
+    # mi - regular SSM-managed instance ID as present in AWS console/logs
+    return name.startswith("id-") or name.startswith("i-") or name.startswith("mi-")
 
-    logger.debug("Querying EC2 API for instance identifier: %s", name)
 
+def _get_filters(name):
     identifier_type = None
     func_dispatcher = {
-        "dns-name": getinstanceidbydnsname,
-        "private-dns-name": getinstanceidbyprivatednsname,
-        "ip-address": getinstanceidbyipaddress,
-        "private-ip-address": getinstanceidbyprivateipaddress,
-        "tag": getinstanceidbytag,
-        "name": getinstanceidbyinstancename,
-        "asg": getinstanceidbyautoscalinggroup,
+        "dns-name": _filters_by_dns_name,
+        "private-dns-name": _filters_by_private_dns_name,
+        "ip-address": _filters_by_ip_address,
+        "private-ip-address": _filters_by_private_ip_address,
+        "tag": _filters_by_tag,
+        "name": _filters_by_instance_name,
+        "asg": _filters_by_autoscaling_group,
     }
 
-    # If we are provided with instance ID directly, we don't need to contact EC2
-    # API and can return the value directly.
-    # Identifier prefixes:
-    # id - human friendly, present in some systems
-    # i - regular EC2 instance ID as present in AWS console/logs
-    # mi - regular SSM-managed instance ID as present in AWS console/logs
-    if name.startswith("id-") or name.startswith("i-") or name.startswith("mi-"):
-        return name
-
     if _is_valid_ip(name):
         if not ipaddress.ip_address(name).is_private:
             identifier_type = "ip-address"
@@ -124,4 +282,336 @@ def query_instance(name, ec2=None):
             identifier_type = "name"
 
     logger.debug("Identifier type chosen: %s", identifier_type)
-    return func_dispatcher[identifier_type](name=name, ec2=ec2)
+    return func_dispatcher[identifier_type](name=name)
+
+
+def _get_instance_by_id(name, ec2):
+    # SSM-managed instances are not known to EC2 API
+    if not name.startswith("i-"):
+        return {"instance_id": name}
+
+    # EC2 API refuses to describe instance IDs it does not know, which for us
+    # means that the instance is not in this region
+    try:
+        return get_instance_details(instance_id=name, ec2=ec2)
+    except AWSConnectionError as e:
+        error = e.args[0]
+        if not isinstance(error, botocore.exceptions.ClientError):
+            raise
+        if error.response.get("Error", {}).get("Code") not in EC2_NOT_FOUND_ERRORS:
+            raise
+
+    logger.debug("Instance %s not found", name)
+    return None
+
+
+def _query_instance_details(name, ec2, selection, availability_zone):
+    logger.debug("Querying EC2 API for instance identifier: %s", name)
+
+    if is_instance_id(name):
+        return _get_instance_by_id(name, ec2)
+
+    return _query_aws_api(
+        filters=_get_filters(name),
+        ec2=ec2,
+        selection=selection,
+        availability_zone=availability_zone,
+    )
+
+
+def _query_inventory(name, profile_name, region_name, selection, availability_zone):
+    # The inventory keeps instances in the order EC2 API lists them, which is
+    # all the first and same-az policies need
+    if selection not in ["first", "same-az"]:
+        return None
+
+    if is_instance_id(name):
+        filters = [{"Name": "instance-id", "Values": [name]}]
+    else:
+        filters = _get_filters(name)
+
+    instance = lookup_instance(
+        filters,
+        profile_name,
+        region_name,
+        availability_zone=availability_zone if selection == "same-az" else None,
+    )
+    if instance is not None:
+        logger.debug("Instance %s found in inventory", name)
+    return instance
+
+
+def _query_region(name, profile_name, region_name, selection, availability_zone):
+    ec2 = get_aws_resource("ec2", region_name=region_name, profile_name=profile_name)
+    try:
+        instance = _query_instance_details(name, ec2, selection, availability_zone)
+    except (AWSConnectionError, botocore.exceptions.BotoCoreError) as e:
+        # Some regions are not enabled for every account (or not reachable at
+        # all, e.g. China or GovCloud), which must not stop the search
+        logger.debug("Unable to query region %s: %s", region_name, e)
+        return None
+
+    if instance is not None:
+        instance["region_name"] = region_name
+    return instance
+
+
+def _query_fallback_regions(
+    name, profile_name, region_name, regions, selection, availability_zone
+):
+    regions = [r for r in regions if r != region_name]
+    if not regions:
+        return None
+
+    logger.debug("Looking for instance %s in regions: %s", name, " ".join(regions))
+
+    executor = ThreadPoolExecutor(
+        max_workers=min(len(regions), REGION_FALLBACK_MAX_WORKERS)
+    )
+    futures = [
+        executor.submit(
+            _query_region, name, profile_name, region, selection, availability_zone
+        )
+        for region in regions
+    ]
+
+    instance = None
+    try:
+        for future in as_completed(futures):
+            instance = future.result()
+            if instance is not None:
+                logger.debug("Instance %s found in %s", name, instance["region_name"])
+                break
+    finally:
+        # Lookups which have not started yet are not needed anymore, the ones
+        # in progress are left to finish in the background
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+    return instance
+
+
+def query_instance_details(
+    name,
+    ec2=None,
+    profile_name=None,
+    region_name=None,
+    selection=DEFAULT_INSTANCE_SELECTION,
+    availability_zone=None,
+    fallback_regions=None,
+):
+    if ec2 is None:
+        raise ValueError("EC2 client is not initialized")
+
+    if selection not in INSTANCE_SELECTION_POLICIES:
+        raise ValueError(f"Invalid instance selection policy: {selection}")
+    if selection == "same-az" and availability_zone is None:
+        raise ValueError("Availability zone is required for same-az selection")
+
+    # Resolved instances are cached per profile and region, which is only
+    # possible when the caller tells us which ones the EC2 client uses. Random
+    # selection would not be random anymore with a cache in front of it.
+    cache_key = None
+    found, instance = False, None
+    if profile_name is not None and region_name is not None and selection != "random":
+        cache_key = _instance_cache_key(
+            name, region_name, profile_name, selection, availability_zone
+        )
+        found, instance = _get_cached_instance(cache_key)
+        if found and (instance is not None or not fallback_regions):
+            logger.debug("Using cached instance for %s: %s", name, instance)
+            return instance
+
+    if not found and cache_key is not None:
+        instance = _query_inventory(
+            name, profile_name, region_name, selection, availability_zone
+        )
+    if not found and instance is None:
+        instance = _query_instance_details(name, ec2, selection, availability_zone)
+
+    # Instances found in other regions are cached under the region we were
+    # asked for, so the next lookup goes straight to the right region
+    if instance is None and fallback_regions and profile_name is not None:
+        instance = _query_fallback_regions(
+            name,
+            profile_name,
+            region_name,
+            fallback_regions,
+            selection,
+            availability_zone,
+        )
+
+    if cache_key is not None:
+        _cache_instance(cache_key, instance)
+
+    return instance
+
+
+def _query_profile(name, profile_name, region_name, **kwargs):
+    start = time.monotonic()
+    try:
+        ec2 = get_aws_resource(
+            "ec2", region_name=region_name, profile_name=profile_name
+        )
+        instance = query_instance_details(
+            name,
+            ec2=ec2,
+            profile_name=profile_name,
+            region_name=region_name,
+            **kwargs,
+        )
+    except (AWSConnectionError, botocore.exceptions.BotoCoreError) as e:
+        return None, time.monotonic() - start, e
+
+    if instance is not None:
+        instance = dict(instance, profile_name=profile_name)
+    return instance, time.monotonic() - start, None
+
+
+def _report_profile(profile_name, instance, latency, error):
+    latency_ms = int(latency * 1000)
+    if error is not None:
+        logger.info(
+            "Profile %s: failed after %s ms: %s", profile_name, latency_ms, error
+        )
+    elif instance is None:
+        logger.info("Profile %s: no instance found in %s ms", profile_name, latency_ms)
+    else:
+        logger.info(
+            "Profile %s: found %s in %s ms",
+            profile_name,
+            instance["instance_id"],
+            latency_ms,
+        )
+
+
+def query_instance_in_profiles(
+    name,
+    profile_names,
+    region_name,
+    preference=DEFAULT_PROFILE_PREFERENCE,
+    **kwargs,
+):
+    if not profile_names:
+        raise ValueError("No AWS profiles provided")
+    if preference not in PROFILE_PREFERENCES:
+        raise ValueError(f"Invalid profile preference: {preference}")
+
+    logger.debug(
+        "Looking for instance %s in profiles: %s", name, " ".join(profile_names)
+    )
+
+    executor = ThreadPoolExecutor(
+        max_workers=min(len(profile_names), PROFILE_FANOUT_MAX_WORKERS)
+    )
+    futures = {}
+    for profile_name in profile_names:
+        future = executor.submit(
+            _query_profile, name, profile_name, region_name, **kwargs
+        )
+        futures[future] = profile_name
+
+    # With "order" preference, profiles listed first win, so a match can only
+    # be used once all profiles listed before it have answered. "fastest"
+    # takes the first match whichever profile it comes from.
+    if preference == "order":
+        results = iter(futures)
+    else:
+        results = as_completed(futures)
+
+    instance = None
+    try:
+        for future in results:
+            instance, latency, error = future.result()
+            _report_profile(futures[future], instance, latency, error)
+            if instance is not None:
+                break
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+    return instance
+
+
+def resolve_instance(
+    name,
+    profile_name,
+    region_name,
+    selection=DEFAULT_INSTANCE_SELECTION,
+    availability_zone=None,
+    fallback_regions=None,
+    profile_names=None,
+    profile_preference=DEFAULT_PROFILE_PREFERENCE,
+    instance_id_only=False,
+):
+    query_kwargs = {
+        "selection": selection,
+        "availability_zone": availability_zone,
+        "fallback_regions": fallback_regions,
+    }
+    if profile_names:
+        return query_instance_in_profiles(
+            name=name,
+            profile_names=profile_names,
+            region_name=region_name,
+            preference=profile_preference,
+            **query_kwargs,
+        )
+
+    # Callers needing nothing but the instance ID get it without asking EC2
+    # API, unless the instance might be in another region
+    if instance_id_only and is_instance_id(name) and not fallback_regions:
+        return {"instance_id": name}
+
+    return query_instance_details(
+        name=name,
+        ec2=get_aws_resource("ec2", region_name=region_name, profile_name=profile_name),
+        profile_name=profile_name,
+        region_name=region_name,
+        **query_kwargs,
+    )
+
+
+def query_instance(
+    name,
+    ec2=None,
+    profile_name=None,
+    region_name=None,
+    selection=DEFAULT_INSTANCE_SELECTION,
+    availability_zone=None,
+):
+    if ec2 is None:
+        raise ValueError("EC2 client is not initialized")
+
+    # If we are provided with instance ID directly, we don't need to contact EC2
+    # API and can return the value directly.
+    if is_instance_id(name):
+        return name
+
+    instance = query_instance_details(
+        name,
+        ec2=ec2,
+        profile_name=profile_name,
+        region_name=region_name,
+        selection=selection,
+        availability_zone=availability_zone,
+    )
+    return instance["instance_id"] if instance else None
+
+
+def query_instances(name, ec2=None):
+    if ec2 is None:
+        raise ValueError("EC2 client is not initialized")
+
+    logger.debug("Querying EC2 API for all instances matching: %s", name)
+
+    if is_instance_id(name):
+        instance = _get_instance_by_id(name, ec2)
+        if instance is not None:
+            yield instance
+        return
+
+    for instance in _iter_aws_api(filters=_get_filters(name), ec2=ec2):
+        yield build_instance_details(instance)
@@ -1,19 +1,21 @@
 import logging
 
-from aws_gate.constants import AWS_DEFAULT_PROFILE, AWS_DEFAULT_REGION
+from aws_gate.constants import (
+    AWS_DEFAULT_PROFILE,
+    AWS_DEFAULT_REGION,
+    DEFAULT_INSTANCE_SELECTION,
+    DEFAULT_PROFILE_PREFERENCE,
+)
 from aws_gate.decorators import (
     plugin_version,
     plugin_required,
     valid_aws_profile,
     valid_aws_region,
 )
-from aws_gate.query import query_instance
+from aws_gate.names import instance_not_found
+from aws_gate.query import resolve_instance
 from aws_gate.session_common import BaseSession
-from aws_gate.utils import (
-    get_aws_client,
-    get_aws_resource,
-    fetch_instance_details_from_config,
-)
+from aws_gate.utils import get_aws_client, fetch_instance_details_from_config
 
 logger = logging.getLogger(__name__)
 
@@ -43,17 +45,35 @@ def session(
     instance_name,
     profile_name=AWS_DEFAULT_PROFILE,
     region_name=AWS_DEFAULT_REGION,
+    selection=DEFAULT_INSTANCE_SELECTION,
+    availability_zone=None,
+    fallback_regions=None,
+    profile_names=None,
+    profile_preference=DEFAULT_PROFILE_PREFERENCE,
 ):
     instance, profile, region = fetch_instance_details_from_config(
         config, instance_name, profile_name, region_name
     )
 
-    ssm = get_aws_client("ssm", region_name=region, profile_name=profile)
-    ec2 = get_aws_resource("ec2", region_name=region, profile_name=profile)
+    # Sessions are opened by the instance ID alone
+    instance_details = resolve_instance(
+        instance,
+        profile,
+        region,
+        selection=selection,
+        availability_zone=availability_zone,
+        fallback_regions=fallback_regions,
+        profile_names=profile_names,
+        profile_preference=profile_preference,
+        instance_id_only=True,
+    )
+    if instance_details is None:
+        raise instance_not_found(instance, config)
 
-    instance_id = query_instance(name=instance, ec2=ec2)
-    if instance_id is None:
-        raise ValueError(f"No instance could be found for name: {instance}")
+    instance_id = instance_details["instance_id"]
+    profile = instance_details.get("profile_name", profile)
+    region = instance_details.get("region_name", region)
+    ssm = get_aws_client("ssm", region_name=region, profile_name=profile)
 
     logger.info(
         "Opening session on instance %s (%s) via profile %s",
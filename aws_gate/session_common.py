@@ -1,6 +1,10 @@
 import json
 import logging
 
+from aws_gate.query import (
+    SSM_INSTANCE_GONE_ERRORS,
+    invalidate_cached_instance_on_error,
+)
 from aws_gate.utils import execute_plugin
 
 logger = logging.getLogger(__name__)
@@ -33,7 +37,10 @@ class BaseSession:
             self._instance_id,
             self._region_name,
         )
-        self._response = self._ssm.start_session(**self._session_parameters)
+        with invalidate_cached_instance_on_error(
+            self._instance_id, SSM_INSTANCE_GONE_ERRORS
+        ):
+            self._response = self._ssm.start_session(**self._session_parameters)
         logger.debug("Received response: %s", self._response)
 
         self._session_id, self._token_value = (
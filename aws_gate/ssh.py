@@ -1,17 +1,22 @@
+import contextlib
 import json
 import logging
 import shlex
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from aws_gate.constants import (
     AWS_DEFAULT_PROFILE,
     AWS_DEFAULT_REGION,
+    DEFAULT_INSTANCE_SELECTION,
+    DEFAULT_PROFILE_PREFERENCE,
     DEFAULT_OS_USER,
     DEFAULT_SSH_PORT,
     DEFAULT_KEY_ALGORITHM,
     DEFAULT_KEY_SIZE,
     PLUGIN_INSTALL_PATH,
     DEBUG,
-    DEFAULT_GATE_KEY_PATH,
 )
 from aws_gate.decorators import (
     plugin_version,
@@ -19,14 +24,13 @@ from aws_gate.decorators import (
     valid_aws_profile,
     valid_aws_region,
 )
-from aws_gate.query import query_instance
+from aws_gate.names import instance_not_found
+from aws_gate.query import resolve_instance
 from aws_gate.session_common import BaseSession
-from aws_gate.ssh_common import SshKey, SshKeyUploader
+from aws_gate.ssh_common import SshKey, SshKeyCache, SshKeyPool, SshKeyUploader
 from aws_gate.utils import (
     get_aws_client,
-    get_aws_resource,
     fetch_instance_details_from_config,
-    get_instance_details,
     execute,
 )
 
@@ -46,6 +50,8 @@ class SshSession(BaseSession):
         local_forward=None,
         remote_forward=None,
         dynamic_forward=None,
+        key_path=None,
+        agent_socket=None,
     ):
         self._instance_id = instance_id
         self._region_name = region_name
@@ -57,6 +63,8 @@ class SshSession(BaseSession):
         self._local_forward = local_forward
         self._remote_forward = remote_forward
         self._dynamic_forward = dynamic_forward
+        self._key_path = key_path
+        self._agent_socket = agent_socket
 
         self._ssh_cmd = None
 
@@ -75,10 +83,11 @@ class SshSession(BaseSession):
             str(self._port),
             "-F",
             "/dev/null",
-            "-i",
-            DEFAULT_GATE_KEY_PATH,
         ]
 
+        if self._key_path:
+            cmd.extend(["-i", self._key_path])
+
         if self._local_forward or self._remote_forward or self._dynamic_forward:
             cmd.append("-N")
 
@@ -107,8 +116,14 @@ class SshSession(BaseSession):
         ]
         proxy_command = " ".join(shlex.quote(i) for i in proxy_command_args)
 
-        ssh_options = [
-            "IdentitiesOnly=yes",
+        if self._agent_socket:
+            # The agent holds the session key only, other identities of the user
+            # are not offered before it
+            ssh_options = [f'IdentityAgent="{self._agent_socket}"', "IdentitiesOnly=no"]
+        else:
+            ssh_options = ["IdentitiesOnly=yes"]
+
+        ssh_options += [
             "UserKnownHostsFile=/dev/null",
             "StrictHostKeyChecking=no",
             f"ProxyCommand={proxy_command}",
@@ -132,11 +147,69 @@ class SshSession(BaseSession):
         return execute(self._ssh_cmd[0], self._ssh_cmd[1:])
 
 
+def _timed(func, *args, **kwargs):
+    start = time.monotonic()
+    result = func(*args, **kwargs)
+    return result, time.monotonic() - start
+
+
+def _generate_ssh_key(key_type, key_size, key_pool=None, private_key=None):
+    ssh_key = SshKey(
+        key_type=key_type,
+        key_size=key_size,
+        key_pool=key_pool,
+        private_key=private_key,
+    )
+    ssh_key.generate()
+    return ssh_key
+
+
+def _get_ssh_key(private_key, key_future, key_type, key_size, key_pool):
+    if private_key is not None:
+        # Key pushed by a concurrent session meanwhile makes the one generated
+        # in the background useless
+        if key_future is not None:
+            key_future.cancel()
+        return _timed(_generate_ssh_key, key_type, key_size, private_key=private_key)
+
+    if key_future is not None:
+        return key_future.result()
+    return _timed(_generate_ssh_key, key_type, key_size, key_pool=key_pool)
+
+
+def _terminate_ssh_session(ssh_session, session_future):
+    # Session is being created in the background, there is nothing to terminate
+    # when it has failed
+    if session_future.exception() is None:
+        ssh_session.terminate()
+
+
+def _report_setup(elapsed, **steps):
+    # Time the setup would take with the steps run one after another
+    sequential = sum(steps.values())
+    logger.info(
+        "SSH session set up in %s ms, %s ms saved by running steps concurrently",
+        int(elapsed * 1000),
+        max(int((sequential - elapsed) * 1000), 0),
+    )
+    logger.debug(
+        "SSH session setup steps: %s",
+        ", ".join(f"{step} {int(t * 1000)} ms" for step, t in steps.items()),
+    )
+
+
+def _start_ssh_agent(stack, ssh_key):
+    # SSH agent needs Unix domain sockets, so it is imported only when used
+    from aws_gate.ssh_agent import SshAgent  # pylint: disable=import-outside-toplevel
+
+    return stack.enter_context(SshAgent(ssh_key)).socket_path
+
+
 @plugin_required
 @plugin_version("1.1.23.0")
 @valid_aws_profile
 @valid_aws_region
-def ssh(
+def ssh(  # pylint: disable=too-many-arguments,too-many-locals
     config,
     instance_name,
     user=DEFAULT_OS_USER,
@@ -149,42 +222,100 @@ def ssh(
     local_forward=None,
     remote_forward=None,
     dynamic_forward=None,
+    selection=DEFAULT_INSTANCE_SELECTION,
+    availability_zone=None,
+    fallback_regions=None,
+    profile_names=None,
+    profile_preference=DEFAULT_PROFILE_PREFERENCE,
+    ssh_agent=False,
 ):
-    instance, profile, region = fetch_instance_details_from_config(
-        config, instance_name, profile_name, region_name
-    )
+    # SSH agent listens on a Unix domain socket
+    if ssh_agent and not hasattr(socket, "AF_UNIX"):
+        raise ValueError("Serving SSH key by an agent requires Unix domain sockets")
 
-    ssm = get_aws_client("ssm", region_name=region, profile_name=profile)
-    ec2 = get_aws_resource("ec2", region_name=region, profile_name=profile)
-    ec2_ic = get_aws_client(
-        "ec2-instance-connect", region_name=region, profile_name=profile
-    )
+    setup_start = time.monotonic()
+    # Keys served by SSH agent never touch the disk, so they are neither taken
+    # from the pool nor kept for reuse
+    key_cache = SshKeyCache(ttl=0 if ssh_agent else None)
+    key_pool = None if ssh_agent else SshKeyPool()
 
-    instance_id = query_instance(name=instance, ec2=ec2)
-    if instance_id is None:
-        raise ValueError(f"No instance could be found for name: {instance}")
+    with contextlib.ExitStack() as stack:
+        executor = ThreadPoolExecutor(max_workers=2)
+        stack.callback(executor.shutdown, wait=False)
 
-    az = get_instance_details(instance_id=instance_id, ec2=ec2)["availability_zone"]
+        # The key does not depend on the instance, so it is generated while the
+        # instance is being looked up, unless a key pushed before might be
+        # reused. In that case, a new key is generated only when it is not.
+        key_future = None
+        if not key_cache.has_reusable_key(user, key_type, key_size):
+            key_future = executor.submit(
+                _timed, _generate_ssh_key, key_type, key_size, key_pool=key_pool
+            )
+
+        instance, profile, region = fetch_instance_details_from_config(
+            config, instance_name, profile_name, region_name
+        )
+
+        instance_details = resolve_instance(
+            instance,
+            profile,
+            region,
+            selection=selection,
+            availability_zone=availability_zone,
+            fallback_regions=fallback_regions,
+            profile_names=profile_names,
+            profile_preference=profile_preference,
+        )
+        if instance_details is None:
+            raise instance_not_found(instance, config)
+
+        instance_id = instance_details["instance_id"]
+        profile = instance_details.get("profile_name", profile)
+        region = instance_details.get("region_name", region)
+        ssm = get_aws_client("ssm", region_name=region, profile_name=profile)
+        ec2_ic = get_aws_client(
+            "ec2-instance-connect", region_name=region, profile_name=profile
+        )
+        lookup_time = time.monotonic() - setup_start
 
-    logger.info(
-        "Opening SSH session on instance %s (%s) via profile %s",
-        instance_id,
-        region,
-        profile,
-    )
-    if local_forward:  # pragma: no cover
-        logger.info("SSH session will do a local port forwarding: %s", local_forward)
-    if remote_forward:  # pragma: no cover
-        logger.info("SSH session will do a remote port forwarding: %s", remote_forward)
-    if dynamic_forward:  # pragma: no cover
         logger.info(
-            "SSH session will do a dynamic port forwarding: %s", dynamic_forward
+            "Opening SSH session on instance %s (%s) via profile %s",
+            instance_id,
+            region,
+            profile,
         )
-    with SshKey(key_type=key_type, key_size=key_size) as ssh_key:
-        with SshKeyUploader(
-            instance_id=instance_id, az=az, user=user, ssh_key=ssh_key, ec2_ic=ec2_ic
-        ):
-            with SshSession(
+        if local_forward:  # pragma: no cover
+            logger.info(
+                "SSH session will do a local port forwarding: %s", local_forward
+            )
+        if remote_forward:  # pragma: no cover
+            logger.info(
+                "SSH session will do a remote port forwarding: %s", remote_forward
+            )
+        if dynamic_forward:  # pragma: no cover
+            logger.info(
+                "SSH session will do a dynamic port forwarding: %s", dynamic_forward
+            )
+
+        with key_cache.lock(instance_id, user):
+            ssh_key, key_time = _get_ssh_key(
+                key_cache.get(instance_id, user, key_type, key_size),
+                key_future,
+                key_type,
+                key_size,
+                key_pool,
+            )
+            stack.push(ssh_key)
+
+            agent_socket = None
+            if ssh_agent:
+                agent_socket = _start_ssh_agent(stack, ssh_key)
+            else:
+                # The file is private to this session and ssh reads it only
+                # once the key is pushed
+                ssh_key.write_to_file()
+
+            ssh_session = SshSession(
                 instance_id,
                 region_name=region,
                 profile_name=profile,
@@ -195,5 +326,32 @@ def ssh(
                 local_forward=local_forward,
                 remote_forward=remote_forward,
                 dynamic_forward=dynamic_forward,
-            ) as ssh_session:
-                ssh_session.open()
+                key_path=ssh_key.key_path,
+                agent_socket=agent_socket,
+            )
+            # Starting the session does not depend on the key being pushed,
+            # both requests are sent at the same time
+            session_future = executor.submit(_timed, ssh_session.create)
+            stack.callback(_terminate_ssh_session, ssh_session, session_future)
+
+            _, upload_time = _timed(
+                SshKeyUploader(
+                    instance_id=instance_id,
+                    az=instance_details.get("availability_zone"),
+                    user=user,
+                    ssh_key=ssh_key,
+                    ec2_ic=ec2_ic,
+                    key_cache=key_cache,
+                ).upload
+            )
+
+        _, session_time = session_future.result()
+        _report_setup(
+            time.monotonic() - setup_start,
+            lookup=lookup_time,
+            key=key_time,
+            upload=upload_time,
+            session=session_time,
+        )
+
+        ssh_session.open()
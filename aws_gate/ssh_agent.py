@@ -0,0 +1,193 @@
+import base64
+import logging
+import os
+import shutil
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+
+from cryptography.hazmat.primitives import hashes
+
+from aws_gate.constants import EC2_IC_KEY_VALIDITY
+
+logger = logging.getLogger(__name__)
+
+# Minimal SSH agent serving the key of a single session, so that the key never
+# has to be written to disk. Only listing identities and signing is supported,
+# see draft-miller-ssh-agent for the protocol.
+SSH_AGENT_FAILURE = 5
+SSH_AGENTC_REQUEST_IDENTITIES = 11
+SSH_AGENT_IDENTITIES_ANSWER = 12
+SSH_AGENTC_SIGN_REQUEST = 13
+SSH_AGENT_SIGN_RESPONSE = 14
+
+SSH_AGENT_RSA_SHA2_256 = 2
+SSH_AGENT_RSA_SHA2_512 = 4
+
+# Largest message accepted, signed data are session identifiers and a few
+# names, far below that
+MAX_MESSAGE_SIZE = 256 * 1024
+
+
+def _pack_string(data):
+    return struct.pack(">I", len(data)) + data
+
+
+def _unpack_string(data, offset):
+    (length,) = struct.unpack_from(">I", data, offset)
+    offset += 4
+    if offset + length > len(data):
+        raise ValueError("Truncated string")
+    return data[offset : offset + length], offset + length
+
+
+def _get_signature_algorithm(key_type, flags):
+    if key_type == "ed25519":
+        return b"ssh-ed25519", None
+    if flags & SSH_AGENT_RSA_SHA2_512:
+        return b"rsa-sha2-512", hashes.SHA512()
+    if flags & SSH_AGENT_RSA_SHA2_256:
+        return b"rsa-sha2-256", hashes.SHA256()
+    return b"ssh-rsa", hashes.SHA1()  # nosec - requested by the client
+
+
+class SshAgentRequestHandler(socketserver.StreamRequestHandler):
+    def _receive(self):
+        header = self.rfile.read(4)
+        if not header:
+            return None
+
+        if len(header) < 4:
+            raise ValueError("Truncated message")
+
+        (length,) = struct.unpack(">I", header)
+        if not 0 < length <= MAX_MESSAGE_SIZE:
+            raise ValueError(f"Invalid message length: {length}")
+
+        message = self.rfile.read(length)
+        if len(message) < length:
+            raise ValueError("Truncated message")
+        return message
+
+    def handle(self):
+        while True:
+            try:
+                message = self._receive()
+                if message is None:
+                    return
+                response = self.server.agent.dispatch(message)
+                self.wfile.write(_pack_string(response))
+            except (OSError, ValueError, struct.error) as e:
+                logger.debug("SSH agent connection failed: %s", e)
+                return
+
+
+class SshAgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, agent):
+        # Only the user running aws-gate is allowed to talk to the agent
+        umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, SshAgentRequestHandler)
+        finally:
+            os.umask(umask)
+
+        self.agent = agent
+
+
+class SshAgent:
+    def __init__(self, ssh_key, lifetime=EC2_IC_KEY_VALIDITY):
+        self._ssh_key = ssh_key
+        self._key_blob = base64.b64decode(ssh_key.public_key.split()[1])
+        # EC2 Instance Connect drops the key after a while, so does the agent
+        self._lifetime = lifetime
+        self._expires = None
+        self._socket_dir = None
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def socket_path(self):
+        if self._socket_dir is None:
+            return None
+        return os.path.join(self._socket_dir, "agent.sock")
+
+    def start(self):
+        self._socket_dir = tempfile.mkdtemp(prefix="aws-gate-ssh-agent-")
+        self._server = SshAgentServer(self.socket_path, self)
+        self._expires = time.monotonic() + self._lifetime
+
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            kwargs={"poll_interval": 0.1},
+            name="aws-gate-ssh-agent",
+            daemon=True,
+        )
+        self._thread.start()
+        logger.debug("SSH agent listening on %s", self.socket_path)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+        if self._socket_dir is not None:
+            shutil.rmtree(self._socket_dir, ignore_errors=True)
+            self._socket_dir = None
+
+    def _is_expired(self):
+        return time.monotonic() >= self._expires
+
+    def _list_identities(self):
+        identities = []
+        if not self._is_expired():
+            identities.append(
+                _pack_string(self._key_blob) + _pack_string(b"aws-gate session key")
+            )
+
+        return (
+            bytes([SSH_AGENT_IDENTITIES_ANSWER])
+            + struct.pack(">I", len(identities))
+            + b"".join(identities)
+        )
+
+    def _sign(self, message):
+        key_blob, offset = _unpack_string(message, 1)
+        data, offset = _unpack_string(message, offset)
+        (flags,) = struct.unpack_from(">I", message, offset)
+
+        if key_blob != self._key_blob:
+            logger.debug("SSH agent asked to sign with unknown key")
+            return bytes([SSH_AGENT_FAILURE])
+        if self._is_expired():
+            logger.debug("SSH agent asked to sign with expired key")
+            return bytes([SSH_AGENT_FAILURE])
+
+        algorithm, hash_algorithm = _get_signature_algorithm(
+            self._ssh_key.key_type, flags
+        )
+        signature = _pack_string(algorithm) + _pack_string(
+            self._ssh_key.sign(data, hash_algorithm)
+        )
+        return bytes([SSH_AGENT_SIGN_RESPONSE]) + _pack_string(signature)
+
+    def dispatch(self, message):
+        if message[0] == SSH_AGENTC_REQUEST_IDENTITIES:
+            return self._list_identities()
+        if message[0] == SSH_AGENTC_SIGN_REQUEST:
+            return self._sign(message)
+
+        logger.debug("SSH agent request %s is not supported", message[0])
+        return bytes([SSH_AGENT_FAILURE])
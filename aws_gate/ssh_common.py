@@ -1,69 +1,460 @@
+import base64
+import contextlib
+import hashlib
+import json
 import logging
 import os
+import tempfile
+import threading
+import time
+import uuid
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa, ed25519
+from cryptography.hazmat.primitives.asymmetric import rsa, ed25519, padding
 
 from aws_gate.constants import (
-    DEFAULT_GATE_KEY_PATH,
+    DEFAULT_GATE_KEY_POOL_DIR,
+    DEFAULT_GATE_SESSION_KEY_DIR,
+    DEFAULT_GATE_SSH_KEY_CACHE_DIR,
     DEFAULT_KEY_SIZE,
+    KEY_POOL_SIZE,
+    KEY_POOL_TYPES,
     SUPPORTED_KEY_TYPES,
     DEFAULT_OS_USER,
+    EC2_IC_KEY_VALIDITY,
+    SSH_KEY_REUSE_TTL,
 )
+from aws_gate.query import (
+    EC2_IC_INSTANCE_GONE_ERRORS,
+    invalidate_cached_instance_on_error,
+)
+from aws_gate.utils import write_file_atomically
 
 logger = logging.getLogger(__name__)
 
 KEY_MIN_SIZE = DEFAULT_KEY_SIZE
 
 
+def _generate_private_key(key_type, key_size):
+    if key_type == "ed25519":
+        return ed25519.Ed25519PrivateKey.generate()
+
+    return rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=key_size,
+        backend=default_backend(),
+    )
+
+
+def _serialize_private_key(private_key):
+    return private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+
+def _load_private_key(data):
+    # Keys read back were generated by us, checking RSA keys would take almost
+    # as long as generating a new one
+    return serialization.load_pem_private_key(
+        data,
+        password=None,
+        backend=default_backend(),
+        unsafe_skip_rsa_key_validation=True,
+    )
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    # Locking is best effort, without fcntl (only available on POSIX platforms)
+    # or when the lock file cannot be created, we go on unlocked
+    try:
+        import fcntl  # pylint: disable=import-outside-toplevel
+
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        f = open(path, "ab")  # pylint: disable=consider-using-with
+    except (ImportError, OSError) as e:
+        logger.debug("Unable to lock %s: %s", path, e)
+        yield
+        return
+
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+class SshKeyPool:
+    # Key files are complete once they get the .pem suffix, writes go through
+    # temporary files renamed into place
+    KEY_SUFFIX = ".pem"
+
+    def __init__(self, pool_dir=None, size=None):
+        self._pool_dir = pool_dir or DEFAULT_GATE_KEY_POOL_DIR
+        self._size = size if size is not None else KEY_POOL_SIZE
+        self._lock = threading.Lock()
+        self._refilling = set()
+
+    def _get_path(self, key_type, key_size):
+        # Size of ed25519 keys is fixed, the requested one does not matter
+        name = key_type if key_type == "ed25519" else f"{key_type}-{key_size}"
+        return os.path.join(self._pool_dir, name)
+
+    def _list_keys(self, path):
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return []
+
+        return sorted(name for name in names if name.endswith(self.KEY_SUFFIX))
+
+    def take(self, key_type, key_size):
+        if self._size <= 0:
+            return None
+
+        path = self._get_path(key_type, key_size)
+        for name in self._list_keys(path):
+            key_path = os.path.join(path, name)
+            # Several aws-gate processes might be taking keys at once. Renaming
+            # is atomic, so only one of them gets the key.
+            claimed_path = f"{key_path}.{uuid.uuid4().hex}"
+            try:
+                os.rename(key_path, claimed_path)
+            except OSError:
+                continue
+
+            try:
+                with open(claimed_path, "rb") as f:
+                    data = f.read()
+            finally:
+                os.remove(claimed_path)
+
+            try:
+                private_key = _load_private_key(data)
+            except ValueError as e:
+                logger.debug("Skipping unreadable pooled SSH key %s: %s", key_path, e)
+                continue
+
+            logger.debug("Using pooled SSH key: %s", key_path)
+            return private_key
+
+        logger.debug("No pooled %s SSH key available", key_type)
+        return None
+
+    def refill(self, key_type, key_size):
+        if self._size <= 0:
+            return 0
+
+        path = self._get_path(key_type, key_size)
+        # Processes refilling the pool at once (e.g. ssh-proxy sessions opened
+        # by Ansible) take turns, so the keys are generated only once and the
+        # pool does not grow past its size
+        with _file_lock(f"{path}.lock"):
+            missing = self._size - len(self._list_keys(path))
+            for _ in range(missing):
+                private_key = _generate_private_key(key_type, key_size)
+                write_file_atomically(
+                    os.path.join(path, f"{uuid.uuid4().hex}{self.KEY_SUFFIX}"),
+                    _serialize_private_key(private_key),
+                )
+
+        return max(missing, 0)
+
+    def _refill_quietly(self, key_type, key_size):
+        try:
+            generated = self.refill(key_type, key_size)
+            logger.debug("Added %s %s SSH keys to the pool", generated, key_type)
+        except OSError as e:
+            logger.debug("Unable to refill SSH key pool: %s", e)
+        finally:
+            with self._lock:
+                self._refilling.discard((key_type, key_size))
+
+    def refill_in_background(self, key_type, key_size):
+        # Keys are generated while the connection is being set up, so the next
+        # one does not need to wait for them
+        if self._size <= 0:
+            return None
+
+        with self._lock:
+            if (key_type, key_size) in self._refilling:
+                return None
+            self._refilling.add((key_type, key_size))
+
+        thread = threading.Thread(
+            target=self._refill_quietly,
+            args=(key_type, key_size),
+            name="aws-gate-key-pool",
+            daemon=True,
+        )
+        thread.start()
+        return thread
+
+
+class SshKeyCache:
+    # Keys pushed via EC2 Instance Connect, so that follow-up connections to
+    # the same instance and user (e.g. scp, then ssh) skip both the key
+    # generation and the push. Every entry is a single file holding the key
+    # together with its expiry, written atomically.
+
+    def __init__(self, cache_dir=None, ttl=None):
+        self._cache_dir = cache_dir or DEFAULT_GATE_SSH_KEY_CACHE_DIR
+        self._ttl = min(
+            ttl if ttl is not None else SSH_KEY_REUSE_TTL, EC2_IC_KEY_VALIDITY
+        )
+
+    def _get_path(self, instance_id, user, suffix=".json"):
+        digest = hashlib.sha256(f"{instance_id}\0{user}".encode()).hexdigest()
+        return os.path.join(self._cache_dir, f"{digest}{suffix}")
+
+    @contextlib.contextmanager
+    def lock(self, instance_id, user):
+        # Concurrent sessions to the same instance and user wait for each other,
+        # so that the first one pushes a key and the others reuse it
+        with _file_lock(self._get_path(instance_id, user, suffix=".lock")):
+            yield
+
+    @staticmethod
+    def _load_entry(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        return entry if isinstance(entry, dict) else None
+
+    @staticmethod
+    def _is_valid(entry, now):
+        # Clock going backwards must not extend the validity either
+        try:
+            return (
+                entry["pushed"] <= now < entry["expires"]
+                and entry["expires"] - entry["pushed"] <= EC2_IC_KEY_VALIDITY
+            )
+        except (KeyError, TypeError):
+            return False
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _get_entry(self, instance_id, user):
+        if self._ttl <= 0:
+            return None
+
+        path = self._get_path(instance_id, user)
+        entry = self._load_entry(path)
+        if entry is None:
+            return None
+
+        if not self._is_valid(entry, time.time()):
+            self._remove(path)
+            return None
+
+        if entry.get("instance_id") != instance_id or entry.get("user") != user:
+            return None
+
+        return entry
+
+    def get(self, instance_id, user, key_type, key_size):
+        entry = self._get_entry(instance_id, user)
+        if entry is None or (entry.get("key_type"), entry.get("key_size")) != (
+            key_type,
+            key_size,
+        ):
+            return None
+
+        try:
+            private_key = _load_private_key(entry["private_key"].encode())
+        except (KeyError, AttributeError, ValueError):
+            return None
+
+        logger.debug(
+            "Reusing SSH key %s pushed to %s@%s %.0f seconds ago",
+            entry.get("fingerprint"),
+            user,
+            instance_id,
+            time.time() - entry["pushed"],
+        )
+        return private_key
+
+    def has_reusable_key(self, user, key_type, key_size):
+        # Tells, before the instance is known, whether a key pushed before
+        # might be reused, i.e. whether generating a new one might be wasted
+        if self._ttl <= 0:
+            return False
+
+        try:
+            names = os.listdir(self._cache_dir)
+        except OSError:
+            return False
+
+        now = time.time()
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+
+            entry = self._load_entry(os.path.join(self._cache_dir, name)) or {}
+            if self._is_valid(entry, now) and (
+                entry.get("user"),
+                entry.get("key_type"),
+                entry.get("key_size"),
+            ) == (user, key_type, key_size):
+                return True
+
+        return False
+
+    def is_pushed(self, instance_id, user, ssh_key):
+        entry = self._get_entry(instance_id, user)
+        return entry is not None and entry.get("fingerprint") == ssh_key.fingerprint
+
+    def _purge(self, now):
+        # Expired keys are useless, but there is no reason to keep them around
+        try:
+            names = os.listdir(self._cache_dir)
+        except OSError:
+            return
+
+        for name in names:
+            path = os.path.join(self._cache_dir, name)
+            if name.endswith(".json") and not self._is_valid(
+                self._load_entry(path) or {}, now
+            ):
+                self._remove(path)
+
+    def put(self, instance_id, user, ssh_key, pushed):
+        if self._ttl <= 0:
+            return
+
+        self._purge(time.time())
+        entry = {
+            "instance_id": instance_id,
+            "user": user,
+            "key_type": ssh_key.key_type,
+            "key_size": ssh_key.key_size,
+            "fingerprint": ssh_key.fingerprint,
+            "pushed": pushed,
+            "expires": pushed + self._ttl,
+            "private_key": ssh_key.private_key.decode(),
+        }
+        try:
+            write_file_atomically(
+                self._get_path(instance_id, user), json.dumps(entry).encode()
+            )
+        except OSError as e:
+            logger.debug("Unable to store pushed SSH key: %s", e)
+
+
+def _purge_session_keys(now):
+    # Key files outlive their sessions when aws-gate gets killed or when they
+    # are shared, but the keys are useless after EC2 Instance Connect drops them
+    try:
+        names = os.listdir(DEFAULT_GATE_SESSION_KEY_DIR)
+    except OSError:
+        return
+
+    for name in names:
+        path = os.path.join(DEFAULT_GATE_SESSION_KEY_DIR, name)
+        try:
+            if os.stat(path).st_mtime < now - EC2_IC_KEY_VALIDITY:
+                os.remove(path)
+        except OSError:
+            pass
+
+
 class SshKey:
     def __init__(
-        self, key_path=DEFAULT_GATE_KEY_PATH, key_type="rsa", key_size=KEY_MIN_SIZE
+        self,
+        key_path=None,
+        key_type="rsa",
+        key_size=KEY_MIN_SIZE,
+        key_pool=None,
+        private_key=None,
     ):
         self._key_path = None
         self._key_type = None
         self._key_size = None
         self._private_key = None
         self._public_key = None
+        self._key_pool = key_pool
+        # Key already pushed to the instance, used instead of a new one
+        self._reused_private_key = private_key
+        # Files at given paths might be shared by concurrent sessions (e.g. via
+        # ssh-config), other keys get a file of their own
+        self._shared = key_path is not None
 
-        self.key_path = key_path
+        if self._shared:
+            self.key_path = key_path
         self.key_type = key_type
         self.key_size = key_size
 
     def __enter__(self):
+        # The key file is written by write_to_file() once the key is pushed,
+        # so that ssh never reads a key unknown to the instance
         self.generate()
-        self.write_to_file()
         return self
 
     def __exit__(self, *args):
         self.delete()
 
     def _generate_key(self):
-        self._private_key = None
-
-        if self._key_type == "rsa":
-            self._private_key = rsa.generate_private_key(
-                public_exponent=65537,
-                key_size=self._key_size,
-                backend=default_backend(),
-            )
-        elif self._key_type == "ed25519":
-            self._private_key = ed25519.Ed25519PrivateKey.generate()
-
+        self._private_key = _generate_private_key(self._key_type, self._key_size)
         self._public_key = self._private_key.public_key()
 
     def generate(self):
+        if self._reused_private_key is not None:
+            self._private_key = self._reused_private_key
+            self._public_key = self._private_key.public_key()
+            return
+
+        if self._key_pool is not None and self._key_type in KEY_POOL_TYPES:
+            self._private_key = self._key_pool.take(self._key_type, self._key_size)
+            self._key_pool.refill_in_background(self._key_type, self._key_size)
+
+            if self._private_key is not None:
+                self._public_key = self._private_key.public_key()
+                return
+
         self._generate_key()
 
     def write_to_file(self):
-        with open(self._key_path, "wb") as f:
+        _purge_session_keys(time.time())
+
+        if self._shared:
+            # Other sessions might be reading the file at the same time
+            write_file_atomically(self._key_path, self.private_key)
+            return
+
+        os.makedirs(DEFAULT_GATE_SESSION_KEY_DIR, mode=0o700, exist_ok=True)
+        # The file is created exclusively and readable by us only, 'ssh' refuses
+        # to use the key with broad access permissions
+        fd, self._key_path = tempfile.mkstemp(
+            dir=DEFAULT_GATE_SESSION_KEY_DIR, prefix="key-"
+        )
+        with os.fdopen(fd, "wb") as f:
             f.write(self.private_key)
-        # 'ssh' refuses to use the key with broad access permissions
-        os.chmod(self._key_path, 0o600)
+
+    def sign(self, data, hash_algorithm=None):
+        # ed25519 signatures have no choice of hash algorithm
+        if self._key_type == "ed25519":
+            return self._private_key.sign(data)
+
+        return self._private_key.sign(data, padding.PKCS1v15(), hash_algorithm)
 
     def delete(self):
-        os.remove(self._key_path)
+        # Shared files are left to other sessions, until they expire
+        if self._shared or self._key_path is None:
+            return
+
+        try:
+            os.remove(self._key_path)
+        except FileNotFoundError:
+            pass
 
     @property
     def public_key(self):
@@ -72,13 +463,16 @@ class SshKey:
             format=serialization.PublicFormat.OpenSSH,
         )
 
+    @property
+    def fingerprint(self):
+        # Same format as 'ssh-keygen -l' prints
+        blob = base64.b64decode(self.public_key.split()[1])
+        digest = base64.b64encode(hashlib.sha256(blob).digest()).decode()
+        return f"SHA256:{digest.rstrip('=')}"
+
     @property
     def private_key(self):
-        return self._private_key.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=serialization.NoEncryption(),
-        )
+        return _serialize_private_key(self._private_key)
 
     @property
     def key_type(self):
@@ -114,14 +508,21 @@ class SshKey:
 
 
 class SshKeyUploader:
-    def __init__(
-        self, instance_id, az, user=DEFAULT_OS_USER, ssh_key=None, ec2_ic=None
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        instance_id,
+        az,
+        user=DEFAULT_OS_USER,
+        ssh_key=None,
+        ec2_ic=None,
+        key_cache=None,
     ):
         self._instance_id = instance_id
         self._az = az
         self._ssh_key = ssh_key
         self._ec2_ic = ec2_ic
         self._user = user
+        self._key_cache = key_cache
 
     def __enter__(self):
         self.upload()
@@ -131,15 +532,30 @@ class SshKeyUploader:
         pass
 
     def upload(self):
+        if self._key_cache is not None and self._key_cache.is_pushed(
+            self._instance_id, self._user, self._ssh_key
+        ):
+            logger.debug("SSH public key already pushed to %s", self._instance_id)
+            return
+
         logger.debug("Uploading SSH public key: %s", self._ssh_key.public_key.decode())
-        response = self._ec2_ic.send_ssh_public_key(
-            InstanceId=self._instance_id,
-            InstanceOSUser=self._user,
-            SSHPublicKey=str(self._ssh_key.public_key.decode()),
-            AvailabilityZone=self._az,
-        )
+        # Validity of the key starts before the request is sent, not when the
+        # response arrives
+        pushed = time.time()
+        with invalidate_cached_instance_on_error(
+            self._instance_id, EC2_IC_INSTANCE_GONE_ERRORS
+        ):
+            response = self._ec2_ic.send_ssh_public_key(
+                InstanceId=self._instance_id,
+                InstanceOSUser=self._user,
+                SSHPublicKey=str(self._ssh_key.public_key.decode()),
+                AvailabilityZone=self._az,
+            )
         logger.debug("Received response: %s", response)
         if not response["Success"]:
             raise ValueError(
                 f"Failed to upload SSH key to instance {self._instance_id}"
             )
+
+        if self._key_cache is not None:
+            self._key_cache.put(self._instance_id, self._user, self._ssh_key, pushed)
@@ -1,4 +1,5 @@
 import logging
+import os
 from collections import OrderedDict
 
 from aws_gate.constants import (
@@ -6,15 +7,20 @@ from aws_gate.constants import (
     AWS_DEFAULT_REGION,
     DEFAULT_SSH_PORT,
     DEFAULT_OS_USER,
-    DEFAULT_GATE_KEY_PATH,
+    DEFAULT_GATE_SESSION_KEY_DIR,
 )
 from aws_gate.decorators import valid_aws_region, valid_aws_profile
 
 logger = logging.getLogger(__name__)
 
+# Connections to the same host, user and port share the key file, ssh-proxy
+# makes sure that its content is always a valid key
+KEY_PATH = os.path.join(DEFAULT_GATE_SESSION_KEY_DIR, "%r@%h-%p")
+
 PROXY_COMMAND = [
     r"""sh -c "aws-gate ssh-proxy -p `echo %h | sed -Ee 's/^(.*)\.(.*)\.(.*)$/\\3/g'`""",
     r"""-r `echo %h | sed -Ee 's/^(.*)\.(.*)\.(.*)$/\\2/g'`""",
+    f"-l %r -P %p --key-path '{KEY_PATH}'",
     r'''`echo %h | sed -Ee 's/^(.*)\.(.*)\.(.*)$/\\1/g'`"''',
 ]
 
@@ -30,7 +36,7 @@ def ssh_config(
     config = OrderedDict(
         {
             "Host": f"*.{region_name}.{profile_name}",
-            "IdentityFile": DEFAULT_GATE_KEY_PATH,
+            "IdentityFile": KEY_PATH,
             "IdentitiesOnly": "yes",
             "User": user,
             "Port": port,
@@ -1,10 +1,13 @@
+import contextlib
 import logging
 
 from aws_gate.constants import (
     AWS_DEFAULT_PROFILE,
     AWS_DEFAULT_REGION,
+    DEFAULT_INSTANCE_SELECTION,
     DEFAULT_OS_USER,
     DEFAULT_SSH_PORT,
+    DEFAULT_GATE_KEY_PATH,
     DEFAULT_KEY_ALGORITHM,
     DEFAULT_KEY_SIZE,
 )
@@ -14,15 +17,11 @@ from aws_gate.decorators import (
     valid_aws_profile,
     valid_aws_region,
 )
-from aws_gate.query import query_instance
+from aws_gate.names import instance_not_found
+from aws_gate.query import resolve_instance
 from aws_gate.session_common import BaseSession
-from aws_gate.ssh_common import SshKey, SshKeyUploader
-from aws_gate.utils import (
-    get_aws_client,
-    get_aws_resource,
-    fetch_instance_details_from_config,
-    get_instance_details,
-)
+from aws_gate.ssh_common import SshKey, SshKeyCache, SshKeyPool, SshKeyUploader
+from aws_gate.utils import get_aws_client, fetch_instance_details_from_config
 
 logger = logging.getLogger(__name__)
 
@@ -64,39 +63,76 @@ def ssh_proxy(
     key_size=DEFAULT_KEY_SIZE,
     profile_name=AWS_DEFAULT_PROFILE,
     region_name=AWS_DEFAULT_REGION,
+    selection=DEFAULT_INSTANCE_SELECTION,
+    availability_zone=None,
+    fallback_regions=None,
+    key_path=None,
 ):
     instance, profile, region = fetch_instance_details_from_config(
         config, instance_name, profile_name, region_name
     )
 
+    instance_details = resolve_instance(
+        instance,
+        profile,
+        region,
+        selection=selection,
+        availability_zone=availability_zone,
+        fallback_regions=fallback_regions,
+    )
+    if instance_details is None:
+        raise instance_not_found(instance, config)
+
+    instance_id = instance_details["instance_id"]
+    region = instance_details.get("region_name", region)
     ssm = get_aws_client("ssm", region_name=region, profile_name=profile)
-    ec2 = get_aws_resource("ec2", region_name=region, profile_name=profile)
     ec2_ic = get_aws_client(
         "ec2-instance-connect", region_name=region, profile_name=profile
     )
 
-    instance_id = query_instance(name=instance, ec2=ec2)
-    if instance_id is None:
-        raise ValueError(f"No instance could be found for name: {instance}")
-
-    az = get_instance_details(instance_id=instance_id, ec2=ec2)["availability_zone"]
-
     logger.info(
         "Opening SSH proxy session on instance %s (%s) via profile %s",
         instance_id,
         region,
         profile,
     )
-    with SshKey(key_type=key_type, key_size=key_size) as ssh_key:
-        with SshKeyUploader(
-            instance_id=instance_id, az=az, user=user, ssh_key=ssh_key, ec2_ic=ec2_ic
-        ):
-            with SshProxySession(
-                instance_id,
-                region_name=region,
-                profile_name=profile,
-                ssm=ssm,
-                port=port,
-                user=user,
-            ) as ssh_proxy_session:
-                ssh_proxy_session.open()
+    # ssh has to find the key in a file it knows in advance, so it is never
+    # written to a file of its own like the keys of ssh sessions
+    if key_path is None:
+        key_path = DEFAULT_GATE_KEY_PATH
+
+    key_cache = SshKeyCache()
+    with contextlib.ExitStack() as stack:
+        # The key is pushed under a lock, so that sessions opened at once (e.g.
+        # by Ansible via ssh-config) share a single push and key file
+        with key_cache.lock(instance_id, user):
+            ssh_key = stack.enter_context(
+                SshKey(
+                    key_path=key_path,
+                    key_type=key_type,
+                    key_size=key_size,
+                    key_pool=SshKeyPool(),
+                    private_key=key_cache.get(instance_id, user, key_type, key_size),
+                )
+            )
+            stack.enter_context(
+                SshKeyUploader(
+                    instance_id=instance_id,
+                    az=instance_details.get("availability_zone"),
+                    user=user,
+                    ssh_key=ssh_key,
+                    ec2_ic=ec2_ic,
+                    key_cache=key_cache,
+                )
+            )
+            ssh_key.write_to_file()
+
+        with SshProxySession(
+            instance_id,
+            region_name=region,
+            profile_name=profile,
+            ssm=ssm,
+            port=port,
+            user=user,
+        ) as ssh_proxy_session:
+            ssh_proxy_session.open()
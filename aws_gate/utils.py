@@ -1,52 +1,28 @@
+import collections
 import contextlib
 import errno
 import logging
 import os
 import signal
 import subprocess
-
-import boto3
-import botocore
-from botocore import credentials
+import tempfile
+import threading
 
 from aws_gate import __version__
-from aws_gate.constants import DEFAULT_GATE_BIN_PATH, PLUGIN_NAME
+from aws_gate.constants import AWS_REGIONS, DEFAULT_GATE_BIN_PATH, PLUGIN_NAME
 from aws_gate.exceptions import AWSConnectionError
 
 logger = logging.getLogger(__name__)
 
-# This list is maintained by hand as new regions are not added that often. This should be
-# removed once, we find a better way how to obtain region list without the need to
-# contact AWS EC2 API
-AWS_REGIONS = [
-    "af-south-1",
-    "ap-east-1",
-    "ap-northeast-1",
-    "ap-northeast-2",
-    "ap-south-1",
-    "ap-southeast-1",
-    "ap-southeast-2",
-    "ca-central-1",
-    "cn-north-1",
-    "cn-northwest-1",
-    "eu-central-1",
-    "eu-north-1",
-    "eu-south-1",
-    "eu-west-1",
-    "eu-west-2",
-    "eu-west-3",
-    "me-south-1",
-    "sa-east-1",
-    "us-east-1",
-    "us-east-2",
-    "us-gov-east-1",
-    "us-gov-west-1",
-    "us-west-1",
-    "us-west-2",
-]
+# boto3 and botocore are imported only when they are needed, as they are expensive
+# to import and there are code paths (e.g. bootstrap) which do not need them at all
+# pylint: disable=import-outside-toplevel
 
 
 def _create_aws_session(region_name=None, profile_name=None):
+    import boto3
+    from botocore import credentials
+
     logger.debug("Obtaining boto3 session object")
     kwargs = {}
     if region_name is not None:
@@ -77,22 +53,79 @@ def _create_aws_session(region_name=None, profile_name=None):
     return session
 
 
-def get_aws_client(service_name, region_name, profile_name=None):
-    session = _create_aws_session(region_name=region_name, profile_name=profile_name)
+# Creating a boto3 session is expensive: botocore has to read the configuration
+# files, resolve credentials and load endpoint and service model data. Sessions
+# are therefore shared per AWS profile for the lifetime of the process and clients
+# and resources are shared per (profile, region, service). Sessions are not
+# thread-safe, so everything is guarded by a single lock.
+_AWS_SESSIONS = {}
+_AWS_CLIENTS = {}
+_AWS_CACHE_LOCK = threading.RLock()
+_AWS_CACHE_STATS = collections.Counter()
+
+
+def get_aws_session(profile_name=None):
+    with _AWS_CACHE_LOCK:
+        if profile_name not in _AWS_SESSIONS:
+            _AWS_SESSIONS[profile_name] = _create_aws_session(profile_name=profile_name)
+            _AWS_CACHE_STATS["sessions"] += 1
+            logger.debug(
+                "Created boto3 session for profile %s (sessions created: %s)",
+                profile_name,
+                _AWS_CACHE_STATS["sessions"],
+            )
+
+        return _AWS_SESSIONS[profile_name]
+
+
+def _get_aws_service(kind, service_name, region_name, profile_name):
+    key = (kind, profile_name, region_name, service_name)
+    with _AWS_CACHE_LOCK:
+        if key not in _AWS_CLIENTS:
+            session = get_aws_session(profile_name=profile_name)
+            factory = session.client if kind == "client" else session.resource
+            _AWS_CLIENTS[key] = factory(
+                service_name=service_name, region_name=region_name
+            )
+            _AWS_CACHE_STATS[f"{kind}s"] += 1
+            logger.debug(
+                "Created %s %s in %s (%ss created: %s)",
+                service_name,
+                kind,
+                region_name,
+                kind,
+                _AWS_CACHE_STATS[f"{kind}s"],
+            )
+
+        return _AWS_CLIENTS[key]
 
-    logger.debug("Obtaining %s client", service_name)
-    return session.client(service_name=service_name)
+
+def get_aws_client(service_name, region_name, profile_name=None):
+    return _get_aws_service("client", service_name, region_name, profile_name)
 
 
 def get_aws_resource(service_name, region_name, profile_name=None):
-    session = _create_aws_session(region_name=region_name, profile_name=profile_name)
+    return _get_aws_service("resource", service_name, region_name, profile_name)
 
-    logger.debug("Obtaining %s boto3 resource", service_name)
-    return session.resource(service_name=service_name)
+
+def get_aws_cache_stats():
+    with _AWS_CACHE_LOCK:
+        return {
+            "sessions": _AWS_CACHE_STATS["sessions"],
+            "clients": _AWS_CACHE_STATS["clients"],
+            "resources": _AWS_CACHE_STATS["resources"],
+        }
+
+
+def clear_aws_cache():
+    with _AWS_CACHE_LOCK:
+        _AWS_SESSIONS.clear()
+        _AWS_CLIENTS.clear()
+        _AWS_CACHE_STATS.clear()
 
 
 def is_existing_profile(profile_name):
-    session = _create_aws_session()
+    session = get_aws_session()
 
     logger.debug(
         "Obtained configured AWS profiles: %s", " ".join(session.available_profiles)
@@ -100,12 +133,16 @@ def is_existing_profile(profile_name):
     return profile_name in session.available_profiles
 
 
+def get_aws_profiles():
+    return get_aws_session().available_profiles
+
+
 def is_existing_region(region_name):
     return region_name in AWS_REGIONS
 
 
 def get_default_region():
-    session = _create_aws_session()
+    session = get_aws_session()
 
     return session.region_name
 
@@ -132,7 +169,48 @@ def deferred_signals(signal_list=None):
             signal.signal(deferred_signal, signal.SIG_DFL)
 
 
+def write_file_atomically(path, data, mode=0o600):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    # Concurrent aws-gate processes might be writing the same file, so we write
+    # to a temporary file first and then atomically move it into place
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+# Processes which need the user's terminal (session-manager-plugin, ssh) have to
+# be spawned by the client process when subcommands run inside aws-gate agent.
+# The agent registers an executor for the thread serving the client, which takes
+# over execute() and execute_plugin().
+_EXECUTION_CONTEXT = threading.local()
+
+
+@contextlib.contextmanager
+def redirected_execution(executor):
+    _EXECUTION_CONTEXT.executor = executor
+    try:
+        yield
+    finally:
+        _EXECUTION_CONTEXT.executor = None
+
+
+def _get_executor():
+    return getattr(_EXECUTION_CONTEXT, "executor", None)
+
+
 def execute(cmd, args, **kwargs):
+    executor = _get_executor()
+    if executor is not None:
+        return executor(cmd, args, plugin=False, **kwargs)
+
     ret, result = None, None
 
     env_path = DEFAULT_GATE_BIN_PATH + os.pathsep + os.environ["PATH"]
@@ -158,6 +236,10 @@ def execute(cmd, args, **kwargs):
 
 
 def execute_plugin(args, **kwargs):
+    executor = _get_executor()
+    if executor is not None:
+        return executor(PLUGIN_NAME, args, plugin=True, **kwargs)
+
     with deferred_signals():
         return execute(PLUGIN_NAME, args, **kwargs)
 
@@ -195,35 +277,39 @@ def fetch_instance_details_from_config(
     return instance, profile, region
 
 
+def build_instance_details(instance):
+    instance_name = None
+    for tag in instance.get("Tags", []):
+        if tag["Key"] == "Name":
+            instance_name = tag["Value"]
+            break
+
+    return {
+        "instance_id": instance["InstanceId"],
+        "instance_name": instance_name,
+        "availability_zone": instance["Placement"]["AvailabilityZone"],
+        "vpc_id": instance.get("VpcId"),
+        "private_ip_address": instance.get("PrivateIpAddress") or None,
+        "public_ip_address": instance.get("PublicIpAddress") or None,
+        "private_dns_name": instance.get("PrivateDnsName") or None,
+        "public_dns_name": instance.get("PublicDnsName") or None,
+    }
+
+
 def get_instance_details(instance_id, ec2=None):
     return get_multiple_instance_details(instance_ids=[instance_id], ec2=ec2)[0]
 
 
 def get_multiple_instance_details(instance_ids, ec2=None):
+    import botocore.exceptions
+
+    paginator = ec2.meta.client.get_paginator("describe_instances")
     try:
-        ec2_instances = list(ec2.instances.filter(InstanceIds=instance_ids))
+        return [
+            build_instance_details(instance)
+            for instance in paginator.paginate(InstanceIds=instance_ids).search(
+                "Reservations[].Instances[]"
+            )
+        ]
     except botocore.exceptions.ClientError as e:
         raise AWSConnectionError(e)
-
-    instance_details = []
-    for ec2_instance in ec2_instances:
-        instance_name = None
-        for tag in ec2_instance.tags:
-            if tag["Key"] == "Name":
-                instance_name = tag["Value"]
-                break
-
-        instance_details.append(
-            {
-                "instance_id": ec2_instance.id,
-                "instance_name": instance_name,
-                "availability_zone": ec2_instance.placement["AvailabilityZone"],
-                "vpc_id": ec2_instance.vpc_id,
-                "private_ip_address": ec2_instance.private_ip_address or None,
-                "public_ip_address": ec2_instance.public_ip_address or None,
-                "private_dns_name": ec2_instance.private_dns_name or None,
-                "public_dns_name": ec2_instance.public_dns_name or None,
-            }
-        )
-
-    return instance_details
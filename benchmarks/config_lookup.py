@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Benchmark host alias lookups in GateConfig over a large synthetic configuration."""
+
+import argparse
+import random
+import timeit
+
+from aws_gate.config import GateConfig
+
+
+def _linear_get_host(hosts, name):
+    # Lookup as it was implemented before aliases were indexed
+    host = [host for host in hosts if host["alias"] == name]
+    if host:
+        return host[0]
+    return {}
+
+
+def _synthetic_hosts(aliases, patterns):
+    hosts = [
+        {
+            "alias": f"host-{i}",
+            "name": f"host-{i}",
+            "profile": "default",
+            "region": "eu-west-1",
+        }
+        for i in range(aliases)
+    ]
+    hosts += [
+        {
+            "alias": f"group-{i}-*",
+            "name": f"group-{i}-*",
+            "profile": "default",
+            "region": "eu-west-1",
+        }
+        for i in range(patterns)
+    ]
+    return hosts
+
+
+def _report(label, number, seconds):
+    print(f"{label:<40} {seconds / number * 1e6:>12.2f} us/op")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--aliases", type=int, default=10000)
+    parser.add_argument("--patterns", type=int, default=1000)
+    parser.add_argument("--number", type=int, default=1000)
+    args = parser.parse_args()
+
+    hosts = _synthetic_hosts(args.aliases, args.patterns)
+    names = [f"host-{random.randrange(args.aliases)}" for _ in range(args.number)]
+    pattern_names = [
+        f"group-{random.randrange(args.patterns)}-web" for _ in range(args.number)
+    ]
+
+    print(f"{args.aliases} aliases, {args.patterns} patterns")
+
+    seconds = timeit.timeit(lambda: GateConfig(defaults={}, hosts=hosts), number=10)
+    _report("build index", 10, seconds)
+
+    config = GateConfig(defaults={}, hosts=hosts)
+
+    seconds = timeit.timeit(
+        lambda: [_linear_get_host(hosts, name) for name in names], number=1
+    )
+    _report("exact lookup (linear scan)", args.number, seconds)
+
+    seconds = timeit.timeit(lambda: [config.get_host(name) for name in names], number=1)
+    _report("exact lookup (index)", args.number, seconds)
+
+    # Patterns are compiled on the first lookup falling back to them
+    seconds = timeit.timeit(lambda: config.get_host(pattern_names[0]), number=1)
+    _report("first pattern lookup", 1, seconds)
+
+    seconds = timeit.timeit(
+        lambda: [config.get_host(name) for name in pattern_names], number=1
+    )
+    _report("pattern lookup", args.number, seconds)
+
+    seconds = timeit.timeit(
+        lambda: [config.get_host("unknown") for _ in range(args.number)], number=1
+    )
+    _report("miss", args.number, seconds)
+
+
+if __name__ == "__main__":
+    main()
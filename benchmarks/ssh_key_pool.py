@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Benchmark SSH key setup on the connect path with and without the key pool."""
+
+import argparse
+import os
+import tempfile
+import time
+
+from aws_gate.constants import DEFAULT_KEY_SIZE, SUPPORTED_KEY_TYPES
+from aws_gate.ssh_common import SshKey, SshKeyPool
+
+
+def _connect(key_path, key_type, key_size, key_pool=None):
+    # Everything ssh and ssh-proxy do with the key before talking to AWS
+    with SshKey(
+        key_path=key_path, key_type=key_type, key_size=key_size, key_pool=key_pool
+    ) as ssh_key:
+        ssh_key.write_to_file()
+        return ssh_key.public_key
+
+
+def _measure(number, func, *func_args, **func_kwargs):
+    start = time.perf_counter()
+    for _ in range(number):
+        func(*func_args, **func_kwargs)
+    return time.perf_counter() - start
+
+
+def _report(label, number, seconds):
+    print(f"{label:<40} {seconds / number * 1e3:>12.2f} ms/op")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--key-size", type=int, default=DEFAULT_KEY_SIZE)
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        key_path = os.path.join(tmp_dir, "key")
+
+        for key_type in SUPPORTED_KEY_TYPES:
+            seconds = _measure(args.number, _connect, key_path, key_type, args.key_size)
+            _report(f"{key_type} connect (no pool)", args.number, seconds)
+
+            pool = SshKeyPool(pool_dir=os.path.join(tmp_dir, "keys"), size=args.number)
+            # Refill happens in the background while connecting, its cost is
+            # reported separately
+            pool.refill_in_background = lambda *_: None
+
+            seconds = _measure(1, pool.refill, key_type, args.key_size)
+            _report(f"{key_type} refill (background)", args.number, seconds)
+
+            seconds = _measure(
+                args.number, _connect, key_path, key_type, args.key_size, key_pool=pool
+            )
+            _report(f"{key_type} connect (pool)", args.number, seconds)
+
+            # Taking keys directly, including the types SshKey never pools
+            pool.refill(key_type, args.key_size)
+            seconds = _measure(args.number, pool.take, key_type, args.key_size)
+            _report(f"{key_type} take from pool", args.number, seconds)
+
+
+if __name__ == "__main__":
+    main()
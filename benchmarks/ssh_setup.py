@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""Benchmark SSH session setup with simulated AWS API latencies."""
+
+import argparse
+import inspect
+import os
+import tempfile
+import time
+from unittest import mock
+
+import aws_gate.ssh
+import aws_gate.ssh_common
+
+
+class _Client:
+    # Stand-in for SSM and EC2 Instance Connect clients answering after a delay
+    def __init__(self, latency):
+        self._latency = latency
+        self.meta = mock.Mock(endpoint_url="https://ssm.eu-west-1.amazonaws.com")
+
+    def start_session(self, **_):
+        time.sleep(self._latency)
+        return {"SessionId": "session-1", "TokenValue": "token"}
+
+    def terminate_session(self, **_):
+        return {}
+
+    def send_ssh_public_key(self, **_):
+        time.sleep(self._latency)
+        return {"Success": True}
+
+
+def _query_instance_details(latency):
+    def query_instance_details(**_):
+        time.sleep(latency)
+        return {"instance_id": "i-0123456789abcdef0", "availability_zone": "a"}
+
+    return query_instance_details
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--key-type", default="rsa")
+    parser.add_argument("--key-size", type=int, default=2048)
+    parser.add_argument("--lookup-latency", type=float, default=0.15)
+    parser.add_argument("--api-latency", type=float, default=0.1)
+    parser.add_argument("--number", type=int, default=10)
+    args = parser.parse_args()
+
+    reports = []
+    ssh = inspect.unwrap(aws_gate.ssh.ssh)
+
+    with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.multiple(
+        aws_gate.ssh,
+        get_aws_client=mock.Mock(return_value=_Client(args.api_latency)),
+        get_aws_resource=mock.Mock(),
+        query_instance_details=_query_instance_details(args.lookup_latency),
+        execute=mock.Mock(),
+        _report_setup=lambda elapsed, **steps: reports.append((elapsed, steps)),
+    ), mock.patch.multiple(
+        aws_gate.ssh_common,
+        DEFAULT_GATE_KEY_POOL_DIR=os.path.join(tmp_dir, "pool"),
+        DEFAULT_GATE_SESSION_KEY_DIR=os.path.join(tmp_dir, "sessions"),
+        DEFAULT_GATE_SSH_KEY_CACHE_DIR=os.path.join(tmp_dir, "ssh-keys"),
+        KEY_POOL_SIZE=0,
+        SSH_KEY_REUSE_TTL=0,
+    ):
+        for _ in range(args.number):
+            ssh(
+                config=mock.Mock(get_host=mock.Mock(return_value={})),
+                instance_name="i-0123456789abcdef0",
+                key_type=args.key_type,
+                key_size=args.key_size,
+            )
+
+    for step in reports[0][1]:
+        seconds = sum(steps[step] for _, steps in reports)
+        print(f"{step:<40} {seconds / args.number * 1e3:>12.2f} ms/op")
+
+    elapsed = sum(elapsed for elapsed, _ in reports)
+    sequential = sum(sum(steps.values()) for _, steps in reports)
+    print(f"{'setup (sequential)':<40} {sequential / args.number * 1e3:>12.2f} ms/op")
+    print(f"{'setup (pipelined)':<40} {elapsed / args.number * 1e3:>12.2f} ms/op")
+    print(
+        f"{'critical path saved':<40} "
+        f"{(sequential - elapsed) / args.number * 1e3:>12.2f} ms/op"
+    )
+
+
+if __name__ == "__main__":
+    main()
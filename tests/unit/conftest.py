@@ -1,8 +1,69 @@
 import os
 
 import boto3
-import placebo
 import pytest
+import placebo
+
+from aws_gate.utils import clear_aws_cache
+
+
+@pytest.fixture(autouse=True)
+def aws_cache():
+    # Sessions and clients are memoized process-wide, make sure that mocked
+    # objects do not leak between tests
+    clear_aws_cache()
+    yield
+    clear_aws_cache()
+
+
+@pytest.fixture(autouse=True)
+def gate_cache_dir(tmp_path, monkeypatch):
+    # Never read or write caches in the home directory of the user running tests
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setattr(
+        "aws_gate.config.DEFAULT_GATE_CONFIG_CACHE_PATH",
+        str(cache_dir / "config.json"),
+    )
+    monkeypatch.setattr(
+        "aws_gate.decorators.DEFAULT_GATE_PLUGIN_VERSION_CACHE_PATH",
+        str(cache_dir / "plugin-version.json"),
+    )
+    monkeypatch.setattr(
+        "aws_gate.query.DEFAULT_GATE_INSTANCE_CACHE_PATH",
+        str(cache_dir / "instances.json"),
+    )
+    monkeypatch.setattr(
+        "aws_gate.inventory.DEFAULT_GATE_INVENTORY_PATH",
+        str(cache_dir / "inventory.db"),
+    )
+    monkeypatch.setattr(
+        "aws_gate.completion.DEFAULT_GATE_COMPLETION_DIR", str(cache_dir / "completion")
+    )
+    monkeypatch.setattr(
+        "aws_gate.completion.DEFAULT_GATE_CONFIG_PATH", str(tmp_path / "config")
+    )
+    monkeypatch.setattr(
+        "aws_gate.completion.DEFAULT_GATE_CONFIGD_PATH", str(tmp_path / "config.d")
+    )
+    monkeypatch.setattr(
+        "aws_gate.ssh_common.DEFAULT_GATE_KEY_POOL_DIR", str(tmp_path / "keys")
+    )
+    monkeypatch.setattr(
+        "aws_gate.ssh_common.DEFAULT_GATE_SESSION_KEY_DIR", str(tmp_path / "sessions")
+    )
+    monkeypatch.setattr(
+        "aws_gate.ssh_proxy.DEFAULT_GATE_KEY_PATH", str(tmp_path / "key")
+    )
+    monkeypatch.setattr(
+        "aws_gate.ssh_common.DEFAULT_GATE_SSH_KEY_CACHE_DIR",
+        str(cache_dir / "ssh-keys"),
+    )
+    monkeypatch.setattr("aws_gate.decorators._PLUGIN_PATH_CACHE", {})
+    # ...nor talk to an aws-gate agent the user might be running
+    monkeypatch.setattr(
+        "aws_gate.agent.DEFAULT_GATE_AGENT_SOCKET_PATH", str(tmp_path / "agent.sock")
+    )
+    return cache_dir
 
 
 @pytest.fixture(name="session")
@@ -32,8 +93,8 @@ def placebo_session(request):
     return session
 
 
-@pytest.fixture
-def ec2(session):
+@pytest.fixture(name="ec2")
+def ec2_resource(session):
     return session.resource("ec2", region_name="eu-west-1")
 
 
@@ -85,7 +146,7 @@ def ssh_key(mocker):
     mock.configure_mock(
         **{
             "public_key.return_value": "ssh-rsa ranodombase64string",
-            "key_path.return_value": "/home/user/.aws-gate/key",
+            "key_path.return_value": "/home/user/.aws-gate/keys/sessions/key-1",
         }
     )
 
@@ -118,5 +179,11 @@ def empty_config(mocker):
 
 
 @pytest.fixture
-def get_instance_details_response():
-    return {"availability_zone": "eu-west-1a"}
+def ec2_api_calls(ec2):
+    calls = []
+    ec2.meta.client.meta.events.register(
+        "before-parameter-build.ec2.*",
+        lambda model, **kwargs: calls.append(model.name),
+        unique_id="ec2-api-calls",
+    )
+    return calls
@@ -0,0 +1,262 @@
+import argparse
+import logging
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+from aws_gate.agent import (
+    _CLIENT,
+    AgentServer,
+    _ClientLogHandler,
+    _ClientStream,
+    _attach_client_logging,
+    _receive,
+    _send,
+    agent,
+    run_in_agent,
+)
+from aws_gate.exceptions import AgentError
+from aws_gate.utils import execute, execute_plugin
+
+
+@pytest.fixture(name="socket_path")
+def socket_path_fixture(tmp_path):
+    return str(tmp_path / "agent.sock")
+
+
+@pytest.fixture(name="agent_server")
+def agent_server_fixture(socket_path):
+    server = AgentServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def _args(subcommand="session", **kwargs):
+    return argparse.Namespace(subcommand=subcommand, verbose=False, **kwargs)
+
+
+def test_run_in_agent_without_agent(socket_path):
+    assert not run_in_agent(_args(), socket_path=socket_path)
+
+
+def test_run_in_agent_without_unix_sockets(mocker, socket_path):
+    mocker.patch("aws_gate.agent.HAS_UNIX_SOCKETS", False)
+    connect_mock = mocker.patch("aws_gate.agent._connect")
+
+    assert not run_in_agent(_args(), socket_path=socket_path)
+    assert not connect_mock.called
+
+
+def test_run_in_agent_stale_socket(socket_path):
+    with open(socket_path, "w"):
+        pass
+
+    assert not run_in_agent(_args(), socket_path=socket_path)
+
+
+@pytest.mark.usefixtures("agent_server")
+def test_run_in_agent(mocker, socket_path, capsys, caplog):
+    client_thread = threading.current_thread()
+    agent_threads = []
+
+    def _run_subcommand(args):
+        agent_threads.append(threading.current_thread())
+        logging.getLogger("aws_gate.session").info("Opening session")
+        print(f"instance {args.instance_name}")
+        sys.stderr.write("note\n")
+        return execute("ssh", ["-V"])
+
+    mocker.patch("aws_gate.cli.run_subcommand", side_effect=_run_subcommand)
+    mocker.patch("sys.stdout", _ClientStream(sys.stdout))
+    mocker.patch("sys.stderr", _ClientStream(sys.stderr, name="stderr"))
+    run_mock = mocker.patch(
+        "aws_gate.utils.subprocess.run",
+        return_value=mocker.MagicMock(stdout=b"OpenSSH"),
+    )
+    caplog.set_level(logging.INFO)
+    handler = _ClientLogHandler()
+    logging.getLogger("aws_gate.session").addHandler(handler)
+
+    try:
+        assert run_in_agent(
+            _args(instance_name="foo"), log_level=logging.INFO, socket_path=socket_path
+        )
+    finally:
+        logging.getLogger("aws_gate.session").removeHandler(handler)
+
+    assert agent_threads and agent_threads[0] is not client_thread
+    assert run_mock.call_args[0][0] == ["ssh", "-V"]
+    assert capsys.readouterr() == ("instance foo\n", "note\n")
+    assert [
+        r.getMessage() for r in caplog.records if r.thread == client_thread.ident
+    ] == ["Opening session"]
+
+
+@pytest.mark.usefixtures("agent_server")
+def test_run_in_agent_plugin(mocker, socket_path):
+    mocker.patch(
+        "aws_gate.cli.run_subcommand",
+        side_effect=lambda args: execute_plugin(["--version"]),
+    )
+    m = mocker.patch("aws_gate.agent.execute_plugin", return_value="1.2.7.0")
+
+    assert run_in_agent(_args(), socket_path=socket_path)
+    assert m.call_args == mocker.call(["--version"])
+
+
+@pytest.mark.usefixtures("agent_server")
+def test_run_in_agent_execute_error(mocker, socket_path):
+    mocker.patch(
+        "aws_gate.cli.run_subcommand", side_effect=lambda args: execute("foo", [])
+    )
+    mocker.patch("aws_gate.agent.execute", side_effect=ValueError("foo not found"))
+
+    with pytest.raises(AgentError, match="foo not found"):
+        run_in_agent(_args(), socket_path=socket_path)
+
+
+@pytest.mark.usefixtures("agent_server")
+def test_run_in_agent_error(mocker, socket_path):
+    mocker.patch(
+        "aws_gate.cli.run_subcommand",
+        side_effect=ValueError("No instance could be found for name: foo"),
+    )
+
+    with pytest.raises(AgentError, match="No instance could be found"):
+        run_in_agent(_args(), socket_path=socket_path)
+
+
+@pytest.mark.usefixtures("agent_server")
+def test_run_in_agent_client_disconnected(mocker, socket_path):
+    mocker.patch("aws_gate.cli.run_subcommand", side_effect=ConnectionError)
+
+    with pytest.raises(ConnectionError):
+        run_in_agent(_args(), socket_path=socket_path)
+
+
+@pytest.mark.parametrize(
+    "args, env",
+    [
+        (_args(subcommand="bootstrap"), {}),
+        (_args(), {"AWS_PROFILE": "other-profile"}),
+    ],
+    ids=["subcommand", "environment"],
+)
+@pytest.mark.usefixtures("agent_server")
+def test_run_in_agent_fallback(mocker, socket_path, args, env):
+    m = mocker.patch("aws_gate.cli.run_subcommand")
+    mocker.patch("aws_gate.agent._aws_environment", side_effect=[env, {}])
+
+    assert not run_in_agent(args, socket_path=socket_path)
+    assert not m.called
+
+
+@pytest.mark.usefixtures("agent_server")
+def test_agent_version_mismatch(mocker, socket_path):
+    m = mocker.patch("aws_gate.cli.run_subcommand")
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile("rwb") as f:
+            _send(f, {"type": "run", "version": "0.0.1", "args": vars(_args())})
+            response = _receive(f)
+
+    assert response["type"] == "fallback"
+    assert not m.called
+
+
+@pytest.mark.usefixtures("agent_server")
+def test_agent_already_running(socket_path):
+    with pytest.raises(ValueError):
+        AgentServer(socket_path)
+
+
+def test_agent_removes_stale_socket(socket_path):
+    with open(socket_path, "w"):
+        pass
+
+    server = AgentServer(socket_path)
+    server.server_close()
+
+    assert not os.path.exists(socket_path)
+
+
+def test_agent_server_close_unlink_error(mocker, socket_path):
+    server = AgentServer(socket_path)
+    mocker.patch("aws_gate.agent.os.unlink", side_effect=PermissionError)
+
+    with pytest.raises(PermissionError):
+        server.server_close()
+
+
+@pytest.mark.usefixtures("agent_server")
+def test_agent_socket_permissions(socket_path):
+    assert os.stat(socket_path).st_mode & 0o777 == 0o600
+
+
+def test_agent(mocker, socket_path):
+    server_mock = mocker.patch("aws_gate.agent.AgentServer")
+    server_mock.return_value.serve_forever.side_effect = KeyboardInterrupt
+    mocker.patch("aws_gate.agent.sys")
+    mocker.patch("aws_gate.agent._attach_client_logging")
+
+    agent(socket_path=socket_path)
+
+    assert server_mock.call_args == mocker.call(socket_path)
+    assert server_mock.return_value.server_close.called
+
+
+def test_agent_without_unix_sockets(mocker, socket_path):
+    mocker.patch("aws_gate.agent.HAS_UNIX_SOCKETS", False)
+
+    with pytest.raises(ValueError):
+        agent(socket_path=socket_path)
+
+
+def test_client_stdout_passthrough(mocker):
+    stream = mocker.MagicMock()
+    stdout = _ClientStream(stream)
+
+    stdout.write("data")
+    stdout.flush()
+
+    assert stream.write.call_args == mocker.call("data")
+    assert stream.flush.called
+    assert stdout.encoding == stream.encoding
+
+
+def test_client_log_handler_send_error(mocker):
+    handler = _ClientLogHandler()
+    error_mock = mocker.patch.object(handler, "handleError")
+    channel = mocker.MagicMock(log_level=logging.DEBUG)
+    channel.send.side_effect = ConnectionError
+    record = logging.makeLogRecord({"msg": "foo", "levelno": logging.INFO})
+
+    _CLIENT.channel = channel
+    try:
+        handler.emit(record)
+    finally:
+        _CLIENT.channel = None
+
+    assert error_mock.call_args == mocker.call(record)
+
+
+def test_attach_client_logging(mocker):
+    handler = logging.NullHandler()
+    root_logger = mocker.MagicMock(handlers=[handler], level=logging.WARNING)
+    mocker.patch("aws_gate.agent.logging.getLogger", return_value=root_logger)
+
+    _attach_client_logging()
+
+    assert handler.level == logging.WARNING
+    assert root_logger.setLevel.call_args == mocker.call(logging.DEBUG)
+    assert isinstance(root_logger.addHandler.call_args[0][0], _ClientLogHandler)
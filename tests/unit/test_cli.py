@@ -1,12 +1,29 @@
 import argparse
+import json
 import os
+import subprocess
+import sys
+import textwrap
 from unittest.mock import MagicMock, create_autospec
 
 import pytest
 from marshmallow import ValidationError
 
-from aws_gate.cli import main, _get_profile, _get_region, parse_arguments
-from aws_gate.constants import AWS_DEFAULT_REGION
+from aws_gate.cli import (
+    main,
+    _get_fallback_regions,
+    _get_profile_names,
+    _get_profile,
+    _get_region,
+    get_argument_parser,
+    parse_arguments,
+    run_subcommand,
+)
+from aws_gate.constants import (
+    AWS_DEFAULT_REGION,
+    AWS_REGIONS,
+    DEFAULT_LIST_HUMAN_FIELDS,
+)
 
 
 def test_cli_param_error():
@@ -17,10 +34,10 @@ def test_cli_param_error():
 def test_cli_invalid_config(mocker):
     mocker.patch(
         "aws_gate.cli.parse_arguments",
-        return_value=mocker.MagicMock(subcommand="bootstrap"),
+        return_value=mocker.MagicMock(subcommand="session"),
     )
     mocker.patch(
-        "aws_gate.cli.load_config_from_files",
+        "aws_gate.config.load_config_from_files",
         side_effect=ValidationError(message="error"),
     )
 
@@ -51,7 +68,7 @@ def test_cli_default_profile_from_aws_vault(mocker):
     )
     mocker.patch("aws_gate.decorators.is_existing_region", return_value=True)
     mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
-    mocker.patch("aws_gate.cli.list_instances")
+    mocker.patch("aws_gate.list.list_instances")
     logger_mock = mocker.patch("aws_gate.cli.logging.getLogger")
     m = mocker.patch("aws_gate.cli._get_profile")
 
@@ -118,17 +135,51 @@ def test_cli_get_region(args, config, default, expected):
     assert _get_region(args, config, default) == expected
 
 
+@pytest.mark.parametrize(
+    "fallback_regions, expected",
+    [
+        (None, None),
+        ("all", AWS_REGIONS),
+        ("eu-central-1,us-east-1,", ["eu-central-1", "us-east-1"]),
+    ],
+    ids=["disabled", "all", "list"],
+)
+def test_cli_get_fallback_regions(fallback_regions, expected):
+    args = argparse.Namespace(fallback_regions=fallback_regions)
+
+    assert _get_fallback_regions(args) == expected
+
+
+@pytest.mark.parametrize(
+    "profile_names, expected",
+    [
+        (None, None),
+        ("all", ["default", "dev", "prod"]),
+        ("dev,prod,", ["dev", "prod"]),
+    ],
+    ids=["disabled", "all", "list"],
+)
+def test_cli_get_profile_names(mocker, profile_names, expected):
+    mocker.patch(
+        "aws_gate.utils.get_aws_profiles", return_value=["default", "dev", "prod"]
+    )
+    args = argparse.Namespace(profile_names=profile_names)
+
+    assert _get_profile_names(args) == expected
+
+
 @pytest.mark.parametrize(
     "subcommand",
     [
-        ("bootstrap", "bootstrap"),
-        ("list", "list_instances"),
-        ("ls", "list_instances"),
-        ("session", "session"),
-        ("ssh", "ssh"),
-        ("ssh-config", "ssh_config"),
-        ("ssh-proxy", "ssh_proxy"),
-        ("exec", "exec"),
+        ("bootstrap", "bootstrap.bootstrap"),
+        ("list", "list.list_instances"),
+        ("ls", "list.list_instances"),
+        ("session", "session.session"),
+        ("ssh", "ssh.ssh"),
+        ("ssh-config", "ssh_config.ssh_config"),
+        ("ssh-proxy", "ssh_proxy.ssh_proxy"),
+        ("exec", "exec.exec"),
+        ("inventory", "inventory_sync.sync"),
     ],
     ids=lambda x: x[0],
 )
@@ -137,15 +188,43 @@ def test_cli_subcommand(mocker, subcommand):
         "aws_gate.cli.parse_arguments",
         return_value=mocker.MagicMock(subcommand=subcommand[0]),
     )
-    m = mocker.patch(f"aws_gate.cli.{subcommand[1]}")
+    m = mocker.patch(f"aws_gate.{subcommand[1]}")
+
+    main()
+
+    assert m.called
+
+
+def test_cli_subcommand_in_agent(mocker):
+    mocker.patch(
+        "aws_gate.cli.parse_arguments",
+        return_value=mocker.MagicMock(subcommand="session"),
+    )
+    agent_mock = mocker.patch("aws_gate.agent.run_in_agent", return_value=True)
+    m = mocker.patch("aws_gate.cli.run_subcommand")
+
+    main()
+
+    assert agent_mock.called
+    assert not m.called
+
+
+def test_cli_agent(mocker):
+    mocker.patch(
+        "aws_gate.cli.parse_arguments",
+        return_value=mocker.MagicMock(subcommand="agent"),
+    )
+    agent_mock = mocker.patch("aws_gate.agent.run_in_agent")
+    m = mocker.patch("aws_gate.agent.agent")
 
     main()
 
     assert m.called
+    assert not agent_mock.called
 
 
 def test_cli_default_region(mocker):
-    mocker.patch("aws_gate.cli.get_default_region", return_value=None)
+    mocker.patch("aws_gate.utils.get_default_region", return_value=None)
     mocker.patch(
         "aws_gate.cli.parse_arguments",
         return_value=mocker.MagicMock(subcommand="unknown"),
@@ -177,3 +256,183 @@ def test_cli_logging_format(mocker, test_input):
     main()
 
     assert mock.call_args_list[0][1]["format"] == log_format_
+
+
+HEAVY_MODULES = [
+    "boto3",
+    "botocore",
+    "cryptography",
+    "marshmallow",
+    "requests",
+    "unix_ar",
+    "yaml",
+]
+
+
+def _imported_heavy_modules(tmp_path, argv, patch_target=None):
+    # Every check has to run in a fresh interpreter, as the test suite itself
+    # has already imported everything
+    script = textwrap.dedent(
+        f"""
+        import json
+        import sys
+        from unittest import mock
+
+        import aws_gate.cli
+
+        sys.argv = {argv!r}
+        try:
+            if {patch_target!r}:
+                with mock.patch({patch_target!r}):
+                    aws_gate.cli.main()
+            else:
+                aws_gate.cli.main()
+        except SystemExit:
+            pass
+        finally:
+            modules = [m for m in {HEAVY_MODULES!r} if m in sys.modules]
+            sys.stdout.write(json.dumps(modules))
+        """
+    )
+    env = dict(os.environ, HOME=str(tmp_path))
+    result = subprocess.run(
+        [sys.executable, "-c", script], env=env, capture_output=True, check=True
+    )
+    return set(json.loads(result.stdout.decode().splitlines()[-1]))
+
+
+def test_cli_import_is_lightweight(tmp_path):
+    assert not _imported_heavy_modules(tmp_path, ["aws-gate", "--version"])
+
+
+def test_cli_complete_is_lightweight(tmp_path):
+    assert not _imported_heavy_modules(tmp_path, ["aws-gate", "__complete", "hosts"])
+
+
+def test_cli_complete(mocker, capsys):
+    mocker.patch("sys.argv", ["aws-gate", "__complete", "regions", "eu-west-1"])
+
+    with pytest.raises(SystemExit) as excinfo:
+        main()
+
+    assert excinfo.value.code == 0
+    assert capsys.readouterr().out == "eu-west-1\n"
+
+
+@pytest.mark.parametrize(
+    "subcommand, patch_target, absent_modules",
+    [
+        (
+            ["bootstrap"],
+            "aws_gate.bootstrap.bootstrap",
+            ["boto3", "botocore", "cryptography", "marshmallow", "yaml"],
+        ),
+        (["list"], "aws_gate.list.list_instances", ["cryptography", "requests"]),
+        (
+            ["inventory", "sync"],
+            "aws_gate.inventory_sync.sync",
+            ["cryptography", "requests"],
+        ),
+        (
+            ["ssh-config"],
+            "aws_gate.ssh_config.ssh_config",
+            ["cryptography", "requests"],
+        ),
+        (["session", "foo"], "aws_gate.session.session", ["cryptography", "requests"]),
+        (["exec", "foo", "ls"], "aws_gate.exec.exec", ["cryptography", "requests"]),
+        (["ssh", "foo"], "aws_gate.ssh.ssh", ["requests", "unix_ar"]),
+        (["ssh-proxy", "foo"], "aws_gate.ssh_proxy.ssh_proxy", ["requests", "unix_ar"]),
+    ],
+    ids=lambda x: x[0] if isinstance(x, list) and x[0] not in HEAVY_MODULES else "",
+)
+def test_cli_subcommand_lazy_imports(
+    tmp_path, subcommand, patch_target, absent_modules
+):
+    imported = _imported_heavy_modules(
+        tmp_path, ["aws-gate"] + subcommand, patch_target=patch_target
+    )
+
+    assert imported.isdisjoint(absent_modules)
+
+
+@pytest.mark.parametrize(
+    "argv, fields, profile_names, region_names",
+    [
+        (["list"], DEFAULT_LIST_HUMAN_FIELDS, None, None),
+        (
+            ["list", "--all-regions"],
+            DEFAULT_LIST_HUMAN_FIELDS + ("profile", "region"),
+            None,
+            AWS_REGIONS,
+        ),
+        (
+            ["list", "--profiles", "dev,prod", "--regions", "eu-west-1"],
+            DEFAULT_LIST_HUMAN_FIELDS + ("profile", "region"),
+            ["dev", "prod"],
+            ["eu-west-1"],
+        ),
+        (["ls", "-o", "instance_id,region"], ["instance_id", "region"], None, None),
+    ],
+    ids=["default", "all-regions", "profiles", "output"],
+)
+def test_cli_list_targets(mocker, argv, fields, profile_names, region_names):
+    mocker.patch("aws_gate.utils.get_default_region", return_value="eu-west-1")
+    m = mocker.patch("aws_gate.list.list_instances")
+    parser, *_ = get_argument_parser()
+
+    run_subcommand(parser.parse_args(argv))
+
+    assert m.call_args[1]["fields"] == fields
+    assert m.call_args[1]["profile_names"] == profile_names
+    assert m.call_args[1]["region_names"] == region_names
+
+
+@pytest.mark.parametrize(
+    "argv, fallback_regions, instance_name, command",
+    [
+        (["ssh", "--fallback-regions", "all", "myhost"], AWS_REGIONS, "myhost", []),
+        (
+            ["exec", "--fallback-regions", "eu-west-1,us-east-1", "myhost", "ls"],
+            ["eu-west-1", "us-east-1"],
+            "myhost",
+            ["ls"],
+        ),
+        (["session", "myhost"], None, "myhost", None),
+    ],
+    ids=["all", "list", "disabled"],
+)
+def test_cli_fallback_regions(argv, fallback_regions, instance_name, command):
+    parser, *_ = get_argument_parser()
+
+    args = parser.parse_args(argv)
+
+    assert _get_fallback_regions(args) == fallback_regions
+    assert args.instance_name == instance_name
+    assert getattr(args, "command", None) == command
+
+
+@pytest.mark.parametrize(
+    "argv",
+    [["ssh", "--fallback-regions", "myhost"], ["session", "--fallback-regions"]],
+    ids=["ssh", "session"],
+)
+def test_cli_fallback_regions_value_required(argv):
+    parser, *_ = get_argument_parser()
+
+    # Without a value, the instance name must not be taken as the region list
+    with pytest.raises(SystemExit):
+        parser.parse_args(argv)
+
+
+def test_cli_inventory_sync(mocker):
+    mocker.patch("aws_gate.utils.get_default_region", return_value="eu-west-1")
+    m = mocker.patch("aws_gate.inventory_sync.sync")
+    parser, *_ = get_argument_parser()
+
+    run_subcommand(
+        parser.parse_args(["inventory", "sync", "--regions", "eu-west-1", "--full"])
+    )
+
+    assert m.call_args[1]["region_names"] == ["eu-west-1"]
+    assert m.call_args[1]["profile_names"] is None
+    assert m.call_args[1]["full"]
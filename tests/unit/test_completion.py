@@ -0,0 +1,115 @@
+import io
+import logging
+import os
+import textwrap
+
+import pytest
+
+from aws_gate.completion import complete, store_names
+
+
+def _complete(*args):
+    stream = io.StringIO()
+    assert complete(list(args), stream=stream) == 0
+    return stream.getvalue().splitlines()
+
+
+def test_complete_hosts(tmp_path):
+    (tmp_path / "config").write_text("hosts: []\n")
+    store_names("aliases", ["web", "db", "web-1"])
+    store_names("instances", ["web-1", "web-2", "api"])
+
+    assert _complete("hosts") == ["api", "db", "web", "web-1", "web-2"]
+    assert _complete("hosts", "web-") == ["web-1", "web-2"]
+    assert not _complete("hosts", "x")
+
+
+def test_complete_hosts_stale_aliases(tmp_path):
+    config = tmp_path / "config"
+    config.write_text("hosts: []\n")
+    store_names("aliases", ["web", "old"])
+    assert _complete("hosts") == ["old", "web"]
+
+    # Configuration edited since the aliases were stored is read directly
+    config.write_text(
+        textwrap.dedent(
+            """
+            hosts:
+            - alias: web
+              name: web
+            - name: db
+              alias: "db-1"  # database
+            - alias: web-*
+              name: web
+            """
+        )
+    )
+    (tmp_path / "config.d").mkdir()
+    (tmp_path / "config.d" / "extra").write_text("hosts:\n  - alias: api\n")
+    (tmp_path / "config.d" / "subdir").mkdir()
+    (tmp_path / "config.d" / "binary").write_bytes(b"\xff\xfe")
+    stored = tmp_path / "cache" / "completion" / "aliases"
+    os.utime(stored, ns=(0, 0))
+
+    assert _complete("hosts") == ["api", "db-1", "web"]
+
+    # Aliases of a removed configuration are not offered anymore
+    config.unlink()
+    for path in (tmp_path / "config.d").iterdir():
+        if path.is_file():
+            path.unlink()
+    assert not _complete("hosts")
+
+
+def test_complete_hosts_without_names():
+    assert not _complete("hosts")
+
+
+def test_store_names_failure(mocker, caplog):
+    caplog.set_level(logging.DEBUG, logger="aws_gate.completion")
+    mocker.patch("aws_gate.utils.write_file_atomically", side_effect=OSError)
+
+    store_names("aliases", ["web"])
+
+    assert "Unable to store aliases for completion" in caplog.text
+
+
+def test_complete_profiles(tmp_path, monkeypatch):
+    config = tmp_path / "config"
+    config.write_text(
+        textwrap.dedent(
+            """
+            [default]
+            region = eu-west-1
+            [profile dev]
+            [profile prod]
+            [sso-session company]
+            """
+        )
+    )
+    credentials = tmp_path / "credentials"
+    credentials.write_text("[default]\n[ci]\n")
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(config))
+    monkeypatch.setenv("AWS_SHARED_CREDENTIALS_FILE", str(credentials))
+
+    assert _complete("profiles") == ["ci", "default", "dev", "prod"]
+    assert _complete("profiles", "d") == ["default", "dev"]
+
+
+def test_complete_profiles_invalid_file(tmp_path, monkeypatch):
+    config = tmp_path / "config"
+    config.write_text("region = eu-west-1\n")
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(config))
+    monkeypatch.setenv("AWS_SHARED_CREDENTIALS_FILE", str(tmp_path / "missing"))
+
+    assert not _complete("profiles")
+
+
+def test_complete_regions():
+    assert _complete("regions", "eu-west-") == ["eu-west-1", "eu-west-2", "eu-west-3"]
+
+
+@pytest.mark.parametrize("args", [[], ["unknown"]])
+def test_complete_invalid(capsys, args):
+    assert complete(args) == 2
+    assert "usage: aws-gate __complete" in capsys.readouterr().err
@@ -11,6 +11,7 @@ from aws_gate.config import (
     validate_profile,
     validate_region,
     _merge_data,
+    _config_cache_key,
 )
 from aws_gate.constants import DEFAULT_GATE_CONFIG_PATH, DEFAULT_GATE_CONFIGD_PATH
 
@@ -214,3 +215,177 @@ def test_merge_config_data_exception(args):
     src, dst = args
     with pytest.raises(TypeError):
         _merge_data(src, dst)
+
+
+@pytest.fixture(name="located_config")
+def located_config_fixture(shared_datadir, mocker):
+    config_file = shared_datadir / "config_valid.yaml"
+    mocker.patch("aws_gate.config._locate_config_files", return_value=[config_file])
+    return config_file
+
+
+@pytest.mark.usefixtures("located_config")
+def test_config_cache(gate_cache_dir, mocker):
+    profile_mock = mocker.patch(
+        "aws_gate.config.is_existing_profile", return_value=True
+    )
+
+    config = load_config_from_files()
+
+    assert profile_mock.called
+    assert (gate_cache_dir / "config.json").exists()
+    aliases = (gate_cache_dir / "completion" / "aliases").read_text().splitlines()
+    assert aliases == sorted(
+        {host["alias"] for host in config.hosts if "*" not in host["alias"]}
+    )
+
+    profile_mock.reset_mock()
+    yaml_mock = mocker.patch("aws_gate.config.yaml.safe_load")
+    cached_config = load_config_from_files()
+
+    assert not profile_mock.called
+    assert not yaml_mock.called
+    assert cached_config.hosts == config.hosts
+    assert cached_config.defaults == config.defaults
+
+
+def test_config_cache_invalidated_on_change(located_config, mocker):
+    profile_mock = mocker.patch(
+        "aws_gate.config.is_existing_profile", return_value=True
+    )
+
+    load_config_from_files()
+    stat = os.stat(located_config)
+    os.utime(located_config, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    profile_mock.reset_mock()
+    load_config_from_files()
+
+    assert profile_mock.called
+
+
+@pytest.mark.usefixtures("located_config")
+def test_config_cache_corrupted(gate_cache_dir, mocker):
+    mocker.patch("aws_gate.config.is_existing_profile", return_value=True)
+    gate_cache_dir.mkdir()
+    (gate_cache_dir / "config.json").write_bytes(b"garbage")
+
+    config = load_config_from_files()
+
+    assert config.default_profile == "default-profile"
+
+
+@pytest.mark.parametrize("cached", ["[]", '{"key": ["0.0.0"]}'])
+@pytest.mark.usefixtures("located_config")
+def test_config_cache_stale(gate_cache_dir, mocker, cached):
+    profile_mock = mocker.patch(
+        "aws_gate.config.is_existing_profile", return_value=True
+    )
+    gate_cache_dir.mkdir()
+    (gate_cache_dir / "config.json").write_text(cached)
+
+    config = load_config_from_files()
+
+    assert profile_mock.called
+    assert config.default_profile == "default-profile"
+
+
+@pytest.mark.usefixtures("located_config")
+def test_config_cache_not_stored_on_validation_error(gate_cache_dir, mocker):
+    mocker.patch("aws_gate.config.is_existing_profile", return_value=False)
+
+    with pytest.raises(ValidationError):
+        load_config_from_files()
+
+    assert not (gate_cache_dir / "config.json").exists()
+
+
+def test_config_cache_not_used_for_explicit_files(
+    shared_datadir, gate_cache_dir, mocker
+):
+    mocker.patch("aws_gate.config.is_existing_profile", return_value=True)
+
+    _load_config_files(config_files=[shared_datadir / "config_valid.yaml"])
+
+    assert not (gate_cache_dir / "config.json").exists()
+
+
+def test_config_cache_key_tracks_aws_config(tmp_path, mocker):
+    aws_config = tmp_path / "aws_config"
+    mocker.patch.dict(os.environ, {"AWS_CONFIG_FILE": str(aws_config)})
+
+    key = _config_cache_key([])
+    aws_config.write_text("[default]\n")
+
+    assert _config_cache_key([]) != key
+
+
+@pytest.mark.usefixtures("located_config")
+def test_config_cache_write_failure(mocker):
+    mocker.patch("aws_gate.config.is_existing_profile", return_value=True)
+    mocker.patch("aws_gate.config.write_file_atomically", side_effect=OSError)
+
+    assert isinstance(load_config_from_files(), GateConfig)
+
+
+def _host(alias, name=None, profile="default", region="eu-west-1"):
+    return {"alias": alias, "name": name or alias, "profile": profile, "region": region}
+
+
+def test_config_get_host_duplicate_alias():
+    config = GateConfig(
+        defaults={},
+        hosts=[_host("foo", profile="first"), _host("foo", profile="second")],
+    )
+
+    assert config.get_host("foo")["profile"] == "first"
+
+
+def test_config_get_host_pattern():
+    config = GateConfig(
+        defaults={},
+        hosts=[
+            _host("web-1", profile="exact"),
+            _host("web-*", profile="web"),
+            _host("db-?", name="database", profile="db"),
+            _host("*", profile="catch-all"),
+        ],
+    )
+
+    assert config.get_host("web-1")["profile"] == "exact"
+    assert config.get_host("web-2") == _host("web-2", profile="web")
+    assert config.get_host("db-1") == _host("db-1", name="database", profile="db")
+    assert config.get_host("db-10")["profile"] == "catch-all"
+
+
+def test_config_get_host_pattern_order():
+    config = GateConfig(
+        defaults={},
+        hosts=[
+            _host("web-*-db", profile="web-db"),
+            _host("*-db", profile="db"),
+            _host("web-*", profile="web"),
+            _host("web-[ab]", profile="web-ab"),
+        ],
+    )
+
+    assert config.get_host("web-1-db")["profile"] == "web-db"
+    assert config.get_host("app-db")["profile"] == "db"
+    assert config.get_host("web-db")["profile"] == "db"
+    assert config.get_host("web-a")["profile"] == "web"
+    assert config.get_host("w") == {}
+
+
+def test_config_get_host_without_patterns():
+    config = GateConfig(defaults={}, hosts=[_host("foo")])
+
+    assert config.get_host("bar") == {}
+
+
+def test_config_get_host_large_config():
+    hosts = [_host(f"host-{i}") for i in range(10000)]
+    hosts += [_host(f"group-{i}-*", profile=f"profile-{i}") for i in range(1000)]
+    config = GateConfig(defaults={}, hosts=hosts)
+
+    assert config.get_host("host-9999") == hosts[9999]
+    assert config.get_host("group-999-web")["profile"] == "profile-999"
+    assert config.get_host("unknown") == {}
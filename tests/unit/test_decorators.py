@@ -1,16 +1,33 @@
+import os
 from subprocess import PIPE
 
 import pytest
 
+from aws_gate.constants import PLUGIN_NAME
 from aws_gate.decorators import (
     plugin_required,
     plugin_version,
     _plugin_exists,
+    _resolve_plugin_path,
     valid_aws_profile,
     valid_aws_region,
 )
 
 
+@pytest.fixture(name="plugin_path")
+def plugin_path_fixture(tmp_path, mocker):
+    gate_bin_dir = tmp_path / "gate-bin"
+    bin_dir = tmp_path / "bin"
+    gate_bin_dir.mkdir()
+    bin_dir.mkdir()
+    mocker.patch("aws_gate.decorators.DEFAULT_GATE_BIN_PATH", str(gate_bin_dir))
+    mocker.patch.dict(os.environ, {"PATH": str(bin_dir)})
+
+    path = bin_dir / PLUGIN_NAME
+    path.write_text("#!/bin/sh\n")
+    return path
+
+
 def test_plugin_exists(mocker):
     m = mocker.patch("aws_gate.decorators.os.path.exists")
 
@@ -65,6 +82,84 @@ def test_plugin_version_bad_version(mocker, version):
         test_function()
 
 
+def test_resolve_plugin_path(plugin_path, tmp_path, mocker):
+    assert _resolve_plugin_path() == str(plugin_path)
+
+    # Our own bin directory takes precedence
+    gate_plugin_path = tmp_path / "gate-bin" / PLUGIN_NAME
+    gate_plugin_path.write_text("#!/bin/sh\n")
+    m = mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
+
+    assert _resolve_plugin_path() == str(plugin_path)
+    assert m.call_count == 1
+
+    plugin_path.unlink()
+    m.side_effect = os.path.exists
+
+    assert _resolve_plugin_path() == str(gate_plugin_path)
+
+
+def test_plugin_version_is_cached(plugin_path, mocker):
+    m = mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.2.7.0")
+
+    @plugin_version("1.1.23.0")
+    def test_function():
+        return "executed"
+
+    assert test_function() == "executed"
+    assert test_function() == "executed"
+    assert m.call_count == 1
+
+    # Upgrading the plugin invalidates the cached version
+    plugin_path.write_text("#!/bin/sh\necho upgraded\n")
+    m.return_value = "1.1.0.0"
+
+    with pytest.raises(ValueError):
+        test_function()
+    assert m.call_count == 2
+
+
+@pytest.mark.usefixtures("plugin_path")
+def test_plugin_version_cache_unreadable(gate_cache_dir, mocker):
+    gate_cache_dir.mkdir()
+    (gate_cache_dir / "plugin-version.json").write_text("garbage")
+    m = mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.2.7.0")
+
+    @plugin_version("1.1.23.0")
+    def test_function():
+        return "executed"
+
+    assert test_function() == "executed"
+    assert m.called
+
+
+@pytest.mark.usefixtures("plugin_path")
+def test_plugin_version_cache_write_failure(mocker):
+    mocker.patch("aws_gate.decorators.write_file_atomically", side_effect=OSError)
+    m = mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.2.7.0")
+
+    @plugin_version("1.1.23.0")
+    def test_function():
+        return "executed"
+
+    assert test_function() == "executed"
+    assert test_function() == "executed"
+    assert m.call_count == 2
+
+
+@pytest.mark.usefixtures("plugin_path")
+def test_plugin_version_plugin_stat_failure(mocker):
+    mocker.patch("aws_gate.decorators.os.stat", side_effect=OSError)
+    m = mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.2.7.0")
+
+    @plugin_version("1.1.23.0")
+    def test_function():
+        return "executed"
+
+    assert test_function() == "executed"
+    assert m.called
+
+
 def test_valid_aws_profile(mocker):
     mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
 
@@ -86,6 +181,32 @@ def test_valid_aws_profile_invalid_profile(mocker):
         test_function(profile_name="invalid-profile")
 
 
+@pytest.mark.parametrize(
+    "profile_names, error",
+    [(["a", "b"], None), (["a", "default"], "default")],
+    ids=["valid", "invalid"],
+)
+def test_valid_aws_profile_profile_names(mocker, profile_names, error):
+    mocker.patch(
+        "aws_gate.decorators.is_existing_profile",
+        side_effect=lambda profile_name: profile_name in ["a", "b"],
+    )
+
+    @valid_aws_profile
+    def test_function(profile_name, profile_names=None):
+        return profile_name, profile_names
+
+    # The single profile is not used with several profiles, so it is not checked
+    if error is None:
+        assert test_function(profile_name="default", profile_names=profile_names) == (
+            "default",
+            profile_names,
+        )
+    else:
+        with pytest.raises(ValueError, match=f"Invalid profile provided: {error}"):
+            test_function(profile_name="a", profile_names=profile_names)
+
+
 def test_valid_aws_region(mocker):
     mocker.patch("aws_gate.decorators.is_existing_region", return_value=True)
 
@@ -38,8 +38,11 @@ def test_exec_session_context_manager(ssm_mock, instance_id):
 
 def test_exec_session(mocker, instance_id, config):
     mocker.patch("aws_gate.exec.get_aws_client")
-    mocker.patch("aws_gate.exec.get_aws_resource")
-    mocker.patch("aws_gate.exec.query_instance", return_value=instance_id)
+    mocker.patch("aws_gate.query.get_aws_resource")
+    mocker.patch(
+        "aws_gate.query.query_instance_details",
+        return_value={"instance_id": instance_id},
+    )
     session_mock = mocker.patch(
         "aws_gate.exec.ExecSession", return_value=mocker.MagicMock()
     )
@@ -59,8 +62,8 @@ def test_exec_session(mocker, instance_id, config):
 
 def test_exec_session_exception_invalid_profile(mocker, instance_id, config):
     mocker.patch("aws_gate.exec.get_aws_client")
-    mocker.patch("aws_gate.exec.get_aws_resource")
-    mocker.patch("aws_gate.exec.query_instance", return_value=None)
+    mocker.patch("aws_gate.query.get_aws_resource")
+    mocker.patch("aws_gate.query.query_instance_details", return_value=None)
     mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
     mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
 
@@ -75,8 +78,8 @@ def test_exec_session_exception_invalid_profile(mocker, instance_id, config):
 
 def test_exec_session_exception_invalid_region(mocker, instance_id, config):
     mocker.patch("aws_gate.exec.get_aws_client")
-    mocker.patch("aws_gate.exec.get_aws_resource")
-    mocker.patch("aws_gate.exec.query_instance", return_value=None)
+    mocker.patch("aws_gate.query.get_aws_resource")
+    mocker.patch("aws_gate.query.query_instance_details", return_value=None)
     mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
     mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
 
@@ -92,8 +95,8 @@ def test_exec_session_exception_invalid_region(mocker, instance_id, config):
 
 def test_exec_session_exception_unknown_instance_id(mocker, instance_id, config):
     mocker.patch("aws_gate.exec.get_aws_client")
-    mocker.patch("aws_gate.exec.get_aws_resource")
-    mocker.patch("aws_gate.exec.query_instance", return_value=None)
+    mocker.patch("aws_gate.query.get_aws_resource")
+    mocker.patch("aws_gate.query.query_instance_details", return_value=None)
     mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
     mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
     mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
@@ -105,21 +108,103 @@ def test_exec_session_exception_unknown_instance_id(mocker, instance_id, config)
             command=["ls", "-l"],
             profile_name="profile",
             region_name="eu-west-1",
+            fallback_regions=["eu-central-1"],
         )
 
 
-def test_exec_session_without_config(mocker, instance_id, empty_config):
+def test_exec_session_without_config(mocker, empty_config):
     mocker.patch("aws_gate.exec.get_aws_client")
-    mocker.patch("aws_gate.exec.get_aws_resource")
-    mocker.patch("aws_gate.exec.query_instance", return_value=None)
+    mocker.patch("aws_gate.query.get_aws_resource")
+    mocker.patch("aws_gate.query.query_instance_details", return_value=None)
     mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
     mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
 
     with pytest.raises(ValueError):
         exec(
             config=empty_config,
-            instance_name=instance_id,
+            instance_name="dummy-instance",
             command=["ls", "-l"],
             profile_name="profile",
             region_name="eu-west-1",
         )
+
+
+def test_exec_session_all_instances(mocker, config):
+    mocker.patch("aws_gate.exec.get_aws_client")
+    mocker.patch("aws_gate.exec.get_aws_resource")
+    mocker.patch(
+        "aws_gate.exec.query_instances",
+        return_value=iter(
+            [{"instance_id": "i-0c32153096cd68a6d"}, {"instance_id": "i-1234"}]
+        ),
+    )
+    session_mock = mocker.patch(
+        "aws_gate.exec.ExecSession", return_value=mocker.MagicMock()
+    )
+    mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
+    mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
+    mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
+
+    exec(
+        config=config,
+        instance_name="role:web",
+        command=["ls", "-l"],
+        profile_name="profile",
+        region_name="eu-west-1",
+        all_instances=True,
+    )
+
+    assert [c[0][0] for c in session_mock.call_args_list] == [
+        "i-0c32153096cd68a6d",
+        "i-1234",
+    ]
+
+
+def test_exec_session_instance_in_other_profile(mocker, instance_id, empty_config):
+    client_mock = mocker.patch("aws_gate.exec.get_aws_client")
+    mocker.patch(
+        "aws_gate.query.query_instance_in_profiles",
+        return_value={"instance_id": instance_id, "profile_name": "prod"},
+    )
+    session_mock = mocker.patch(
+        "aws_gate.exec.ExecSession", return_value=mocker.MagicMock()
+    )
+    mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
+    mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
+    mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
+
+    exec(
+        config=empty_config,
+        instance_name=instance_id,
+        command=["ls", "-l"],
+        profile_name="profile",
+        region_name="eu-west-1",
+        profile_names=["dev", "prod"],
+    )
+
+    assert client_mock.call_args == mocker.call(
+        "ssm", region_name="eu-west-1", profile_name="prod"
+    )
+    assert session_mock.call_args[1]["profile_name"] == "prod"
+
+
+def test_exec_session_by_instance_id(mocker, instance_id, empty_config):
+    mocker.patch("aws_gate.exec.get_aws_client")
+    resource_mock = mocker.patch("aws_gate.query.get_aws_resource")
+    query_mock = mocker.patch("aws_gate.query.query_instance_details")
+    session_mock = mocker.patch("aws_gate.exec.ExecSession")
+    mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
+    mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
+    mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
+
+    exec(
+        config=empty_config,
+        instance_name=instance_id,
+        command=["ls", "-l"],
+        profile_name="profile",
+        region_name="eu-west-1",
+    )
+
+    assert session_mock.call_args[0][0] == instance_id
+    assert not query_mock.called
+    assert not resource_mock.called
@@ -0,0 +1,311 @@
+import sqlite3
+import time
+
+import pytest
+
+from aws_gate.constants import INVENTORY_FULL_SYNC_AGE, INVENTORY_MAX_AGE
+from aws_gate.exceptions import AWSConnectionError
+from aws_gate.inventory import (
+    INSTANCE_DETAILS_FIELDS,
+    get_instance_names,
+    iter_inventory_instances,
+    lookup_instance,
+    remove_instance,
+)
+from aws_gate.inventory_sync import sync
+from aws_gate.list import _TargetSummary
+
+
+def _instance(instance_id, tags, **kwargs):
+    instance = {
+        "instance_id": instance_id,
+        "instance_name": tags.get("Name"),
+        "availability_zone": "eu-west-1a",
+        "vpc_id": "vpc-1",
+        "private_ip_address": "10.0.0.1",
+        "platform": "Linux",
+        "profile": "default",
+        "region": "eu-west-1",
+        "tags": tags,
+        "fingerprint": "registered",
+    }
+    instance.update(kwargs)
+    return instance
+
+
+INSTANCES = [
+    _instance("i-1", {"Name": "web", "env": "dev"}),
+    _instance("i-2", {"Name": "web", "env": "prod[1]"}, availability_zone="eu-west-1b"),
+    _instance("i-3", {"Name": "db-1"}, vpc_id="vpc-2", platform="Windows"),
+]
+
+
+@pytest.fixture(name="listed")
+def listed_fixture(mocker):
+    mocker.patch("aws_gate.decorators.is_existing_region", return_value=True)
+    mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
+
+    listed = {"instances": INSTANCES, "failed": []}
+
+    def _iter_instances(_targets, failures, known):
+        listed["known"] = known
+        for instance in listed["instances"]:
+            # Like aws_gate.list, details of unchanged instances are not fetched
+            target = (instance["profile"], instance["region"])
+            stored = known.get(target, {}).get(instance["instance_id"])
+            if stored is not None and stored["fingerprint"] == instance["fingerprint"]:
+                instance = dict(stored, profile=target[0], region=target[1])
+            yield instance
+        for profile_name, region_name in listed["failed"]:
+            failures.append(
+                _TargetSummary(profile_name, region_name, 0, 0.1, Exception("failed"))
+            )
+
+    mocker.patch("aws_gate.inventory_sync.iter_instances", side_effect=_iter_instances)
+    return listed
+
+
+def _lookup(filters, **kwargs):
+    instance = lookup_instance(filters, "default", "eu-west-1", **kwargs)
+    return instance["instance_id"] if instance is not None else None
+
+
+@pytest.mark.usefixtures("listed")
+def test_sync(capsys):
+    sync(profile_name="default", region_name="eu-west-1")
+
+    assert capsys.readouterr().out == (
+        "Synchronized 3 instances from 1 targets: "
+        "3 changed, 0 removed, 0 EC2 API calls saved\n"
+    )
+    assert set(lookup_instance([], "default", "eu-west-1")) == set(
+        INSTANCE_DETAILS_FIELDS
+    )
+
+
+@pytest.mark.usefixtures("listed")
+def test_sync_named_profiles_only(mocker, capsys):
+    mocker.patch(
+        "aws_gate.decorators.is_existing_profile",
+        side_effect=lambda p: p in ["a", "b"],
+    )
+
+    # "default" profile filled in by the CLI is not synchronized with --profiles
+    sync(profile_name="default", region_name="eu-west-1", profile_names=["a", "b"])
+
+    assert "from 2 targets" in capsys.readouterr().out
+
+
+@pytest.mark.usefixtures("listed")
+@pytest.mark.parametrize(
+    "filters, availability_zone, expected",
+    [
+        ([{"Name": "tag:Name", "Values": ["web"]}], None, "i-1"),
+        ([{"Name": "tag:Name", "Values": ["web"]}], "eu-west-1b", "i-2"),
+        ([{"Name": "instance-id", "Values": ["i-3"]}], None, "i-3"),
+        ([{"Name": "tag:env", "Values": ["prod[1]"]}], None, "i-2"),
+        ([{"Name": "tag:Name", "Values": ["db-*"]}], None, "i-3"),
+        ([{"Name": "tag:Name", "Values": ["unknown"]}], None, None),
+        ([{"Name": "instance-state-name", "Values": ["running"]}], None, None),
+    ],
+    ids=["name", "same-az", "id", "tag", "wildcard", "not found", "unsupported"],
+)
+def test_lookup_instance(filters, availability_zone, expected):
+    sync(profile_name="default", region_name="eu-west-1")
+
+    assert _lookup(filters, availability_zone=availability_zone) == expected
+
+
+def test_lookup_instance_gone(listed):
+    sync(profile_name="default", region_name="eu-west-1")
+    listed["instances"] = INSTANCES[:1]
+    sync(profile_name="default", region_name="eu-west-1")
+
+    assert _lookup([{"Name": "instance-id", "Values": ["i-2"]}]) is None
+    assert _lookup([{"Name": "tag:env", "Values": ["prod[1]"]}]) is None
+    assert _lookup([{"Name": "tag:env", "Values": ["dev"]}]) == "i-1"
+
+
+@pytest.mark.usefixtures("listed")
+def test_remove_instance(gate_cache_dir):
+    remove_instance("i-2")
+
+    sync(profile_name="default", region_name="eu-west-1")
+    remove_instance("i-2")
+    remove_instance("i-unknown")
+
+    assert _lookup([{"Name": "instance-id", "Values": ["i-2"]}]) is None
+    assert _lookup([{"Name": "tag:env", "Values": ["prod[1]"]}]) is None
+    assert _lookup([{"Name": "tag:Name", "Values": ["web"]}]) == "i-1"
+
+    (gate_cache_dir / "inventory.db").write_text("corrupted")
+    remove_instance("i-1")
+
+
+def test_sync_incremental(mocker, listed, capsys):
+    mocker.patch("aws_gate.inventory_sync.LIST_BATCH_SIZE", 1)
+    sync(profile_name="default", region_name="eu-west-1")
+    capsys.readouterr()
+    listed["instances"] = [
+        INSTANCES[0],
+        dict(INSTANCES[1], fingerprint="re-registered"),
+        _instance("i-4", {"Name": "web"}),
+    ]
+
+    sync(profile_name="default", region_name="eu-west-1")
+
+    assert set(listed["known"][("default", "eu-west-1")]) == {"i-1", "i-2", "i-3"}
+    assert capsys.readouterr().out == (
+        "Synchronized 3 instances from 1 targets: "
+        "2 changed, 1 removed, 1 EC2 API calls saved\n"
+    )
+    assert _lookup([{"Name": "instance-id", "Values": ["i-3"]}]) is None
+
+
+def test_sync_full(mocker, listed):
+    now = time.time()
+    time_mock = mocker.patch("aws_gate.inventory_sync.time.time", return_value=now)
+    sync(profile_name="default", region_name="eu-west-1")
+
+    sync(profile_name="default", region_name="eu-west-1", full=True)
+    assert listed["known"] == {}
+
+    # Incremental synchronizations do not postpone the next full one
+    time_mock.return_value = now + 60
+    sync(profile_name="default", region_name="eu-west-1")
+    assert listed["known"]
+
+    time_mock.return_value = now + INVENTORY_FULL_SYNC_AGE + 1
+    sync(profile_name="default", region_name="eu-west-1")
+    assert listed["known"] == {}
+
+
+def test_sync_failure(listed):
+    listed["failed"] = [("default", "eu-west-1")]
+
+    with pytest.raises(AWSConnectionError):
+        sync(profile_name="default", region_name="eu-west-1")
+
+    # Instances of targets which failed to synchronize are never trusted
+    assert _lookup([{"Name": "instance-id", "Values": ["i-1"]}]) is None
+
+
+@pytest.mark.usefixtures("listed")
+def test_lookup_instance_stale(mocker):
+    sync(profile_name="default", region_name="eu-west-1")
+    filters = [{"Name": "instance-id", "Values": ["i-1"]}]
+
+    assert _lookup(filters, max_age=0) is None
+    assert lookup_instance(filters, "default", "us-east-1") is None
+
+    mocker.patch("aws_gate.inventory.time.time", return_value=time.time() + 3600)
+    assert _lookup(filters) is None
+
+
+def test_lookup_instance_renamed(mocker, listed):
+    now = time.time()
+    time_mock = mocker.patch("aws_gate.inventory.time.time", return_value=now)
+    sync(profile_name="default", region_name="eu-west-1")
+    time_mock.return_value = now + 60
+    sync(profile_name="default", region_name="eu-west-1")
+
+    # Name moves to a replacement instance, while the old one stays registered
+    # and its details are not fetched again
+    listed["instances"] = [
+        dict(INSTANCES[2], tags={"Name": "db-old"}, instance_name="db-old"),
+        _instance("i-4", {"Name": "db-1"}, fingerprint="new"),
+    ]
+    time_mock.return_value = now + INVENTORY_MAX_AGE + 1
+    sync(profile_name="default", region_name="eu-west-1")
+
+    assert _lookup([{"Name": "tag:Name", "Values": ["db-1"]}]) == "i-4"
+    assert _lookup([{"Name": "tag:Name", "Values": ["db-old"]}]) is None
+    assert _lookup([{"Name": "instance-id", "Values": ["i-3"]}]) == "i-3"
+
+
+def test_lookup_instance_missing():
+    assert _lookup([]) is None
+
+
+@pytest.mark.usefixtures("listed")
+def test_inventory_format_mismatch(gate_cache_dir):
+    path = str(gate_cache_dir / "inventory.db")
+    sync(profile_name="default", region_name="eu-west-1")
+    with sqlite3.connect(path) as conn:
+        conn.execute("PRAGMA user_version = 0")
+
+    assert _lookup([]) is None
+
+    sync(profile_name="default", region_name="eu-west-1")
+    assert _lookup([]) == "i-1"
+
+
+def test_inventory_corrupted(gate_cache_dir):
+    gate_cache_dir.mkdir()
+    (gate_cache_dir / "inventory.db").write_text("corrupted")
+
+    assert _lookup([]) is None
+    assert iter_inventory_instances("default", "eu-west-1", {}) is None
+
+
+@pytest.mark.usefixtures("listed")
+@pytest.mark.parametrize(
+    "filters, expected",
+    [
+        ({"ssm": [], "ec2": []}, ["i-1", "i-2", "i-3"]),
+        (
+            {"ssm": [{"Key": "PlatformTypes", "Values": ["Linux"]}], "ec2": []},
+            ["i-1", "i-2"],
+        ),
+        (
+            {
+                "ssm": [],
+                "ec2": [
+                    {"Name": "vpc-id", "Values": ["vpc-1"]},
+                    {"Name": "tag:env", "Values": ["dev", "prod*"]},
+                ],
+            },
+            ["i-1", "i-2"],
+        ),
+        ({"ssm": [], "ec2": [{"Name": "tag:Name", "Values": ["db-*"]}]}, ["i-3"]),
+    ],
+    ids=["all", "platform", "vpc and tag", "name prefix"],
+)
+def test_iter_inventory_instances(filters, expected):
+    sync(profile_name="default", region_name="eu-west-1")
+
+    instances = list(iter_inventory_instances("default", "eu-west-1", filters))
+
+    assert [instance["instance_id"] for instance in instances] == expected
+    assert instances[0]["tags"] == INSTANCES[int(expected[0][-1]) - 1]["tags"]
+    assert "profile" not in instances[0]
+
+
+@pytest.mark.usefixtures("listed")
+def test_iter_inventory_instances_unavailable():
+    filters = {"ssm": [], "ec2": []}
+    assert iter_inventory_instances("default", "eu-west-1", filters) is None
+
+    sync(profile_name="default", region_name="eu-west-1")
+
+    assert iter_inventory_instances("default", "eu-west-1", filters, max_age=0) is None
+    assert iter_inventory_instances("default", "us-east-1", filters) is None
+    assert (
+        iter_inventory_instances(
+            "default",
+            "eu-west-1",
+            {"ssm": [{"Key": "AssociationStatus", "Values": ["Failed"]}], "ec2": []},
+        )
+        is None
+    )
+
+
+@pytest.mark.usefixtures("listed")
+def test_get_instance_names(gate_cache_dir):
+    assert not get_instance_names()
+
+    sync(profile_name="default", region_name="eu-west-1")
+    assert get_instance_names() == ["db-1", "web"]
+
+    (gate_cache_dir / "inventory.db").write_text("corrupted")
+    assert not get_instance_names()
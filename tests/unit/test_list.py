@@ -1,8 +1,27 @@
+import io
 import json
+import logging
+import queue
+import threading
 
 import pytest
+from botocore.exceptions import ClientError
 
-from aws_gate.list import list_instances, serialize
+from aws_gate.exceptions import AWSConnectionError
+from aws_gate.list import (
+    _fetch_instance_details,
+    _get_fingerprint,
+    _get_required_sources,
+    _list_targets,
+    _matches_local_filters,
+    _parse_filters,
+    _print_stream,
+    _produce_target,
+    iter_instances,
+    list_instances,
+    serialize,
+    serialize_stream,
+)
 
 
 def test_list(mocker, ec2, ssm, capsys):
@@ -63,6 +82,19 @@ def test_list_invalid_field(mocker):
             [{"foo": "bar", "bar": "foo"}],
             json.dumps([{"foo": "bar", "bar": "foo"}], sort_keys=True, indent=4),
         ),
+        ("json", ["foo"], [], json.dumps([], sort_keys=True, indent=4)),
+        (
+            "ndjson",
+            ["foo"],
+            [{"foo": "bar"}],
+            json.dumps({"foo": "bar"}) + "\n",
+        ),
+        (
+            "ndjson",
+            ["foo", "bar"],
+            [{"foo": "bar", "bar": "foo"}, {"foo": "baz"}],
+            '{"bar": "foo", "foo": "bar"}\n{"foo": "baz"}\n',
+        ),
         ("human", ["foo"], [{"foo": "bar"}], "bar\r\n"),
         ("human", ["foo", "bar"], [{"foo": "bar", "bar": "foo"}], "bar foo\r\n"),
         ("tsv", ["foo"], [{"foo": "bar"}], "bar\r\n"),
@@ -70,11 +102,549 @@ def test_list_invalid_field(mocker):
         ("csv", ["foo"], [{"foo": "bar"}], "bar\r\n"),
         ("csv", ["foo", "bar"], [{"foo": "bar", "bar": "foo"}], "bar,foo\r\n"),
     ],
-    ids=[
+    ids=["json-single", "json-many", "json-empty", "ndjson-single", "ndjson-many"]
+    + [
         f"{type_}-{number}"
-        for type_ in ["json", "human", "tsv", "csv"]
+        for type_ in ["human", "tsv", "csv"]
         for number in ["single", "many"]
     ],
 )
 def test_serializer(output_format, fields, data, expected):
     assert serialize(data=data, output_format=output_format, fields=fields) == expected
+
+
+def _instance_information(instance_id, ping_status="Online"):
+    return {"InstanceId": instance_id, "PingStatus": ping_status}
+
+
+def test_list_in_batches(mocker, capsys):
+    mocker.patch("aws_gate.list.LIST_BATCH_SIZE", 2)
+    mocker.patch("aws_gate.decorators.is_existing_region", return_value=True)
+    mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
+
+    ssm = mocker.MagicMock()
+    ssm.get_paginator.return_value.paginate.return_value = [
+        {
+            "InstanceInformationList": [
+                _instance_information("i-3"),
+                _instance_information("i-1"),
+                _instance_information("i-2", ping_status="ConnectionLost"),
+            ]
+        },
+        {
+            "InstanceInformationList": [
+                _instance_information("i-terminated"),
+                _instance_information("mi-onpremise"),
+                _instance_information("i-4"),
+            ]
+        },
+    ]
+    mocker.patch("aws_gate.list.get_aws_client", return_value=ssm)
+
+    def _describe_instances(Filters):  # pylint: disable=invalid-name
+        # EC2 API does not keep the order of instances and skips unknown ones
+        instance_ids = Filters[0]["Values"]
+        result = mocker.MagicMock()
+        result.search.return_value = [
+            {"InstanceId": instance_id, "Placement": {"AvailabilityZone": "eu-west-1a"}}
+            for instance_id in sorted(instance_ids, reverse=True)
+            if instance_id.startswith("i-") and instance_id != "i-terminated"
+        ]
+        return result
+
+    ec2 = mocker.MagicMock()
+    paginator = ec2.meta.client.get_paginator.return_value
+    paginator.paginate.side_effect = _describe_instances
+    mocker.patch("aws_gate.list.get_aws_resource", return_value=ec2)
+
+    list_instances(
+        profile_name="default",
+        region_name="eu-west-1",
+        fields=["instance_id", "vpc_id"],
+    )
+    out, _ = capsys.readouterr()
+
+    # Instances unknown to EC2 API are listed without EC2 details
+    assert out.split() == ["i-3", "i-1", "i-terminated", "mi-onpremise", "i-4"]
+    assert sorted(
+        c[1]["Filters"][0]["Values"] for c in paginator.paginate.call_args_list
+    ) == [["i-3", "i-1"], ["i-4"], ["i-terminated"]]
+
+
+def test_fetch_instance_details_no_instances(mocker):
+    ec2 = mocker.MagicMock()
+
+    assert not list(_fetch_instance_details([], ec2))
+    assert not ec2.meta.client.get_paginator.called
+
+
+def test_fetch_instance_details_unknown_instances(mocker):
+    ec2 = mocker.MagicMock()
+    paginator = ec2.meta.client.get_paginator.return_value
+    paginator.paginate.return_value.search.return_value = []
+    instances = [{"instance_id": "i-terminated"}, {"instance_id": "mi-onpremise"}]
+
+    assert list(_fetch_instance_details(instances, ec2)) == [
+        {"instance_id": "i-terminated", "tags": {}},
+        {"instance_id": "mi-onpremise", "tags": {}},
+    ]
+
+    # EC2 API filters leave out instances EC2 API does not know about
+    filters = [{"Name": "vpc-id", "Values": ["vpc-1"]}]
+    assert not list(_fetch_instance_details(instances, ec2, filters=filters))
+
+
+def test_fetch_instance_details_managed_instances(mocker):
+    ec2 = mocker.MagicMock()
+
+    assert list(_fetch_instance_details([{"instance_id": "mi-onpremise"}], ec2)) == [
+        {"instance_id": "mi-onpremise", "tags": {}}
+    ]
+    assert not ec2.meta.client.get_paginator.called
+
+
+def test_fetch_instance_details_exception(mocker):
+    ec2 = mocker.MagicMock()
+    ec2.meta.client.get_paginator.return_value.paginate.side_effect = ClientError(
+        {"Error": {"Code": "UnauthorizedOperation"}}, "DescribeInstances"
+    )
+
+    with pytest.raises(AWSConnectionError):
+        list(_fetch_instance_details([{"instance_id": "i-0c32153096cd68a6d"}], ec2))
+
+
+@pytest.mark.parametrize(
+    "output_format, expected",
+    [
+        ("json", '[\n    {\n        "foo": "bar"\n    },\n    {}\n]\n'),
+        ("ndjson", '{"foo": "bar"}\n{}\n'),
+        ("csv", 'bar\r\n""\n'),
+        ("human", 'bar\r\n""\n'),
+    ],
+)
+def test_print_stream(output_format, expected):
+    output = io.StringIO()
+
+    _print_stream(
+        serialize_stream(
+            [{"foo": "bar"}, {"bar": "foo"}],
+            output_format=output_format,
+            fields=["foo"],
+        ),
+        stream=output,
+    )
+
+    assert output.getvalue() == expected
+
+
+def test_print_stream_empty(capsys):
+    _print_stream(iter([]))
+    out, _ = capsys.readouterr()
+
+    assert out == "\n"
+
+
+def test_list_streams_output(mocker, capsys):
+    mocker.patch("aws_gate.list.LIST_BATCH_SIZE", 1)
+    mocker.patch("aws_gate.list.LIST_MAX_WORKERS", 2)
+    mocker.patch("aws_gate.decorators.is_existing_region", return_value=True)
+    mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
+    mocker.patch("aws_gate.list.get_aws_client")
+    mocker.patch("aws_gate.list.get_aws_resource")
+
+    printed = []
+
+    def _instances():
+        for instance_id in ["i-1", "i-2", "i-3", "i-4"]:
+            # Instances are printed before all of them have been read from SSM
+            printed.append(capsys.readouterr().out)
+            yield {"instance_id": instance_id}
+
+    mocker.patch("aws_gate.list._iter_online_instances", return_value=_instances())
+    mocker.patch(
+        "aws_gate.list._fetch_instance_details_batch",
+        side_effect=lambda batch, _ec2, _filters: batch,
+    )
+
+    list_instances(
+        profile_name="default",
+        region_name="eu-west-1",
+        output_format="ndjson",
+        fields=["instance_id", "vpc_id"],
+    )
+
+    assert "".join(printed) + capsys.readouterr().out == "".join(
+        json.dumps({"instance_id": f"i-{i}"}) + "\n" for i in range(1, 5)
+    )
+    assert printed[-1] != ""
+
+
+@pytest.fixture(name="targets")
+def targets_fixture(mocker):
+    mocker.patch("aws_gate.decorators.is_existing_region", return_value=True)
+    mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
+
+    def _list_target(profile_name, region_name, _plan):
+        yield {"instance_id": f"i-{profile_name}", "region": region_name}
+        if region_name == "us-east-1" and profile_name == "prod":
+            raise AWSConnectionError("access denied")
+
+    return mocker.patch("aws_gate.list._list_target", side_effect=_list_target)
+
+
+def test_list_targets(targets, capsys, caplog):
+    caplog.set_level(logging.INFO, logger="aws_gate.list")
+
+    with pytest.raises(AWSConnectionError):
+        list_instances(
+            profile_name="default",
+            region_name="eu-west-1",
+            fields=["instance_id", "region"],
+            profile_names=["dev", "prod"],
+            region_names=["eu-west-1", "us-east-1"],
+        )
+    out, _ = capsys.readouterr()
+
+    assert sorted(out.splitlines()) == [
+        "i-dev eu-west-1",
+        "i-dev us-east-1",
+        "i-prod eu-west-1",
+        "i-prod us-east-1",
+    ]
+    assert targets.call_count == 4
+    assert "dev/eu-west-1: 1 instances in" in caplog.text
+    assert "prod/us-east-1: failed after" in caplog.text
+
+
+@pytest.mark.parametrize(
+    "profile_names, region_names",
+    [(["dev", "invalid-profile"], None), (None, ["eu-west-1", "invalid-region"])],
+    ids=["profile", "region"],
+)
+def test_list_targets_invalid(mocker, profile_names, region_names):
+    mocker.patch(
+        "aws_gate.decorators.is_existing_profile",
+        side_effect=lambda p: p != "invalid-profile",
+    )
+    mocker.patch(
+        "aws_gate.decorators.is_existing_region",
+        side_effect=lambda r: r != "invalid-region",
+    )
+
+    with pytest.raises(ValueError):
+        list_instances(
+            profile_name="default",
+            region_name="eu-west-1",
+            profile_names=profile_names,
+            region_names=region_names,
+        )
+
+
+def test_list_targets_unused_profile_and_region(mocker, targets, capsys):
+    mocker.patch(
+        "aws_gate.decorators.is_existing_profile",
+        side_effect=lambda p: p in ["a", "b"],
+    )
+    mocker.patch(
+        "aws_gate.decorators.is_existing_region",
+        side_effect=lambda r: r == "eu-west-1",
+    )
+
+    # The profile and region instances are not listed from do not have to exist
+    list_instances(
+        profile_name="default",
+        region_name="invalid-region",
+        fields=["instance_id"],
+        profile_names=["a", "b"],
+        region_names=["eu-west-1"],
+    )
+
+    assert sorted(capsys.readouterr().out.splitlines()) == ["i-a", "i-b"]
+    assert targets.call_count == 2
+
+
+@pytest.mark.usefixtures("targets")
+def test_list_targets_stopped():
+    instances = _list_targets(
+        [("dev", "eu-west-1"), ("dev", "us-east-1")],
+        {"filters": {"ssm": [], "ec2": [], "local": []}, "sources": {"ssm"}},
+        [],
+    )
+
+    assert next(instances)["instance_id"] == "i-dev"
+    instances.close()
+
+
+def test_produce_target_stopped(mocker):
+    mocker.patch(
+        "aws_gate.list._list_target", return_value=iter([{"instance_id": "i-1"}])
+    )
+    items = queue.Queue(maxsize=1)
+    items.put({"instance_id": "i-0"})
+    stop = threading.Event()
+    threading.Timer(0.2, stop.set).start()
+
+    _produce_target("dev", "eu-west-1", {}, items, stop)
+
+    assert items.get_nowait() == {"instance_id": "i-0"}
+    assert items.empty()
+
+
+@pytest.mark.parametrize(
+    "filters, expected",
+    [
+        (None, {"ssm": [], "ec2": [], "local": []}),
+        (
+            ["platform=Linux,MacOS"],
+            {
+                "ssm": [{"Key": "PlatformTypes", "Values": ["Linux", "MacOS"]}],
+                "ec2": [],
+                "local": [],
+            },
+        ),
+        (
+            ["tag:team=web", "vpc=vpc-1", "az=eu-west-1a", "name=web-"],
+            {
+                "ssm": [],
+                "ec2": [
+                    {"Name": "tag:team", "Values": ["web"]},
+                    {"Name": "vpc-id", "Values": ["vpc-1"]},
+                    {"Name": "availability-zone", "Values": ["eu-west-1a"]},
+                    {"Name": "tag:Name", "Values": ["web-*"]},
+                ],
+                "local": [],
+            },
+        ),
+        (
+            ["private_ip_address=10.0.*,10.1.*"],
+            {
+                "ssm": [],
+                "ec2": [],
+                "local": [("private_ip_address", ["10.0.*", "10.1.*"])],
+            },
+        ),
+    ],
+    ids=["none", "ssm", "ec2", "local"],
+)
+def test_parse_filters(filters, expected):
+    assert _parse_filters(filters) == expected
+
+
+@pytest.mark.parametrize(
+    "expression", ["vpc", "vpc=", "=vpc-1", "vpc=,", "unknown=value"]
+)
+def test_parse_filters_invalid(expression):
+    with pytest.raises(ValueError):
+        _parse_filters([expression])
+
+
+@pytest.mark.parametrize(
+    "instance, expected",
+    [
+        ({"instance_name": "web-1", "vpc_id": "vpc-1"}, True),
+        ({"instance_name": "db-1", "vpc_id": "vpc-1"}, True),
+        ({"instance_name": "web-1", "vpc_id": "vpc-2"}, False),
+        ({"instance_name": None, "vpc_id": "vpc-1"}, False),
+    ],
+)
+def test_matches_local_filters(instance, expected):
+    local_filters = [("instance_name", ["web-*", "db-*"]), ("vpc_id", ["vpc-1"])]
+
+    assert _matches_local_filters(instance, local_filters) == expected
+
+
+def test_list_filters(mocker, capsys):
+    mocker.patch("aws_gate.decorators.is_existing_region", return_value=True)
+    mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
+
+    ssm = mocker.MagicMock()
+    ssm_paginator = ssm.get_paginator.return_value
+    ssm_paginator.paginate.return_value = [
+        {
+            "InstanceInformationList": [
+                _instance_information("i-1"),
+                _instance_information("i-2"),
+            ]
+        },
+    ]
+    mocker.patch("aws_gate.list.get_aws_client", return_value=ssm)
+
+    ec2 = mocker.MagicMock()
+    ec2_paginator = ec2.meta.client.get_paginator.return_value
+    ec2_paginator.paginate.return_value.search.return_value = [
+        {
+            "InstanceId": instance_id,
+            "Placement": {"AvailabilityZone": "eu-west-1a"},
+            "Tags": [{"Key": "Name", "Value": instance_name}],
+        }
+        for instance_id, instance_name in [("i-1", "web-1"), ("i-2", "db-1")]
+    ]
+    mocker.patch("aws_gate.list.get_aws_resource", return_value=ec2)
+
+    list_instances(
+        profile_name="default",
+        region_name="eu-west-1",
+        fields=["instance_id"],
+        filters=["platform=Linux", "vpc=vpc-1", "instance_name=web-*"],
+    )
+    out, err = capsys.readouterr()
+
+    assert out == "i-1\n"
+    assert ssm_paginator.paginate.call_args == mocker.call(
+        Filters=[
+            {"Key": "PingStatus", "Values": ["Online"]},
+            {"Key": "PlatformTypes", "Values": ["Linux"]},
+        ]
+    )
+    assert ec2_paginator.paginate.call_args == mocker.call(
+        Filters=[
+            {"Name": "instance-id", "Values": ["i-1", "i-2"]},
+            {"Name": "vpc-id", "Values": ["vpc-1"]},
+        ]
+    )
+    assert err == (
+        "Filters applied by SSM API: platform=Linux; by EC2 API: vpc=vpc-1; "
+        "locally: instance_name=web-*\n"
+    )
+
+
+@pytest.mark.parametrize(
+    "fields, filters, expected",
+    [
+        (["instance_id", "ping_status"], [], {"ssm"}),
+        (["instance_id", "region"], [], {"ssm", None}),
+        (["instance_id"], ["vpc=vpc-1"], {"ssm", "ec2"}),
+        (["instance_id"], ["private_ip_address=10.*"], {"ssm", "ec2"}),
+        (["instance_id", "asg_name"], [], {"ssm", "ec2"}),
+    ],
+    ids=["ssm", "target", "ec2-filter", "local-filter", "ec2-field"],
+)
+def test_get_required_sources(fields, filters, expected):
+    assert _get_required_sources(fields, _parse_filters(filters)) == expected
+
+
+def test_list_ssm_fields_only(mocker, ssm, capsys):
+    mocker.patch("aws_gate.list.get_aws_client", return_value=ssm)
+    ec2_mock = mocker.patch("aws_gate.list.get_aws_resource")
+    mocker.patch("aws_gate.decorators.is_existing_region", return_value=True)
+    mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
+
+    list_instances(
+        profile_name="default",
+        region_name="eu-west-1",
+        fields=["instance_id", "ping_status"],
+    )
+    out, _ = capsys.readouterr()
+
+    assert out == "i-0c32153096cd68a6d Online\n"
+    assert not ec2_mock.called
+
+
+def test_list_enrichment_fields(mocker, capsys):
+    mocker.patch("aws_gate.decorators.is_existing_region", return_value=True)
+    mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
+
+    ssm = mocker.MagicMock()
+    ssm.get_paginator.return_value.paginate.return_value = [
+        {
+            "InstanceInformationList": [
+                dict(
+                    _instance_information("i-1"),
+                    AgentVersion="3.0.1",
+                    PlatformType="Linux",
+                )
+            ]
+        }
+    ]
+    mocker.patch("aws_gate.list.get_aws_client", return_value=ssm)
+
+    ec2 = mocker.MagicMock()
+    ec2.meta.client.get_paginator.return_value.paginate.return_value.search.return_value = [  # noqa: B950
+        {
+            "InstanceId": "i-1",
+            "Placement": {"AvailabilityZone": "eu-west-1a"},
+            "Tags": [
+                {"Key": "Name", "Value": "web-1"},
+                {"Key": "aws:autoscaling:groupName", "Value": "web"},
+            ],
+        }
+    ]
+    mocker.patch("aws_gate.list.get_aws_resource", return_value=ec2)
+
+    list_instances(
+        profile_name="default",
+        region_name="eu-west-1",
+        output_format="csv",
+        fields=[
+            "instance_id",
+            "agent_version",
+            "platform",
+            "instance_name",
+            "asg_name",
+        ],
+    )
+    out, _ = capsys.readouterr()
+
+    assert out == "i-1,3.0.1,Linux,web-1,web\n"
+
+
+@pytest.mark.parametrize(
+    "inventory_instances, live_calls", [([{"instance_id": "i-1"}], 0), (None, 1)]
+)
+def test_list_from_inventory(mocker, capsys, inventory_instances, live_calls):
+    mocker.patch("aws_gate.decorators.is_existing_region", return_value=True)
+    mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
+    inventory_mock = mocker.patch(
+        "aws_gate.list.iter_inventory_instances", return_value=inventory_instances
+    )
+    live_mock = mocker.patch(
+        "aws_gate.list._iter_live_instances",
+        return_value=iter([{"instance_id": "i-1"}]),
+    )
+
+    list_instances(
+        profile_name="default",
+        region_name="eu-west-1",
+        output_format="tsv",
+        fields=["instance_id", "profile"],
+        inventory=True,
+    )
+
+    assert capsys.readouterr().out == "i-1\tdefault\n"
+    assert inventory_mock.call_args[0][:2] == ("default", "eu-west-1")
+    assert live_mock.call_count == live_calls
+
+
+def test_list_known_instances(mocker):
+    ssm = mocker.MagicMock()
+    ssm.get_paginator.return_value.paginate.return_value = [
+        {"InstanceInformationList": [_instance_information("i-1")]},
+        {"InstanceInformationList": [_instance_information("i-2")]},
+    ]
+    mocker.patch("aws_gate.list.get_aws_client", return_value=ssm)
+    mocker.patch("aws_gate.list.get_aws_resource")
+    fetch_mock = mocker.patch(
+        "aws_gate.list._fetch_instance_details_batch",
+        side_effect=lambda batch, _ec2, _filters: [
+            dict(instance, vpc_id="vpc-fetched") for instance in batch
+        ],
+    )
+    fingerprint = _get_fingerprint(_instance_information("i-1"))
+    known = {
+        ("default", "eu-west-1"): {
+            "i-1": {
+                "instance_id": "i-1",
+                "vpc_id": "vpc-1",
+                "fingerprint": fingerprint,
+            },
+            "i-2": {"instance_id": "i-2", "vpc_id": "vpc-2", "fingerprint": "old"},
+        }
+    }
+
+    instances = iter_instances([("default", "eu-west-1")], known=known)
+
+    assert [(i["instance_id"], i["vpc_id"]) for i in instances] == [
+        ("i-1", "vpc-1"),
+        ("i-2", "vpc-fetched"),
+    ]
+    assert fetch_mock.call_count == 1
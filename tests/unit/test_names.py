@@ -0,0 +1,95 @@
+import pytest
+
+from aws_gate.names import NameIndex, build_name_index, instance_not_found
+
+NAMES = [
+    "web-1",
+    "web-2",
+    "web",
+    "worker-1",
+    "database-primary",
+    "database-replica",
+    "bastion",
+]
+
+
+@pytest.fixture(name="index")
+def index_fixture():
+    return NameIndex(NAMES + ["web", ""])
+
+
+def test_name_index(index):
+    assert len(index) == len(NAMES)
+    assert "web" in index
+    assert "we" not in index
+
+
+@pytest.mark.parametrize(
+    "prefix, limit, expected",
+    [
+        ("web", None, ["web", "web-1", "web-2"]),
+        ("w", 2, ["web", "web-1"]),
+        ("database-", None, ["database-primary", "database-replica"]),
+        ("x", None, []),
+        ("", 1, ["bastion"]),
+    ],
+)
+def test_name_index_complete(index, prefix, limit, expected):
+    assert index.complete(prefix, limit=limit) == expected
+
+
+def test_name_index_complete_order():
+    # Names are completed in lexicographic order, not shorter names first
+    index = NameIndex(["b", "abc", "ab", "a-z"])
+
+    assert index.complete("") == ["a-z", "ab", "abc", "b"]
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ("databse-primary", "database-primary"),
+        ("bastoin", "bastion"),
+        ("Worker-1", "worker-1"),
+    ],
+)
+def test_name_index_fuzzy(index, name, expected):
+    assert index.fuzzy(name)[0] == expected
+
+
+def test_name_index_fuzzy_no_match(index):
+    assert not index.fuzzy("zzz")
+
+
+def test_name_index_suggest(index):
+    # Completions of the name come first, similar names follow
+    assert index.suggest("web") == ["web-1", "web-2"]
+    assert index.suggest("bastoin") == ["bastion"]
+
+
+def test_build_name_index(mocker):
+    mocker.patch("aws_gate.names.get_instance_names", return_value=["web-1"])
+    config = mocker.MagicMock(
+        hosts=[{"alias": "db"}, {"alias": "web-*"}, {"alias": "web-1"}]
+    )
+
+    index = build_name_index(config)
+
+    assert index.complete("") == ["db", "web-1"]
+
+
+@pytest.mark.parametrize(
+    "name, message",
+    [
+        (
+            "web-3",
+            "No instance could be found for name: web-3 "
+            "(did you mean: web-1, web-2?)",
+        ),
+        ("zzz", "No instance could be found for name: zzz"),
+    ],
+)
+def test_instance_not_found(mocker, name, message):
+    mocker.patch("aws_gate.names.get_instance_names", return_value=["web-1", "web-2"])
+
+    assert str(instance_not_found(name, mocker.MagicMock(hosts=[]))) == message
@@ -1,7 +1,56 @@
+import datetime
+import logging
+import threading
+
 import pytest
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, ProfileNotFound
+
+from aws_gate.query import (
+    SSM_INSTANCE_GONE_ERRORS,
+    _query_aws_api,
+    invalidate_cached_instance,
+    invalidate_cached_instance_on_error,
+    query_instance,
+    query_instance_details,
+    query_instance_in_profiles,
+    query_instances,
+    resolve_instance,
+    AWSConnectionError,
+)
+
+
+def _instance(instance_id, launch_time, availability_zone="eu-west-1a"):
+    return {
+        "InstanceId": instance_id,
+        "LaunchTime": datetime.datetime(2023, 1, launch_time),
+        "Placement": {"AvailabilityZone": availability_zone},
+    }
+
+
+@pytest.fixture(name="instances")
+def instances_fixture():
+    return [
+        _instance("i-1", 2),
+        _instance("i-2", 3, availability_zone="eu-west-1b"),
+        _instance("i-3", 1, availability_zone="eu-west-1b"),
+    ]
 
-from aws_gate.query import _query_aws_api, query_instance, AWSConnectionError
+
+@pytest.fixture(name="paginated_ec2")
+def paginated_ec2_fixture(mocker, instances):
+    consumed = []
+
+    def _search(expression):
+        assert expression == "Reservations[].Instances[]"
+        for instance in instances:
+            consumed.append(instance["InstanceId"])
+            yield instance
+
+    ec2_mock = mocker.MagicMock()
+    paginator = ec2_mock.meta.client.get_paginator.return_value
+    paginator.paginate.return_value.search.side_effect = _search
+    ec2_mock.consumed = consumed
+    return ec2_mock
 
 
 def test_query_aws_api_exception(mocker):
@@ -10,7 +59,11 @@ def test_query_aws_api_exception(mocker):
     # https://github.com/surbas/pg2kinesis/blob/master/tests/test_stream.py#L20
     error_response = {"Error": {"Code": "ResourceInUseException"}}
     ec2_mock.configure_mock(
-        **{"instances.filter.side_effect": ClientError(error_response, "random_ec2_op")}
+        **{
+            "meta.client.get_paginator.return_value.paginate.side_effect": ClientError(
+                error_response, "random_ec2_op"
+            )
+        }
     )
 
     filters = [{"Name": "ip-address", "Values": ["10.1.1.1"]}]
@@ -72,3 +125,665 @@ def test_query_instance_by_tag_parsing(mocker, name, expected, ec2):
 def test_query_instance_ec2_unitialized():
     with pytest.raises(ValueError):
         query_instance("18.205.215.108")
+
+
+def test_query_instance_cache(mocker, ec2):
+    m = mocker.patch(
+        "aws_gate.query._query_aws_api",
+        return_value={"instance_id": "i-0c32153096cd68a6d"},
+    )
+
+    for _ in range(2):
+        assert (
+            query_instance(
+                "dummy-instance",
+                ec2=ec2,
+                profile_name="default",
+                region_name="eu-west-1",
+            )
+            == "i-0c32153096cd68a6d"
+        )
+
+    assert m.call_count == 1
+
+
+@pytest.mark.parametrize(
+    "cached, other",
+    [
+        (("default", "eu-west-1"), ("default", "eu-central-1")),
+        (("default", "eu-west-1"), ("production", "eu-west-1")),
+    ],
+    ids=["region", "profile"],
+)
+def test_query_instance_cache_key(mocker, ec2, cached, other):
+    m = mocker.patch(
+        "aws_gate.query._query_aws_api",
+        return_value={"instance_id": "i-0c32153096cd68a6d"},
+    )
+
+    for profile_name, region_name in (cached, other):
+        query_instance(
+            "dummy-instance",
+            ec2=ec2,
+            profile_name=profile_name,
+            region_name=region_name,
+        )
+
+    assert m.call_count == 2
+
+
+def test_query_instance_cache_without_profile(mocker, ec2):
+    m = mocker.patch(
+        "aws_gate.query._query_aws_api",
+        return_value={"instance_id": "i-0c32153096cd68a6d"},
+    )
+
+    query_instance("dummy-instance", ec2=ec2)
+    query_instance("dummy-instance", ec2=ec2)
+
+    assert m.call_count == 2
+
+
+@pytest.mark.parametrize(
+    "instance_id, ttl, negative_ttl, calls",
+    [
+        ("i-0c32153096cd68a6d", 300, 30, 1),
+        ("i-0c32153096cd68a6d", 0, 30, 2),
+        (None, 300, 30, 1),
+        (None, 300, 0, 2),
+    ],
+    ids=["positive", "positive disabled", "negative", "negative disabled"],
+)
+def test_query_instance_cache_ttl(mocker, ec2, instance_id, ttl, negative_ttl, calls):
+    mocker.patch("aws_gate.query.INSTANCE_CACHE_TTL", ttl)
+    mocker.patch("aws_gate.query.INSTANCE_CACHE_NEGATIVE_TTL", negative_ttl)
+    m = mocker.patch(
+        "aws_gate.query._query_aws_api",
+        return_value={"instance_id": instance_id} if instance_id else None,
+    )
+
+    for _ in range(2):
+        assert (
+            query_instance(
+                "dummy-instance",
+                ec2=ec2,
+                profile_name="default",
+                region_name="eu-west-1",
+            )
+            == instance_id
+        )
+
+    assert m.call_count == calls
+
+
+def test_query_instance_cache_expired(mocker, ec2):
+    time_mock = mocker.patch("aws_gate.query.time.time", return_value=1000)
+    m = mocker.patch(
+        "aws_gate.query._query_aws_api",
+        return_value={"instance_id": "i-0c32153096cd68a6d"},
+    )
+    kwargs = {"ec2": ec2, "profile_name": "default", "region_name": "eu-west-1"}
+
+    query_instance("dummy-instance", **kwargs)
+    time_mock.return_value = 1000 + 299
+    query_instance("dummy-instance", **kwargs)
+    time_mock.return_value = 1000 + 300
+    query_instance("dummy-instance", **kwargs)
+
+    assert m.call_count == 2
+
+
+def test_query_instance_cache_corrupted(mocker, ec2, gate_cache_dir):
+    gate_cache_dir.mkdir()
+    (gate_cache_dir / "instances.json").write_text("{")
+    m = mocker.patch(
+        "aws_gate.query._query_aws_api",
+        return_value={"instance_id": "i-0c32153096cd68a6d"},
+    )
+
+    assert (
+        query_instance(
+            "dummy-instance", ec2=ec2, profile_name="default", region_name="eu-west-1"
+        )
+        == "i-0c32153096cd68a6d"
+    )
+    assert m.called
+
+
+@pytest.mark.parametrize(
+    "code, invalidated",
+    [("TargetNotConnected", True), ("AccessDeniedException", False)],
+    ids=["instance gone", "other error"],
+)
+def test_invalidate_cached_instance_on_error(mocker, ec2, code, invalidated):
+    m = mocker.patch(
+        "aws_gate.query._query_aws_api",
+        return_value={"instance_id": "i-0c32153096cd68a6d"},
+    )
+    kwargs = {"ec2": ec2, "profile_name": "default", "region_name": "eu-west-1"}
+    query_instance("dummy-instance", **kwargs)
+
+    with pytest.raises(ClientError):
+        with invalidate_cached_instance_on_error(
+            "i-0c32153096cd68a6d", SSM_INSTANCE_GONE_ERRORS
+        ):
+            raise ClientError({"Error": {"Code": code}}, "StartSession")
+
+    query_instance("dummy-instance", **kwargs)
+
+    assert m.call_count == (2 if invalidated else 1)
+
+
+def test_query_instance_cache_format_mismatch(mocker, ec2, gate_cache_dir):
+    gate_cache_dir.mkdir()
+    (gate_cache_dir / "instances.json").write_text('{"format": 0, "instances": {}}')
+    m = mocker.patch(
+        "aws_gate.query._query_aws_api",
+        return_value={"instance_id": "i-0c32153096cd68a6d"},
+    )
+
+    query_instance(
+        "dummy-instance", ec2=ec2, profile_name="default", region_name="eu-west-1"
+    )
+
+    assert m.called
+
+
+def test_query_instance_cache_write_failure(mocker, ec2):
+    mocker.patch(
+        "aws_gate.query._query_aws_api",
+        return_value={"instance_id": "i-0c32153096cd68a6d"},
+    )
+    mocker.patch("aws_gate.query.write_file_atomically", side_effect=OSError)
+
+    assert (
+        query_instance(
+            "dummy-instance", ec2=ec2, profile_name="default", region_name="eu-west-1"
+        )
+        == "i-0c32153096cd68a6d"
+    )
+
+
+def test_invalidate_cached_instance_not_cached(mocker):
+    m = mocker.patch("aws_gate.query._store_instance_cache")
+    remove_mock = mocker.patch("aws_gate.query.remove_instance")
+
+    invalidate_cached_instance("i-0c32153096cd68a6d")
+
+    assert not m.called
+    # Instances known only to the inventory are forgotten as well
+    assert remove_mock.call_args == mocker.call("i-0c32153096cd68a6d")
+
+
+def test_query_instance_details(ec2, ec2_api_calls):
+    details = query_instance_details("dummy-instance", ec2=ec2)
+
+    assert details["instance_id"] == "i-0c32153096cd68a6d"
+    assert details["instance_name"] == "dummy-instance"
+    assert details["availability_zone"] == "eu-west-1a"
+    assert ec2_api_calls == ["DescribeInstances"]
+
+
+def test_query_instance_details_by_id(mocker, ec2):
+    m = mocker.patch(
+        "aws_gate.query.get_instance_details",
+        return_value={"instance_id": "i-0c32153096cd68a6d"},
+    )
+
+    assert query_instance_details("i-0c32153096cd68a6d", ec2=ec2) == {
+        "instance_id": "i-0c32153096cd68a6d"
+    }
+    assert m.call_args == mocker.call(instance_id="i-0c32153096cd68a6d", ec2=ec2)
+
+
+def test_query_instance_details_by_id_not_found(mocker, ec2):
+    error = ClientError(
+        {"Error": {"Code": "InvalidInstanceID.NotFound"}}, "DescribeInstances"
+    )
+    mocker.patch(
+        "aws_gate.query.get_instance_details", side_effect=AWSConnectionError(error)
+    )
+
+    assert query_instance_details("i-0c32153096cd68a6d", ec2=ec2) is None
+    assert not list(query_instances("i-0c32153096cd68a6d", ec2=ec2))
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        ClientError({"Error": {"Code": "UnauthorizedOperation"}}, "DescribeInstances"),
+        "Connection reset",
+    ],
+    ids=["client error", "other error"],
+)
+def test_query_instance_details_by_id_error(mocker, ec2, error):
+    mocker.patch(
+        "aws_gate.query.get_instance_details", side_effect=AWSConnectionError(error)
+    )
+
+    with pytest.raises(AWSConnectionError):
+        query_instance_details("i-0c32153096cd68a6d", ec2=ec2)
+
+
+def test_query_instance_details_by_id_fallback_regions(mocker):
+    error = ClientError(
+        {"Error": {"Code": "InvalidInstanceID.NotFound"}}, "DescribeInstances"
+    )
+    mocker.patch(
+        "aws_gate.query.get_aws_resource",
+        side_effect=lambda service, region_name, profile_name: region_name,
+    )
+
+    def _describe(instance_id, ec2):
+        if ec2 != "eu-central-1":
+            raise AWSConnectionError(error)
+        return {"instance_id": instance_id}
+
+    mocker.patch("aws_gate.query.get_instance_details", side_effect=_describe)
+
+    assert query_instance_details(
+        "i-0c32153096cd68a6d",
+        ec2="eu-west-1",
+        profile_name="default",
+        region_name="eu-west-1",
+        fallback_regions=["eu-central-1"],
+    ) == {"instance_id": "i-0c32153096cd68a6d", "region_name": "eu-central-1"}
+
+
+def test_query_instance_details_ec2_unitialized():
+    with pytest.raises(ValueError):
+        query_instance_details("dummy-instance")
+
+
+def test_query_instance_details_managed_instance(ec2, ec2_api_calls):
+    assert query_instance_details("mi-0c32153096cd68a6d", ec2=ec2) == {
+        "instance_id": "mi-0c32153096cd68a6d"
+    }
+    assert not ec2_api_calls
+
+
+def test_query_instance_by_id_skips_api(ec2, ec2_api_calls):
+    assert query_instance("i-0c32153096cd68a6d", ec2=ec2) == "i-0c32153096cd68a6d"
+    assert not ec2_api_calls
+
+
+@pytest.mark.parametrize(
+    "selection, availability_zone, expected, consumed",
+    [
+        ("first", None, "i-1", ["i-1"]),
+        ("newest", None, "i-2", ["i-1", "i-2", "i-3"]),
+        ("same-az", "eu-west-1b", "i-2", ["i-1", "i-2"]),
+        ("same-az", "eu-west-1c", "i-1", ["i-1", "i-2", "i-3"]),
+    ],
+    ids=["first", "newest", "same-az", "same-az (fallback)"],
+)
+def test_query_aws_api_selection(
+    paginated_ec2, selection, availability_zone, expected, consumed
+):
+    details = _query_aws_api(
+        filters=[],
+        ec2=paginated_ec2,
+        selection=selection,
+        availability_zone=availability_zone,
+    )
+
+    assert details["instance_id"] == expected
+    assert paginated_ec2.consumed == consumed
+
+
+def test_query_aws_api_selection_random(mocker, paginated_ec2):
+    mocker.patch("aws_gate.query.random.randrange", side_effect=[0, 0, 1])
+
+    details = _query_aws_api(filters=[], ec2=paginated_ec2, selection="random")
+
+    assert details["instance_id"] == "i-2"
+
+
+@pytest.mark.parametrize(
+    "selection", ["first", "newest", "random", "same-az"], ids=lambda s: s
+)
+def test_query_aws_api_no_match(mocker, selection):
+    ec2_mock = mocker.MagicMock()
+    paginator = ec2_mock.meta.client.get_paginator.return_value
+    paginator.paginate.return_value.search.return_value = iter([])
+
+    assert (
+        _query_aws_api(
+            filters=[],
+            ec2=ec2_mock,
+            selection=selection,
+            availability_zone="eu-west-1a",
+        )
+        is None
+    )
+
+
+@pytest.mark.parametrize(
+    "selection, availability_zone",
+    [("unknown", None), ("same-az", None)],
+    ids=["unknown policy", "same-az without availability zone"],
+)
+def test_query_instance_details_invalid_selection(ec2, selection, availability_zone):
+    with pytest.raises(ValueError):
+        query_instance_details(
+            "dummy-instance",
+            ec2=ec2,
+            selection=selection,
+            availability_zone=availability_zone,
+        )
+
+
+def test_query_instance_random_selection_not_cached(mocker, ec2):
+    m = mocker.patch(
+        "aws_gate.query._query_aws_api",
+        return_value={"instance_id": "i-0c32153096cd68a6d"},
+    )
+    kwargs = {"ec2": ec2, "profile_name": "default", "region_name": "eu-west-1"}
+
+    for _ in range(2):
+        query_instance("dummy-instance", selection="random", **kwargs)
+
+    assert m.call_count == 2
+
+
+def test_query_instances(paginated_ec2):
+    assert [
+        i["instance_id"] for i in query_instances("role:web", ec2=paginated_ec2)
+    ] == [
+        "i-1",
+        "i-2",
+        "i-3",
+    ]
+    filters = paginated_ec2.meta.client.get_paginator.return_value.paginate.call_args[
+        1
+    ]["Filters"]
+    assert filters[0] == {"Name": "tag:role", "Values": ["web"]}
+
+
+def test_query_instances_by_id(ec2_mock):
+    assert list(query_instances("mi-0c32153096cd68a6d", ec2=ec2_mock)) == [
+        {"instance_id": "mi-0c32153096cd68a6d"}
+    ]
+
+
+def test_query_instances_ec2_unitialized():
+    with pytest.raises(ValueError):
+        list(query_instances("dummy-instance"))
+
+
+@pytest.fixture(name="regional_lookup")
+def regional_lookup_fixture(mocker):
+    # EC2 "resources" are region names, so lookups can tell where they run
+    mocker.patch(
+        "aws_gate.query.get_aws_resource",
+        side_effect=lambda service, region_name, profile_name: region_name,
+    )
+
+    def _lookup(_name, ec2, *_args):
+        if ec2 == "eu-central-1":
+            return {"instance_id": "i-0c32153096cd68a6d"}
+        if ec2 == "us-east-1":
+            raise AWSConnectionError("region disabled")
+        return None
+
+    return mocker.patch("aws_gate.query._query_instance_details", side_effect=_lookup)
+
+
+def test_query_instance_details_fallback_regions(regional_lookup):
+    kwargs = {"ec2": "eu-west-1", "profile_name": "default", "region_name": "eu-west-1"}
+
+    for _ in range(2):
+        details = query_instance_details(
+            "dummy-instance",
+            fallback_regions=["eu-west-1", "us-east-1", "eu-central-1"],
+            **kwargs,
+        )
+        assert details == {
+            "instance_id": "i-0c32153096cd68a6d",
+            "region_name": "eu-central-1",
+        }
+
+    # Cached under the region we asked for, even without fallback
+    assert query_instance_details("dummy-instance", **kwargs) == details
+    assert sorted(c[0][1] for c in regional_lookup.call_args_list) == [
+        "eu-central-1",
+        "eu-west-1",
+        "us-east-1",
+    ]
+
+
+def test_query_instance_details_fallback_regions_not_found(regional_lookup):
+    kwargs = {"ec2": "eu-west-1", "profile_name": "default", "region_name": "eu-west-1"}
+
+    assert query_instance_details("dummy-instance", **kwargs) is None
+    assert (
+        query_instance_details(
+            "dummy-instance", fallback_regions=["eu-west-1", "us-east-1"], **kwargs
+        )
+        is None
+    )
+    assert (
+        query_instance_details(
+            "dummy-instance", fallback_regions=["eu-west-1"], **kwargs
+        )
+        is None
+    )
+    # The negative cache entry does not prevent looking into other regions
+    assert [c[0][1] for c in regional_lookup.call_args_list] == [
+        "eu-west-1",
+        "us-east-1",
+    ]
+
+
+def test_query_instance_details_fallback_regions_cancelled(mocker):
+    mocker.patch("aws_gate.query.REGION_FALLBACK_MAX_WORKERS", 1)
+    mocker.patch("aws_gate.query._query_instance_details", return_value=None)
+    release = threading.Event()
+    queried = []
+
+    def _query_region(_name, _profile_name, region_name, *_args):
+        queried.append(region_name)
+        if region_name == "eu-central-1":
+            return {"instance_id": "i-0c32153096cd68a6d", "region_name": region_name}
+        release.wait()
+        return None
+
+    mocker.patch("aws_gate.query._query_region", side_effect=_query_region)
+
+    details = query_instance_details(
+        "dummy-instance",
+        ec2="eu-west-1",
+        profile_name="default",
+        region_name="eu-west-1",
+        fallback_regions=["eu-central-1", "us-east-1", "us-west-2"],
+    )
+    release.set()
+
+    assert details["region_name"] == "eu-central-1"
+    assert "us-west-2" not in queried
+
+
+@pytest.fixture(name="profile_lookup")
+def profile_lookup_fixture(mocker):
+    # EC2 "resources" are profile names, so lookups can tell where they run
+    mocker.patch(
+        "aws_gate.query.get_aws_resource",
+        side_effect=lambda service, region_name, profile_name: profile_name,
+    )
+    release = threading.Event()
+
+    def _lookup(_name, ec2, **_kwargs):
+        if ec2 == "dev":
+            raise ProfileNotFound(profile=ec2)
+        if ec2 == "ops":
+            raise AWSConnectionError("access denied")
+        if ec2 == "stage":
+            release.wait(5)
+        if ec2 in ["stage", "prod"]:
+            return {"instance_id": f"i-{ec2}"}
+        return None
+
+    mocker.patch("aws_gate.query.query_instance_details", side_effect=_lookup)
+    yield release
+    release.set()
+
+
+def test_query_instance_in_profiles_order(profile_lookup, caplog):
+    caplog.set_level(logging.INFO, logger="aws_gate.query")
+    profile_lookup.set()
+
+    details = query_instance_in_profiles(
+        "dummy-instance",
+        profile_names=["dev", "ops", "test", "stage", "prod"],
+        region_name="eu-west-1",
+    )
+
+    assert details == {"instance_id": "i-stage", "profile_name": "stage"}
+    assert "Profile dev: failed after" in caplog.text
+    assert "Profile ops: failed after" in caplog.text
+    assert "Profile test: no instance found in" in caplog.text
+    assert "Profile stage: found i-stage in" in caplog.text
+
+
+@pytest.mark.usefixtures("profile_lookup")
+def test_query_instance_in_profiles_fastest():
+    details = query_instance_in_profiles(
+        "dummy-instance",
+        profile_names=["stage", "prod"],
+        region_name="eu-west-1",
+        preference="fastest",
+    )
+
+    assert details == {"instance_id": "i-prod", "profile_name": "prod"}
+
+
+@pytest.mark.usefixtures("profile_lookup")
+def test_query_instance_in_profiles_not_found():
+    assert (
+        query_instance_in_profiles(
+            "dummy-instance", profile_names=["dev", "test"], region_name="eu-west-1"
+        )
+        is None
+    )
+
+
+@pytest.mark.parametrize(
+    "profile_names, preference",
+    [([], "order"), (None, "order"), (["default"], "slowest")],
+    ids=["empty", "none", "preference"],
+)
+def test_query_instance_in_profiles_invalid(profile_names, preference):
+    with pytest.raises(ValueError):
+        query_instance_in_profiles(
+            "dummy-instance",
+            profile_names=profile_names,
+            region_name="eu-west-1",
+            preference=preference,
+        )
+
+
+@pytest.mark.parametrize(
+    "name, kwargs, expected",
+    [
+        ("dummy-instance", {}, "details"),
+        ("i-0c32153096cd68a6d", {}, "details"),
+        ("i-0c32153096cd68a6d", {"instance_id_only": True}, "instance_id"),
+        (
+            "i-0c32153096cd68a6d",
+            {"instance_id_only": True, "fallback_regions": ["eu-central-1"]},
+            "details",
+        ),
+        ("dummy-instance", {"profile_names": ["dev", "prod"]}, "profiles"),
+    ],
+    ids=["name", "id", "id-only", "id-fallback", "profiles"],
+)
+def test_resolve_instance(mocker, name, kwargs, expected):
+    resource_mock = mocker.patch("aws_gate.query.get_aws_resource")
+    details_mock = mocker.patch(
+        "aws_gate.query.query_instance_details", return_value="details"
+    )
+    profiles_mock = mocker.patch(
+        "aws_gate.query.query_instance_in_profiles", return_value="profiles"
+    )
+
+    instance = resolve_instance(name, "default", "eu-west-1", **kwargs)
+
+    if expected == "instance_id":
+        assert instance == {"instance_id": name}
+    else:
+        assert instance == expected
+    assert details_mock.called == (expected == "details")
+    assert profiles_mock.called == (expected == "profiles")
+    if details_mock.called:
+        assert resource_mock.call_args == mocker.call(
+            "ec2", region_name="eu-west-1", profile_name="default"
+        )
+        assert details_mock.call_args[1]["ec2"] == resource_mock.return_value
+
+
+@pytest.mark.parametrize(
+    "name, selection, availability_zone, filters",
+    [
+        (
+            "dummy-instance",
+            "first",
+            None,
+            [{"Name": "tag:Name", "Values": ["dummy-instance"]}],
+        ),
+        (
+            "i-0c32153096cd68a6d",
+            "same-az",
+            "eu-west-1b",
+            [{"Name": "instance-id", "Values": ["i-0c32153096cd68a6d"]}],
+        ),
+    ],
+    ids=["name", "id"],
+)
+def test_query_instance_details_from_inventory(
+    mocker, ec2, name, selection, availability_zone, filters
+):
+    lookup_mock = mocker.patch(
+        "aws_gate.query.lookup_instance",
+        return_value={"instance_id": "i-0c32153096cd68a6d"},
+    )
+    api_mock = mocker.patch("aws_gate.query._query_instance_details")
+
+    instance = query_instance_details(
+        name,
+        ec2=ec2,
+        profile_name="default",
+        region_name="eu-west-1",
+        selection=selection,
+        availability_zone=availability_zone,
+    )
+
+    assert instance == {"instance_id": "i-0c32153096cd68a6d"}
+    assert lookup_mock.call_args == mocker.call(
+        filters, "default", "eu-west-1", availability_zone=availability_zone
+    )
+    assert not api_mock.called
+
+
+@pytest.mark.parametrize(
+    "selection, inventory_instance",
+    [("first", None), ("newest", {"instance_id": "i-stale"})],
+    ids=["not in inventory", "newest"],
+)
+def test_query_instance_details_inventory_miss(
+    mocker, ec2, selection, inventory_instance
+):
+    mocker.patch("aws_gate.query.lookup_instance", return_value=inventory_instance)
+    mocker.patch(
+        "aws_gate.query._query_aws_api",
+        return_value={"instance_id": "i-0c32153096cd68a6d"},
+    )
+
+    instance = query_instance_details(
+        "dummy-instance",
+        ec2=ec2,
+        profile_name="default",
+        region_name="eu-west-1",
+        selection=selection,
+    )
+
+    assert instance == {"instance_id": "i-0c32153096cd68a6d"}
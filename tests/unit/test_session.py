@@ -1,5 +1,6 @@
 # pylint: disable=wrong-import-position
 import pytest
+from botocore.exceptions import ClientError
 
 from aws_gate.session import SSMSession, session  # noqa
 
@@ -38,8 +39,11 @@ def test_ssm_session_context_manager(ssm_mock, instance_id):
 
 def test_ssm_session(mocker, instance_id, config):
     mocker.patch("aws_gate.session.get_aws_client")
-    mocker.patch("aws_gate.session.get_aws_resource")
-    mocker.patch("aws_gate.session.query_instance", return_value=instance_id)
+    mocker.patch("aws_gate.query.get_aws_resource")
+    mocker.patch(
+        "aws_gate.query.query_instance_details",
+        return_value={"instance_id": instance_id},
+    )
     session_mock = mocker.patch(
         "aws_gate.session.SSMSession", return_value=mocker.MagicMock()
     )
@@ -58,8 +62,8 @@ def test_ssm_session(mocker, instance_id, config):
 
 def test_ssm_session_exception_invalid_profile(mocker, instance_id, config):
     mocker.patch("aws_gate.session.get_aws_client")
-    mocker.patch("aws_gate.session.get_aws_resource")
-    mocker.patch("aws_gate.session.query_instance", return_value=None)
+    mocker.patch("aws_gate.query.get_aws_resource")
+    mocker.patch("aws_gate.query.query_instance_details", return_value=None)
     mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
     mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
 
@@ -71,8 +75,8 @@ def test_ssm_session_exception_invalid_profile(mocker, instance_id, config):
 
 def test_ssm_session_exception_invalid_region(mocker, instance_id, config):
     mocker.patch("aws_gate.session.get_aws_client")
-    mocker.patch("aws_gate.session.get_aws_resource")
-    mocker.patch("aws_gate.session.query_instance", return_value=None)
+    mocker.patch("aws_gate.query.get_aws_resource")
+    mocker.patch("aws_gate.query.query_instance_details", return_value=None)
     mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
     mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
 
@@ -87,8 +91,8 @@ def test_ssm_session_exception_invalid_region(mocker, instance_id, config):
 
 def test_ssm_session_exception_unknown_instance_id(mocker, instance_id, config):
     mocker.patch("aws_gate.session.get_aws_client")
-    mocker.patch("aws_gate.session.get_aws_resource")
-    mocker.patch("aws_gate.session.query_instance", return_value=None)
+    mocker.patch("aws_gate.query.get_aws_resource")
+    mocker.patch("aws_gate.query.query_instance_details", return_value=None)
     mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
     mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
     mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
@@ -99,20 +103,141 @@ def test_ssm_session_exception_unknown_instance_id(mocker, instance_id, config):
             instance_name=instance_id,
             profile_name="profile",
             region_name="eu-west-1",
+            fallback_regions=["eu-central-1"],
         )
 
 
-def test_ssm_session_without_config(mocker, instance_id, empty_config):
+def test_ssm_session_without_config(mocker, empty_config):
     mocker.patch("aws_gate.session.get_aws_client")
-    mocker.patch("aws_gate.session.get_aws_resource")
-    mocker.patch("aws_gate.session.query_instance", return_value=None)
+    mocker.patch("aws_gate.query.get_aws_resource")
+    mocker.patch("aws_gate.query.query_instance_details", return_value=None)
     mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
     mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
 
     with pytest.raises(ValueError):
         session(
             config=empty_config,
-            instance_name=instance_id,
+            instance_name="dummy-instance",
             profile_name="profile",
             region_name="eu-west-1",
         )
+
+
+def test_create_ssm_session_instance_gone(mocker, ssm_mock, instance_id):
+    m = mocker.patch("aws_gate.query.invalidate_cached_instance")
+    ssm_mock.configure_mock(
+        **{
+            "start_session.side_effect": ClientError(
+                {"Error": {"Code": "TargetNotConnected"}}, "StartSession"
+            )
+        }
+    )
+    sess = SSMSession(instance_id=instance_id, ssm=ssm_mock)
+
+    with pytest.raises(ClientError):
+        sess.create()
+
+    assert m.call_args == mocker.call(instance_id)
+
+
+def test_ssm_session_instance_in_other_region(mocker, instance_id, empty_config):
+    client_mock = mocker.patch("aws_gate.session.get_aws_client")
+    mocker.patch("aws_gate.query.get_aws_resource")
+    query_mock = mocker.patch(
+        "aws_gate.query.query_instance_details",
+        return_value={"instance_id": instance_id, "region_name": "eu-central-1"},
+    )
+    session_mock = mocker.patch("aws_gate.session.SSMSession")
+    mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
+    mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
+    mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
+
+    session(
+        config=empty_config,
+        instance_name=instance_id,
+        profile_name="profile",
+        region_name="eu-west-1",
+        fallback_regions=["eu-central-1"],
+    )
+
+    assert query_mock.call_args[1]["fallback_regions"] == ["eu-central-1"]
+    assert client_mock.call_args == mocker.call(
+        "ssm", region_name="eu-central-1", profile_name="profile"
+    )
+    assert session_mock.call_args[1]["region_name"] == "eu-central-1"
+
+
+def test_ssm_session_instance_in_other_profile(mocker, instance_id, empty_config):
+    client_mock = mocker.patch("aws_gate.session.get_aws_client")
+    query_mock = mocker.patch(
+        "aws_gate.query.query_instance_in_profiles",
+        return_value={"instance_id": instance_id, "profile_name": "prod"},
+    )
+    session_mock = mocker.patch("aws_gate.session.SSMSession")
+    mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
+    mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
+    mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
+
+    session(
+        config=empty_config,
+        instance_name=instance_id,
+        profile_name="profile",
+        region_name="eu-west-1",
+        profile_names=["dev", "prod"],
+        profile_preference="fastest",
+    )
+
+    assert query_mock.call_args[1]["profile_names"] == ["dev", "prod"]
+    assert query_mock.call_args[1]["preference"] == "fastest"
+    assert client_mock.call_args == mocker.call(
+        "ssm", region_name="eu-west-1", profile_name="prod"
+    )
+    assert session_mock.call_args[1]["profile_name"] == "prod"
+
+
+def test_ssm_session_named_profiles_only(mocker, instance_id, empty_config):
+    mocker.patch("aws_gate.session.get_aws_client")
+    mocker.patch(
+        "aws_gate.query.query_instance_in_profiles",
+        return_value={"instance_id": instance_id, "profile_name": "b"},
+    )
+    session_mock = mocker.patch("aws_gate.session.SSMSession")
+    mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
+    mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
+    mocker.patch("aws_gate.utils.get_aws_profiles", return_value=["a", "b"])
+    mocker.patch(
+        "aws_gate.decorators.is_existing_profile",
+        side_effect=lambda profile_name: profile_name in ["a", "b"],
+    )
+
+    # "default" profile filled in by the CLI is not used with --profiles
+    session(
+        config=empty_config,
+        instance_name=instance_id,
+        profile_name="default",
+        region_name="eu-west-1",
+        profile_names=["a", "b"],
+    )
+
+    assert session_mock.call_args[1]["profile_name"] == "b"
+
+
+def test_ssm_session_by_instance_id(mocker, instance_id, empty_config):
+    mocker.patch("aws_gate.session.get_aws_client")
+    resource_mock = mocker.patch("aws_gate.query.get_aws_resource")
+    query_mock = mocker.patch("aws_gate.query.query_instance_details")
+    session_mock = mocker.patch("aws_gate.session.SSMSession")
+    mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
+    mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
+    mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
+
+    session(
+        config=empty_config,
+        instance_name=instance_id,
+        profile_name="profile",
+        region_name="eu-west-1",
+    )
+
+    assert session_mock.call_args[0][0] == instance_id
+    assert not query_mock.called
+    assert not resource_mock.called
@@ -0,0 +1,200 @@
+import base64
+import os
+import shutil
+import socket
+import stat
+import struct
+import subprocess
+
+import pytest
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+
+from aws_gate.ssh_agent import (
+    MAX_MESSAGE_SIZE,
+    SSH_AGENT_FAILURE,
+    SSH_AGENT_IDENTITIES_ANSWER,
+    SSH_AGENT_RSA_SHA2_256,
+    SSH_AGENT_RSA_SHA2_512,
+    SSH_AGENT_SIGN_RESPONSE,
+    SSH_AGENTC_REQUEST_IDENTITIES,
+    SSH_AGENTC_SIGN_REQUEST,
+    SshAgent,
+)
+from aws_gate.ssh_common import SshKey
+
+
+def _pack_string(data):
+    return struct.pack(">I", len(data)) + data
+
+
+def _unpack_string(data, offset=0):
+    (length,) = struct.unpack_from(">I", data, offset)
+    return data[offset + 4 : offset + 4 + length], offset + 4 + length
+
+
+def _receive(rfile):
+    header = rfile.read(4)
+    if not header:
+        return None
+    (length,) = struct.unpack(">I", header)
+    return rfile.read(length)
+
+
+def _request(socket_path, *messages, raw=b""):
+    # Stand-in for ssh talking to the agent
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(b"".join(_pack_string(m) for m in messages) + raw)
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile("rb") as rfile:
+            return [_receive(rfile) for _ in messages] or [_receive(rfile)]
+
+
+def _sign_request(key_blob, data, flags=0):
+    return (
+        bytes([SSH_AGENTC_SIGN_REQUEST])
+        + _pack_string(key_blob)
+        + _pack_string(data)
+        + struct.pack(">I", flags)
+    )
+
+
+@pytest.fixture(name="ssh_key", params=["ed25519", "rsa"])
+def ssh_key_fixture(request):
+    ssh_key = SshKey(key_type=request.param)
+    ssh_key.generate()
+    return ssh_key
+
+
+def _key_blob(ssh_key):
+    return base64.b64decode(ssh_key.public_key.split()[1])
+
+
+def test_ssh_agent_identities(ssh_key):
+    with SshAgent(ssh_key) as agent:
+        (response,) = _request(
+            agent.socket_path, bytes([SSH_AGENTC_REQUEST_IDENTITIES])
+        )
+
+    assert response[0] == SSH_AGENT_IDENTITIES_ANSWER
+    assert struct.unpack_from(">I", response, 1) == (1,)
+    key_blob, offset = _unpack_string(response, 5)
+    comment, _ = _unpack_string(response, offset)
+    assert key_blob == _key_blob(ssh_key)
+    assert comment == b"aws-gate session key"
+
+
+@pytest.mark.parametrize(
+    "flags, algorithm, hash_algorithm",
+    [
+        (0, b"ssh-rsa", hashes.SHA1),
+        (SSH_AGENT_RSA_SHA2_256, b"rsa-sha2-256", hashes.SHA256),
+        (SSH_AGENT_RSA_SHA2_512, b"rsa-sha2-512", hashes.SHA512),
+    ],
+    ids=["ssh-rsa", "rsa-sha2-256", "rsa-sha2-512"],
+)
+def test_ssh_agent_sign(ssh_key, flags, algorithm, hash_algorithm):
+    public_key = ssh_key._private_key.public_key()  # pylint: disable=protected-access
+    key_blob = _key_blob(ssh_key)
+
+    with SshAgent(ssh_key) as agent:
+        (response,) = _request(
+            agent.socket_path, _sign_request(key_blob, b"session", flags)
+        )
+
+    assert response[0] == SSH_AGENT_SIGN_RESPONSE
+    signature_blob, _ = _unpack_string(response, 1)
+    signature_algorithm, offset = _unpack_string(signature_blob)
+    signature, _ = _unpack_string(signature_blob, offset)
+    if ssh_key.key_type == "ed25519":
+        assert signature_algorithm == b"ssh-ed25519"
+        public_key.verify(signature, b"session")
+    else:
+        assert signature_algorithm == algorithm
+        public_key.verify(signature, b"session", padding.PKCS1v15(), hash_algorithm())
+
+
+def test_ssh_agent_sign_unknown_key(ssh_key):
+    with SshAgent(ssh_key) as agent:
+        (response,) = _request(agent.socket_path, _sign_request(b"unknown", b"data"))
+
+    assert response == bytes([SSH_AGENT_FAILURE])
+
+
+def test_ssh_agent_expired(ssh_key):
+    key_blob = _key_blob(ssh_key)
+
+    with SshAgent(ssh_key, lifetime=0) as agent:
+        identities, signature = _request(
+            agent.socket_path,
+            bytes([SSH_AGENTC_REQUEST_IDENTITIES]),
+            _sign_request(key_blob, b"data"),
+        )
+
+    assert identities == bytes([SSH_AGENT_IDENTITIES_ANSWER]) + struct.pack(">I", 0)
+    assert signature == bytes([SSH_AGENT_FAILURE])
+
+
+def test_ssh_agent_unsupported_request(ssh_key):
+    with SshAgent(ssh_key) as agent:
+        # Adding identities (SSH_AGENTC_ADD_IDENTITY) is not supported
+        (response,) = _request(agent.socket_path, bytes([17]))
+
+    assert response == bytes([SSH_AGENT_FAILURE])
+
+
+@pytest.mark.parametrize(
+    "raw",
+    [
+        b"\0\0",
+        struct.pack(">I", 0),
+        struct.pack(">I", MAX_MESSAGE_SIZE + 1),
+        struct.pack(">I", 10) + b"short",
+        _pack_string(bytes([SSH_AGENTC_SIGN_REQUEST]) + struct.pack(">I", 100)),
+    ],
+    ids=["header", "empty", "too large", "body", "sign request"],
+)
+def test_ssh_agent_invalid_message(ssh_key, raw):
+    with SshAgent(ssh_key) as agent:
+        assert _request(agent.socket_path, raw=raw) == [None]
+
+        # The agent keeps serving other connections
+        (response,) = _request(
+            agent.socket_path, bytes([SSH_AGENTC_REQUEST_IDENTITIES])
+        )
+        assert response[0] == SSH_AGENT_IDENTITIES_ANSWER
+
+
+def test_ssh_agent_socket(ssh_key):
+    agent = SshAgent(ssh_key)
+    assert agent.socket_path is None
+
+    with agent:
+        socket_path = agent.socket_path
+        assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+        assert stat.S_IMODE(os.stat(os.path.dirname(socket_path)).st_mode) == 0o700
+
+    assert not os.path.exists(os.path.dirname(socket_path))
+    agent.stop()
+
+
+@pytest.mark.skipif(shutil.which("ssh-add") is None, reason="ssh-add is missing")
+def test_ssh_agent_ssh_add(ssh_key, tmp_path):
+    public_key_path = tmp_path / "key.pub"
+    public_key_path.write_bytes(ssh_key.public_key)
+
+    with SshAgent(ssh_key) as agent:
+        env = dict(os.environ, SSH_AUTH_SOCK=agent.socket_path)
+        listed = subprocess.run(
+            ["ssh-add", "-l"], env=env, capture_output=True, check=True, text=True
+        )
+        # ssh-add -T signs data by the agent and verifies the signature
+        subprocess.run(
+            ["ssh-add", "-T", str(public_key_path)],
+            env=env,
+            capture_output=True,
+            check=True,
+        )
+
+    assert ssh_key.fingerprint in listed.stdout
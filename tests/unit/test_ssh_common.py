@@ -1,12 +1,22 @@
+import json
+import logging
+import os
+import stat
+import threading
+import time
 from datetime import timedelta
 
 import pytest
+from botocore.exceptions import ClientError
+from cryptography.hazmat.primitives.asymmetric import ed25519
 from hypothesis import given, example, settings
 from hypothesis.strategies import text, integers, sampled_from
 
-from aws_gate.constants import DEFAULT_GATE_KEY_PATH
+from aws_gate.constants import KEY_POOL_TYPES, SSH_KEY_REUSE_TTL
 from aws_gate.ssh_common import (
     SshKey,
+    SshKeyCache,
+    SshKeyPool,
     SUPPORTED_KEY_TYPES,
     KEY_MIN_SIZE,
     SshKeyUploader,
@@ -18,19 +28,21 @@ from aws_gate.ssh_common import (
 def test_initialize_key(key_type, key_size):
     key = SshKey(key_type=key_type, key_size=key_size)
 
-    assert key.key_path == DEFAULT_GATE_KEY_PATH
+    assert key.key_path is None
     assert key.key_type == key_type
     assert key.key_size == key_size
 
 
 @pytest.mark.parametrize("key_type", SUPPORTED_KEY_TYPES)
-def test_initialize_key_as_context_manager(mocker, key_type):
-    mocker.patch("aws_gate.ssh_common.os")
-    open_mock = mocker.patch("builtins.open", new_callable=mocker.mock_open())
+def test_initialize_key_as_context_manager(tmp_path, key_type):
+    with SshKey(key_type=key_type) as key:
+        assert key.key_path is None
+        key.write_to_file()
+        with open(key.key_path, "rb") as f:
+            assert f.read() == key.private_key
+        assert os.path.dirname(key.key_path) == str(tmp_path / "sessions")
 
-    with SshKey(key_type=key_type):
-        assert open_mock.called
-        open_mock.assert_called_with(DEFAULT_GATE_KEY_PATH, "wb")
+    assert not os.path.exists(key.key_path)
 
 
 @pytest.mark.parametrize("key_type", SUPPORTED_KEY_TYPES)
@@ -54,6 +66,122 @@ def test_initialize_key_unsupported_key_size(key_size):
         SshKey(key_size=key_size)
 
 
+@pytest.mark.parametrize("key_type", KEY_POOL_TYPES)
+def test_ssh_key_pool(mocker, tmp_path, key_type):
+    pool = SshKeyPool(size=2)
+    mocker.patch.object(pool, "refill_in_background")
+    assert pool.take(key_type, KEY_MIN_SIZE) is None
+
+    assert pool.refill(key_type, KEY_MIN_SIZE) == 2
+    assert pool.refill(key_type, KEY_MIN_SIZE) == 0
+
+    first = SshKey(key_type=key_type, key_pool=pool)
+    first.generate()
+    second = SshKey(key_type=key_type, key_pool=pool)
+    second.generate()
+
+    # Pooled keys are used once only
+    assert first.private_key != second.private_key
+    assert not list((tmp_path / "keys").glob(f"{key_type}*/*"))
+    assert pool.refill(key_type, KEY_MIN_SIZE) == 2
+
+
+def test_ssh_key_pool_empty(mocker):
+    pool = SshKeyPool(size=1)
+    refill_mock = mocker.patch.object(pool, "refill_in_background")
+
+    key = SshKey(key_pool=pool)
+    key.generate()
+
+    assert key.public_key.decode().startswith("ssh-rsa")
+    refill_mock.assert_called_once_with("rsa", KEY_MIN_SIZE)
+
+
+def test_ssh_key_pool_unpooled_key_type(mocker):
+    pool = SshKeyPool(size=1)
+    take_mock = mocker.patch.object(pool, "take")
+
+    key = SshKey(key_type="ed25519", key_pool=pool)
+    key.generate()
+
+    assert key.public_key.decode().startswith("ssh-ed25519")
+    assert not take_mock.called
+
+
+def test_ssh_key_pool_disabled(tmp_path):
+    pool = SshKeyPool(size=0)
+
+    assert pool.refill("rsa", KEY_MIN_SIZE) == 0
+    assert pool.refill_in_background("rsa", KEY_MIN_SIZE) is None
+    assert pool.take("rsa", KEY_MIN_SIZE) is None
+    assert not (tmp_path / "keys").exists()
+
+
+def test_ssh_key_pool_concurrent_take(mocker, tmp_path):
+    pool = SshKeyPool(size=1)
+    pool.refill("ed25519", KEY_MIN_SIZE)
+    rename = mocker.patch("aws_gate.ssh_common.os.rename")
+    # Another process claimed the key first
+    rename.side_effect = FileNotFoundError
+
+    assert pool.take("ed25519", KEY_MIN_SIZE) is None
+    assert len(list((tmp_path / "keys" / "ed25519").glob("*.pem"))) == 1
+
+
+def test_ssh_key_pool_concurrent_refill(mocker, tmp_path):
+    pool = SshKeyPool(size=2)
+    generate = mocker.patch(
+        "aws_gate.ssh_common._generate_private_key",
+        side_effect=lambda *args: time.sleep(0.05)
+        or ed25519.Ed25519PrivateKey.generate(),
+    )
+    barrier = threading.Barrier(3)
+    generated = []
+
+    def _refill():
+        barrier.wait()
+        generated.append(pool.refill("ed25519", KEY_MIN_SIZE))
+
+    threads = [threading.Thread(target=_refill) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Refills take turns and count the keys once they get theirs
+    assert sorted(generated) == [0, 0, 2]
+    assert generate.call_count == 2
+    assert len(list((tmp_path / "keys" / "ed25519").glob("*.pem"))) == 2
+
+
+def test_ssh_key_pool_unreadable_key(tmp_path):
+    pool = SshKeyPool(size=1)
+    (tmp_path / "keys" / "ed25519").mkdir(parents=True)
+    (tmp_path / "keys" / "ed25519" / "broken.pem").write_text("broken")
+
+    assert pool.take("ed25519", KEY_MIN_SIZE) is None
+    assert not list((tmp_path / "keys" / "ed25519").iterdir())
+
+
+def test_ssh_key_pool_refill_in_background(mocker, caplog):
+    caplog.set_level(logging.DEBUG)
+    pool = SshKeyPool(size=1)
+    refill_mock = mocker.patch.object(
+        pool, "refill", side_effect=[OSError("denied"), 1]
+    )
+
+    thread = pool.refill_in_background("rsa", KEY_MIN_SIZE)
+    # Only a single refill of the same keys runs at once
+    assert pool.refill_in_background("rsa", KEY_MIN_SIZE) is None
+    thread.join()
+
+    refill_mock.assert_called_once_with("rsa", KEY_MIN_SIZE)
+    assert "Unable to refill SSH key pool: denied" in caplog.text
+
+    pool.refill_in_background("rsa", KEY_MIN_SIZE).join()
+    assert "Added 1 rsa SSH keys to the pool" in caplog.text
+
+
 def test_initialize_key_invalid_key_path():
     with pytest.raises(ValueError):
         SshKey(key_path="")
@@ -65,29 +193,74 @@ def test_initialize_key_unsupported_key_type(key_type):
         SshKey(key_type=key_type)
 
 
-def test_ssh_key_file_permissions(mocker):
-    mocker.patch("builtins.open", new_callable=mocker.mock_open())
-    m = mocker.patch("aws_gate.ssh_common.os.chmod")
+def test_ssh_key_file_permissions():
+    with SshKey(key_type="ed25519") as key:
+        key.write_to_file()
+        assert stat.S_IMODE(os.stat(key.key_path).st_mode) == 0o600
+
+
+def test_delete_key():
+    key = SshKey(key_type="ed25519")
+    key.delete()
 
-    key = SshKey()
     key.generate()
     key.write_to_file()
+    key.delete()
+    key.delete()
 
-    assert m.called
-    assert mocker.call(DEFAULT_GATE_KEY_PATH, 0o600) == m.call_args_list[0]
+    assert not os.path.exists(key.key_path)
 
 
-def test_delete_key(mocker):
-    mocker.patch("builtins.open", new_callable=mocker.mock_open())
-    m = mocker.patch("aws_gate.ssh_common.os", new_callable=mocker.MagicMock())
+def test_session_key_paths():
+    # Concurrent sessions never share their key files
+    with SshKey(key_type="ed25519") as first, SshKey(key_type="ed25519") as second:
+        first.write_to_file()
+        second.write_to_file()
+        assert first.key_path != second.key_path
+        assert os.path.exists(first.key_path)
+        assert os.path.exists(second.key_path)
 
-    key = SshKey()
-    key.generate()
-    key.write_to_file()
-    key.delete()
 
-    assert m.remove.called
-    assert m.remove.call_args == mocker.call(DEFAULT_GATE_KEY_PATH)
+def test_shared_key_path(tmp_path):
+    key_path = str(tmp_path / "sessions" / "ec2-user@test-22")
+
+    with SshKey(key_path=key_path, key_type="ed25519") as first:
+        first.write_to_file()
+        with SshKey(key_path=key_path, key_type="ed25519") as second:
+            second.write_to_file()
+            with open(key_path, "rb") as f:
+                assert f.read() == second.private_key
+
+    # Other sessions might still need the file
+    assert first.key_path == key_path
+    assert os.path.exists(key_path)
+    assert stat.S_IMODE(os.stat(key_path).st_mode) == 0o600
+
+
+def test_purge_session_keys(tmp_path):
+    with SshKey(key_type="ed25519") as orphaned:
+        orphaned.write_to_file()
+    (tmp_path / "sessions" / "orphaned").write_text("key")
+    (tmp_path / "sessions" / "recent").write_text("key")
+    os.utime(tmp_path / "sessions" / "orphaned", (0, 0))
+
+    with SshKey(key_type="ed25519") as key:
+        key.write_to_file()
+        assert sorted(os.listdir(tmp_path / "sessions")) == sorted(
+            ["recent", os.path.basename(key.key_path)]
+        )
+    assert not os.path.exists(orphaned.key_path)
+
+
+def test_purge_session_keys_concurrently(mocker, tmp_path):
+    (tmp_path / "sessions").mkdir()
+    (tmp_path / "sessions" / "orphaned").write_text("key")
+    os.utime(tmp_path / "sessions" / "orphaned", (0, 0))
+    # Another session removed the file first
+    mocker.patch("aws_gate.ssh_common.os.remove", side_effect=FileNotFoundError)
+
+    with SshKey(key_type="ed25519") as key:
+        key.write_to_file()
 
 
 def test_uploader(ec2_ic_mock, ssh_key, instance_id):
@@ -118,3 +291,244 @@ def test_uploader_exception(ec2_ic_mock, ssh_key, instance_id):
             ec2_ic=ec2_ic_mock,
         )
         uploader.upload()
+
+
+def test_uploader_instance_gone(mocker, ec2_ic_mock, ssh_key, instance_id):
+    m = mocker.patch("aws_gate.query.invalidate_cached_instance")
+    ec2_ic_mock.configure_mock(
+        **{
+            "send_ssh_public_key.side_effect": ClientError(
+                {"Error": {"Code": "EC2InstanceNotFoundException"}},
+                "SendSSHPublicKey",
+            )
+        }
+    )
+    uploader = SshKeyUploader(
+        instance_id=instance_id, az="eu-west-1a", ssh_key=ssh_key, ec2_ic=ec2_ic_mock
+    )
+
+    with pytest.raises(ClientError):
+        uploader.upload()
+
+    assert m.call_args == mocker.call(instance_id)
+
+
+def _upload(ec2_ic_mock, instance_id, key_cache, key_type="ed25519", user="ec2-user"):
+    ssh_key = SshKey(
+        key_type=key_type,
+        private_key=key_cache.get(instance_id, user, key_type, KEY_MIN_SIZE),
+    )
+    ssh_key.generate()
+    SshKeyUploader(
+        instance_id=instance_id,
+        az="eu-west-1a",
+        user=user,
+        ssh_key=ssh_key,
+        ec2_ic=ec2_ic_mock,
+        key_cache=key_cache,
+    ).upload()
+    return ssh_key
+
+
+def test_ssh_key_fingerprint():
+    key = SshKey(key_type="ed25519")
+    key.generate()
+
+    assert key.fingerprint.startswith("SHA256:")
+    assert len(key.fingerprint) == 50
+
+
+def test_ssh_key_cache(ec2_ic_mock, instance_id):
+    key_cache = SshKeyCache()
+
+    first = _upload(ec2_ic_mock, instance_id, key_cache)
+    second = _upload(ec2_ic_mock, instance_id, key_cache)
+
+    assert second.private_key == first.private_key
+    assert ec2_ic_mock.send_ssh_public_key.call_count == 1
+
+    # Keys are pushed for every instance, user and key type separately
+    for kwargs in [
+        {"instance_id": instance_id, "user": "ubuntu"},
+        {"instance_id": "i-other"},
+        {"instance_id": instance_id, "key_type": "rsa"},
+    ]:
+        ssh_key = _upload(ec2_ic_mock, key_cache=key_cache, **kwargs)
+        assert ssh_key.private_key != first.private_key
+    assert ec2_ic_mock.send_ssh_public_key.call_count == 4
+
+
+@pytest.mark.parametrize(
+    "elapsed", [SSH_KEY_REUSE_TTL, -1], ids=["expired", "clock going backwards"]
+)
+def test_ssh_key_cache_expired(
+    mocker, ec2_ic_mock, instance_id, gate_cache_dir, elapsed
+):
+    key_cache = SshKeyCache()
+    now = time.time()
+    mocker.patch("aws_gate.ssh_common.time.time", return_value=now)
+    first = _upload(ec2_ic_mock, instance_id, key_cache)
+
+    mocker.patch("aws_gate.ssh_common.time.time", return_value=now + elapsed)
+    assert key_cache.get(instance_id, "ec2-user", "ed25519", KEY_MIN_SIZE) is None
+    assert not key_cache.is_pushed(instance_id, "ec2-user", first)
+    assert not list((gate_cache_dir / "ssh-keys").iterdir())
+
+
+def test_ssh_key_cache_validity_capped(mocker, ec2_ic_mock, instance_id):
+    key_cache = SshKeyCache(ttl=3600)
+    now = time.time()
+    mocker.patch("aws_gate.ssh_common.time.time", return_value=now)
+    _upload(ec2_ic_mock, instance_id, key_cache)
+
+    # Keys pushed via EC2 Instance Connect are never valid for longer
+    mocker.patch("aws_gate.ssh_common.time.time", return_value=now + 60)
+    assert key_cache.get(instance_id, "ec2-user", "ed25519", KEY_MIN_SIZE) is None
+
+
+def test_ssh_key_cache_purge(mocker, ec2_ic_mock, instance_id, gate_cache_dir):
+    key_cache = SshKeyCache()
+    now = time.time()
+    mocker.patch("aws_gate.ssh_common.time.time", return_value=now)
+    _upload(ec2_ic_mock, instance_id, key_cache)
+    (gate_cache_dir / "ssh-keys" / "corrupted.json").write_text("[]")
+
+    mocker.patch("aws_gate.ssh_common.time.time", return_value=now + 3600)
+    _upload(ec2_ic_mock, "i-other", key_cache)
+
+    assert len(list((gate_cache_dir / "ssh-keys").iterdir())) == 1
+
+
+def test_ssh_key_cache_disabled(ec2_ic_mock, instance_id, gate_cache_dir):
+    key_cache = SshKeyCache(ttl=0)
+
+    _upload(ec2_ic_mock, instance_id, key_cache)
+    _upload(ec2_ic_mock, instance_id, key_cache)
+
+    assert ec2_ic_mock.send_ssh_public_key.call_count == 2
+    assert not (gate_cache_dir / "ssh-keys").exists()
+
+
+@pytest.mark.parametrize(
+    "update",
+    [
+        {"instance_id": "i-other"},
+        {"private_key": "broken"},
+        {"private_key": None},
+        {"pushed": None},
+    ],
+    ids=["other instance", "broken key", "missing key", "missing push time"],
+)
+def test_ssh_key_cache_invalid_entry(ec2_ic_mock, instance_id, gate_cache_dir, update):
+    key_cache = SshKeyCache()
+    _upload(ec2_ic_mock, instance_id, key_cache)
+    (path,) = (gate_cache_dir / "ssh-keys").iterdir()
+    path.write_text(json.dumps(dict(json.loads(path.read_text()), **update)))
+
+    assert key_cache.get(instance_id, "ec2-user", "ed25519", KEY_MIN_SIZE) is None
+
+
+def test_ssh_key_cache_unreadable(ec2_ic_mock, instance_id, gate_cache_dir):
+    key_cache = SshKeyCache()
+    _upload(ec2_ic_mock, instance_id, key_cache)
+    (path,) = (gate_cache_dir / "ssh-keys").iterdir()
+    path.write_text("corrupted")
+
+    assert key_cache.get(instance_id, "ec2-user", "ed25519", KEY_MIN_SIZE) is None
+
+
+def test_ssh_key_cache_has_reusable_key(mocker, ec2_ic_mock, instance_id):
+    key_cache = SshKeyCache()
+    assert not key_cache.has_reusable_key("ec2-user", "ed25519", KEY_MIN_SIZE)
+
+    now = time.time()
+    mocker.patch("aws_gate.ssh_common.time.time", return_value=now)
+    with key_cache.lock(instance_id, "ec2-user"):
+        _upload(ec2_ic_mock, instance_id, key_cache)
+
+    # Keys pushed to any instance count, the instance is not known yet
+    assert key_cache.has_reusable_key("ec2-user", "ed25519", KEY_MIN_SIZE)
+    assert not key_cache.has_reusable_key("ubuntu", "ed25519", KEY_MIN_SIZE)
+    assert not key_cache.has_reusable_key("ec2-user", "rsa", KEY_MIN_SIZE)
+    assert not SshKeyCache(ttl=0).has_reusable_key("ec2-user", "ed25519", KEY_MIN_SIZE)
+
+    mocker.patch("aws_gate.ssh_common.time.time", return_value=now + SSH_KEY_REUSE_TTL)
+    assert not key_cache.has_reusable_key("ec2-user", "ed25519", KEY_MIN_SIZE)
+
+
+def test_ssh_key_cache_lock(gate_cache_dir, instance_id):
+    key_cache = SshKeyCache()
+    acquired = threading.Event()
+    released = threading.Event()
+
+    def _hold_lock():
+        with key_cache.lock(instance_id, "ec2-user"):
+            acquired.set()
+            released.wait()
+
+    thread = threading.Thread(target=_hold_lock)
+    thread.start()
+    acquired.wait()
+
+    # Locks of other instances and users are independent
+    with key_cache.lock(instance_id, "ubuntu"), key_cache.lock("i-other", "ec2-user"):
+        pass
+
+    entered = threading.Event()
+
+    def _wait_for_lock():
+        with key_cache.lock(instance_id, "ec2-user"):
+            entered.set()
+
+    waiting = threading.Thread(target=_wait_for_lock)
+    waiting.start()
+    assert not entered.wait(0.1)
+
+    released.set()
+    thread.join()
+    waiting.join()
+    assert entered.is_set()
+    assert len(list((gate_cache_dir / "ssh-keys").glob("*.lock"))) == 3
+
+
+def test_ssh_key_cache_lock_unavailable(gate_cache_dir, instance_id, caplog):
+    caplog.set_level(logging.DEBUG)
+    gate_cache_dir.mkdir()
+    (gate_cache_dir / "ssh-keys").write_text("not a directory")
+
+    with SshKeyCache().lock(instance_id, "ec2-user"):
+        pass
+
+    assert "Unable to lock" in caplog.text
+
+
+def test_ssh_key_cache_lock_without_fcntl(mocker, gate_cache_dir, instance_id):
+    mocker.patch.dict("sys.modules", {"fcntl": None})
+
+    with SshKeyCache().lock(instance_id, "ec2-user"):
+        pass
+
+    assert not (gate_cache_dir / "ssh-keys").exists()
+
+
+def test_ssh_key_cache_write_failure(mocker, ec2_ic_mock, instance_id, caplog):
+    caplog.set_level(logging.DEBUG)
+    mocker.patch(
+        "aws_gate.ssh_common.write_file_atomically", side_effect=OSError("denied")
+    )
+
+    _upload(ec2_ic_mock, instance_id, SshKeyCache())
+
+    assert "Unable to store pushed SSH key: denied" in caplog.text
+
+
+def test_ssh_key_cache_expired_concurrently(mocker, ec2_ic_mock, instance_id):
+    key_cache = SshKeyCache()
+    now = time.time()
+    mocker.patch("aws_gate.ssh_common.time.time", return_value=now)
+    _upload(ec2_ic_mock, instance_id, key_cache)
+
+    mocker.patch("aws_gate.ssh_common.time.time", return_value=now + 3600)
+    # Another process removed the expired key first
+    mocker.patch("aws_gate.ssh_common.os.remove", side_effect=FileNotFoundError)
+    assert key_cache.get(instance_id, "ec2-user", "ed25519", KEY_MIN_SIZE) is None
@@ -1,13 +1,12 @@
 import pytest
 
-from aws_gate.constants import DEFAULT_GATE_KEY_PATH
-from aws_gate.ssh_config import ssh_config, PROXY_COMMAND
+from aws_gate.ssh_config import KEY_PATH, ssh_config, PROXY_COMMAND
 
 
 def test_ssh_config(mocker, capsys):
     expected_output_lines = [
         """Host *.eu-west-1.default""",
-        f"""IdentityFile {DEFAULT_GATE_KEY_PATH}""",
+        f"""IdentityFile {KEY_PATH}""",
         """IdentitiesOnly yes""",
         """User ec2-user""",
         """Port 22""",
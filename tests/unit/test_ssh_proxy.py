@@ -1,7 +1,14 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
+from cryptography.hazmat.primitives import serialization
 
 from aws_gate.ssh_proxy import SshProxySession, ssh_proxy
 
+CONCURRENT_SESSIONS = 60
+
 
 def test_create_ssh_proxy_session(ssm_mock, instance_id):
     sess = SshProxySession(instance_id=instance_id, ssm=ssm_mock)
@@ -36,18 +43,15 @@ def test_ssh_proxy_session_context_manager(ssm_mock, instance_id):
     assert ssm_mock.terminate_session.called
 
 
-def test_ssh_proxy_session(
-    mocker, instance_id, ssh_key, get_instance_details_response, config
-):
+def test_ssh_proxy_session(mocker, instance_id, ssh_key, config):
     mocker.patch("aws_gate.ssh_proxy.get_aws_client")
-    mocker.patch("aws_gate.ssh_proxy.get_aws_resource")
-    mocker.patch("aws_gate.ssh_proxy.query_instance", return_value=instance_id)
-    mocker.patch("aws_gate.ssh_proxy.SshKey", return_value=ssh_key)
-    mocker.patch("aws_gate.ssh_proxy.SshKeyUploader", return_value=mocker.MagicMock())
+    mocker.patch("aws_gate.query.get_aws_resource")
     mocker.patch(
-        "aws_gate.ssh_proxy.get_instance_details",
-        return_value=get_instance_details_response,
+        "aws_gate.query.query_instance_details",
+        return_value={"instance_id": instance_id, "availability_zone": "eu-west-1a"},
     )
+    mocker.patch("aws_gate.ssh_proxy.SshKey", return_value=ssh_key)
+    mocker.patch("aws_gate.ssh_proxy.SshKeyUploader", return_value=mocker.MagicMock())
     session_mock = mocker.patch(
         "aws_gate.ssh_proxy.SshProxySession", return_value=mocker.MagicMock()
     )
@@ -66,8 +70,11 @@ def test_ssh_proxy_session(
 
 def test_ssh_proxy_exception_invalid_profile(mocker, instance_id, ssh_key, config):
     mocker.patch("aws_gate.ssh_proxy.get_aws_client")
-    mocker.patch("aws_gate.ssh_proxy.get_aws_resource")
-    mocker.patch("aws_gate.ssh_proxy.query_instance", return_value=instance_id)
+    mocker.patch("aws_gate.query.get_aws_resource")
+    mocker.patch(
+        "aws_gate.query.query_instance_details",
+        return_value={"instance_id": instance_id, "availability_zone": "eu-west-1a"},
+    )
     mocker.patch("aws_gate.ssh_proxy.SshKey", return_value=ssh_key)
     mocker.patch("aws_gate.decorators.is_existing_region", return_value=True)
     mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
@@ -84,8 +91,11 @@ def test_ssh_proxy_exception_invalid_profile(mocker, instance_id, ssh_key, confi
 
 def test_ssh_proxy_exception_invalid_region(mocker, instance_id, ssh_key, config):
     mocker.patch("aws_gate.ssh_proxy.get_aws_client")
-    mocker.patch("aws_gate.ssh_proxy.get_aws_resource")
-    mocker.patch("aws_gate.ssh_proxy.query_instance", return_value=instance_id)
+    mocker.patch("aws_gate.query.get_aws_resource")
+    mocker.patch(
+        "aws_gate.query.query_instance_details",
+        return_value={"instance_id": instance_id, "availability_zone": "eu-west-1a"},
+    )
     mocker.patch("aws_gate.ssh_proxy.SshKey", return_value=ssh_key)
     mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
     mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
@@ -102,8 +112,8 @@ def test_ssh_proxy_exception_invalid_region(mocker, instance_id, ssh_key, config
 
 def test_ssh_proxy_exception_unknown_instance_id(mocker, ssh_key, instance_id, config):
     mocker.patch("aws_gate.ssh_proxy.get_aws_client")
-    mocker.patch("aws_gate.ssh_proxy.get_aws_resource")
-    mocker.patch("aws_gate.ssh_proxy.query_instance", return_value=None)
+    mocker.patch("aws_gate.query.get_aws_resource")
+    mocker.patch("aws_gate.query.query_instance_details", return_value=None)
     mocker.patch("aws_gate.ssh_proxy.SshKey", return_value=ssh_key)
     mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
     mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
@@ -121,8 +131,8 @@ def test_ssh_proxy_exception_unknown_instance_id(mocker, ssh_key, instance_id, c
 
 def test_ssh_proxy_without_config(mocker, ssh_key, instance_id, empty_config):
     mocker.patch("aws_gate.ssh_proxy.get_aws_client")
-    mocker.patch("aws_gate.ssh_proxy.get_aws_resource")
-    mocker.patch("aws_gate.ssh_proxy.query_instance", return_value=None)
+    mocker.patch("aws_gate.query.get_aws_resource")
+    mocker.patch("aws_gate.query.query_instance_details", return_value=None)
     mocker.patch("aws_gate.ssh_proxy.SshKey", return_value=ssh_key)
     mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
     mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
@@ -134,3 +144,130 @@ def test_ssh_proxy_without_config(mocker, ssh_key, instance_id, empty_config):
             profile_name="default",
             region_name="eu-west-1",
         )
+
+
+def test_ssh_proxy_single_describe_instances(
+    mocker, ec2, ec2_api_calls, ssh_key, config
+):
+    mocker.patch("aws_gate.ssh_proxy.get_aws_client")
+    mocker.patch("aws_gate.query.get_aws_resource", return_value=ec2)
+    mocker.patch("aws_gate.ssh_proxy.SshKey", return_value=ssh_key)
+    uploader_mock = mocker.patch("aws_gate.ssh_proxy.SshKeyUploader")
+    mocker.patch("aws_gate.ssh_proxy.SshProxySession")
+    mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
+    mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
+    mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
+
+    ssh_proxy(
+        config=config,
+        instance_name="dummy-instance",
+        profile_name="default",
+        region_name="eu-west-1",
+    )
+
+    assert ec2_api_calls == ["DescribeInstances"]
+    assert uploader_mock.call_args[1]["instance_id"] == "i-0c32153096cd68a6d"
+    assert uploader_mock.call_args[1]["az"] == "eu-west-1a"
+
+
+@pytest.mark.parametrize(
+    "key_path", [None, "custom-key"], ids=["legacy key path", "custom key path"]
+)
+def test_ssh_proxy_key_path(mocker, instance_id, config, tmp_path, key_path):
+    # ssh configuration generated by earlier versions points IdentityFile to
+    # ~/.aws-gate/key without passing --key-path to ssh-proxy
+    expected_path = str(tmp_path / (key_path or "key"))
+    mocker.patch("aws_gate.ssh_proxy.get_aws_client")
+    mocker.patch("aws_gate.query.get_aws_resource")
+    mocker.patch(
+        "aws_gate.query.query_instance_details",
+        return_value={"instance_id": instance_id, "availability_zone": "eu-west-1a"},
+    )
+    mocker.patch("aws_gate.ssh_proxy.SshKeyUploader")
+    mocker.patch("aws_gate.ssh_proxy.SshProxySession")
+    mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
+    mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
+    mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
+
+    ssh_proxy(
+        config=config,
+        instance_name=instance_id,
+        profile_name="default",
+        region_name="eu-west-1",
+        key_type="ed25519",
+        key_path=expected_path if key_path else None,
+    )
+
+    with open(expected_path, "rb") as f:
+        assert serialization.load_pem_private_key(f.read(), None)
+    assert not (tmp_path / "sessions").exists()
+
+
+@pytest.mark.parametrize("reuse_ttl", [40, 0], ids=["key reuse", "no key reuse"])
+def test_ssh_proxy_concurrent_sessions(
+    mocker, instance_id, config, tmp_path, reuse_ttl
+):
+    # Sessions opened at once via ssh-config (e.g. by Ansible forks) share
+    # the key file, ssh has to find a pushed key in it whenever it reads it
+    key_path = str(tmp_path / "sessions" / "ec2-user@test.eu-west-1.default-22")
+    pushed = set()
+    authenticated = []
+
+    def _send_ssh_public_key(**kwargs):
+        time.sleep(0.01)
+        pushed.add(kwargs["SSHPublicKey"])
+        return {"Success": True}
+
+    class _SshProxySession:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def open(self):
+            # ssh reads the key once the proxy forwards the connection
+            time.sleep(random.uniform(0, 0.05))
+            with open(key_path, "rb") as f:
+                private_key = serialization.load_pem_private_key(f.read(), None)
+            public_key = private_key.public_key().public_bytes(
+                encoding=serialization.Encoding.OpenSSH,
+                format=serialization.PublicFormat.OpenSSH,
+            )
+            authenticated.append(public_key.decode() in pushed)
+
+    ec2_ic = mocker.MagicMock()
+    ec2_ic.send_ssh_public_key.side_effect = _send_ssh_public_key
+    mocker.patch("aws_gate.ssh_proxy.get_aws_client", return_value=ec2_ic)
+    mocker.patch("aws_gate.query.get_aws_resource")
+    mocker.patch(
+        "aws_gate.query.query_instance_details",
+        return_value={"instance_id": instance_id, "availability_zone": "eu-west-1a"},
+    )
+    mocker.patch("aws_gate.ssh_proxy.SshProxySession", _SshProxySession)
+    mocker.patch("aws_gate.ssh_common.SSH_KEY_REUSE_TTL", reuse_ttl)
+    mocker.patch("aws_gate.decorators._plugin_exists", return_value=True)
+    mocker.patch("aws_gate.decorators.execute_plugin", return_value="1.1.23.0")
+    mocker.patch("aws_gate.decorators.is_existing_profile", return_value=True)
+
+    with ThreadPoolExecutor(max_workers=CONCURRENT_SESSIONS) as executor:
+        futures = [
+            executor.submit(
+                ssh_proxy,
+                config=config,
+                instance_name="test",
+                profile_name="default",
+                region_name="eu-west-1",
+                key_type="ed25519",
+                key_path=key_path,
+            )
+            for _ in range(CONCURRENT_SESSIONS)
+        ]
+        for future in futures:
+            future.result()
+
+    assert authenticated == [True] * CONCURRENT_SESSIONS
+    assert len(pushed) == (1 if reuse_ttl else CONCURRENT_SESSIONS)
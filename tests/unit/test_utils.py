@@ -15,12 +15,17 @@ from aws_gate.utils import (
     _create_aws_session,
     get_aws_client,
     get_aws_resource,
+    get_aws_session,
+    get_aws_cache_stats,
+    get_aws_profiles,
+    get_default_region,
     AWS_REGIONS,
     is_existing_region,
     execute,
     execute_plugin,
     fetch_instance_details_from_config,
     get_instance_details,
+    write_file_atomically,
 )
 
 
@@ -41,10 +46,14 @@ def test_existing_profile(mocker):
     assert not is_existing_profile("nonexistentprofile")
 
 
+def test_get_aws_profiles(mocker):
+    mocker.patch("aws_gate.utils._create_aws_session", return_value=MockSession())
+
+    assert get_aws_profiles() == [f"profile{i}" for i in range(5)]
+
+
 def test_create_aws_session(mocker):
-    session_mock = mocker.patch(
-        "aws_gate.utils.boto3.session", return_value=mocker.MagicMock()
-    )
+    session_mock = mocker.patch("boto3.session", return_value=mocker.MagicMock())
 
     _create_aws_session(region_name="eu-west-1")
 
@@ -74,9 +83,7 @@ def test_aws_session_file_cache_is_set():
 
 
 def test_create_aws_session_with_profile(mocker):
-    session_mock = mocker.patch(
-        "aws_gate.utils.boto3.session", return_value=mocker.MagicMock()
-    )
+    session_mock = mocker.patch("boto3.session", return_value=mocker.MagicMock())
     _create_aws_session(region_name="eu-west-1", profile_name="default")
 
     assert session_mock.Session.called
@@ -91,9 +98,7 @@ def test_create_aws_profile_credentials_from_env_vars(mocker):
         "AWS_SECRET_ACCESS_KEY": "b",
         "AWS_SESSION_TOKEN": "c",
     }
-    session_mock = mocker.patch(
-        "aws_gate.utils.boto3.session", return_value=mocker.MagicMock()
-    )
+    session_mock = mocker.patch("boto3.session", return_value=mocker.MagicMock())
     mocker.patch.dict(os.environ, credentials_dict)
 
     _create_aws_session()
@@ -112,7 +117,10 @@ def test_get_aws_client(mocker):
     get_aws_client(service_name="ec2", region_name="eu-west-1")
 
     assert mock.called
-    assert mock.mock_calls == [mocker.call(profile_name=None, region_name="eu-west-1")]
+    assert mock.call_args == mocker.call(profile_name=None)
+    assert mock.return_value.client.call_args == mocker.call(
+        service_name="ec2", region_name="eu-west-1"
+    )
 
 
 def test_get_aws_resource(mocker):
@@ -124,6 +132,49 @@ def test_get_aws_resource(mocker):
     assert mock.called
 
 
+def test_aws_session_is_shared_per_profile(mocker):
+    mock = mocker.patch(
+        "aws_gate.utils._create_aws_session", side_effect=lambda **_: mocker.MagicMock()
+    )
+
+    assert get_aws_session("profile1") is get_aws_session("profile1")
+    assert get_aws_session("profile1") is not get_aws_session("profile2")
+    assert mock.call_count == 2
+
+
+def test_aws_clients_are_memoized(mocker):
+    def _session(**_):
+        return mocker.MagicMock(
+            **{
+                "client.side_effect": lambda **_: mocker.MagicMock(),
+                "resource.side_effect": lambda **_: mocker.MagicMock(),
+            }
+        )
+
+    mocker.patch("aws_gate.utils._create_aws_session", side_effect=_session)
+
+    ssm = get_aws_client("ssm", region_name="eu-west-1", profile_name="default")
+    ec2 = get_aws_resource("ec2", region_name="eu-west-1", profile_name="default")
+
+    assert get_aws_client("ssm", "eu-west-1", "default") is ssm
+    assert get_aws_resource("ec2", "eu-west-1", "default") is ec2
+    assert get_aws_client("ssm", "eu-west-2", "default") is not ssm
+    assert get_aws_client("ssm", "eu-west-1", "other") is not ssm
+    assert get_aws_cache_stats() == {"sessions": 2, "clients": 3, "resources": 1}
+
+
+def test_profile_validation_and_default_region_share_session(mocker):
+    mock = mocker.patch(
+        "aws_gate.utils._create_aws_session", return_value=mocker.MagicMock()
+    )
+
+    is_existing_profile("default")
+    get_default_region()
+    get_aws_client("ssm", region_name="eu-west-1")
+
+    assert mock.call_count == 1
+
+
 def test_region_validation():
     assert is_existing_region(region_name=AWS_REGIONS[0])
     assert not is_existing_region(region_name="unknown-region-1")
@@ -215,7 +266,11 @@ def test_get_instance_details_aws_api_exception(ec2_mock, instance_id):
     # https://github.com/surbas/pg2kinesis/blob/master/tests/test_stream.py#L20
     error_response = {"Error": {"Code": "ResourceInUseException"}}
     ec2_mock.configure_mock(
-        **{"instances.filter.side_effect": ClientError(error_response, "random_ec2_op")}
+        **{
+            "meta.client.get_paginator.return_value.paginate.side_effect": ClientError(
+                error_response, "random_ec2_op"
+            )
+        }
     )
 
     with pytest.raises(AWSConnectionError):
@@ -237,3 +292,22 @@ def test_get_instance_details(instance_id, ec2):
     details = get_instance_details(instance_id, ec2=ec2)
 
     assert details == expected_details
+
+
+def test_write_file_atomically(tmp_path):
+    path = tmp_path / "dir" / "file"
+
+    write_file_atomically(str(path), b"data")
+
+    assert path.read_bytes() == b"data"
+    assert path.stat().st_mode & 0o777 == 0o600
+    assert os.listdir(tmp_path / "dir") == ["file"]
+
+
+def test_write_file_atomically_failure(tmp_path, mocker):
+    mocker.patch("aws_gate.utils.os.replace", side_effect=OSError)
+
+    with pytest.raises(OSError):
+        write_file_atomically(str(tmp_path / "file"), b"data")
+
+    assert os.listdir(tmp_path) == []